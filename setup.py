@@ -99,6 +99,9 @@ setup(
         ],
         'calmjs.runtime': [
             'rjs = calmjs.rjs.runtime:default',
+            'karmaserver = calmjs.rjs.karma:karma_server [dev]',
+            'rjskarma = calmjs.rjs.karma:rjs_karma [dev]',
+            'nodetest = calmjs.rjs.noderunner:node_test [dev]',
         ],
         'calmjs.toolchain.advice': [
             'calmjs.dev.toolchain:KarmaToolchain = calmjs.rjs.dev:rjs_advice',
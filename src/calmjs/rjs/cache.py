@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent caches for calmjs.rjs.
+
+Everything stored here are plain JSON files inside a cache directory
+that must be explicitly provided, so that nothing will be written to
+unexpected locations unless requested.  All writes are done atomically
+through a temporary file that gets renamed into place, such that
+concurrent builds sharing the same cache directory will at worst lose
+some of the entries, but never read a partially written file.
+"""
+
+import codecs
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+from os import makedirs
+from os.path import abspath
+from os.path import exists
+from os.path import dirname
+from os.path import join
+from tempfile import mkstemp
+
+import pkg_resources
+
+logger = logging.getLogger(__name__)
+
+# The spec key for the cache directory.
+CACHE_DIR = 'rjs_cache_dir'
+# The spec key for the ResultCache instance for the cache directory.
+RESULT_CACHE = 'rjs_result_cache'
+
+STATE_CACHE_NAME = 'state.json'
+RESULT_CACHE_NAME = 'results'
+# Bump this whenever the results produced by the functions that make use
+# of the result cache are changed in any way.
+RESULT_CACHE_VERSION = 1
+# The default maximum size of the result cache, in bytes.
+RESULT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# The number of new entries written between the pruning of the cache.
+RESULT_CACHE_PRUNE_INTERVAL = 256
+
+
+def hash_key(*parts):
+    """
+    Produce a stable hex digest for the JSON serializable parts.
+    """
+
+    return hashlib.sha1(json.dumps(
+        parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _rename(source, target):
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        replace(source, target)
+        return
+    # Python 2 on Windows does not provide a rename that overwrite.
+    if os.name == 'nt' and exists(target):  # pragma: no cover
+        os.remove(target)
+    os.rename(source, target)
+
+
+def read_json(path):
+    """
+    Return the JSON value stored at path, or None if it does not exist
+    or if it has become unreadable.
+    """
+
+    try:
+        with codecs.open(path, encoding='utf-8') as fd:
+            return json.load(fd)
+    except (OSError, IOError) as e:
+        if e.errno != errno.ENOENT:
+            logger.debug("failed to read cache file '%s': %s", path, e)
+    except ValueError as e:
+        logger.warning("ignoring corrupted cache file '%s': %s", path, e)
+    return None
+
+
+def _mkstemp(path):
+    target_dir = dirname(path)
+    if not exists(target_dir):
+        try:
+            makedirs(target_dir)
+        except OSError as e:  # pragma: no cover
+            # another process may have created it first.
+            if e.errno != errno.EEXIST:
+                raise
+    return mkstemp(dir=target_dir, prefix='.tmp')
+
+
+def write_json(path, value):
+    """
+    Atomically write the JSON serializable value to path.
+    """
+
+    fd, tmp = _mkstemp(path)
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(value, stream, sort_keys=True)
+        _rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def write_text(path, text):
+    """
+    Atomically write the text to path, encoded as utf-8.
+    """
+
+    fd, tmp = _mkstemp(path)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(text.encode('utf-8'))
+        _rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def store_file(source, path):
+    """
+    Atomically copy the file at source to path.
+    """
+
+    fd, tmp = _mkstemp(path)
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp)
+        _rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def stat_fingerprint(path):
+    """
+    Return the cheaply acquired fingerprint of the file at path, or None
+    if it cannot be stat'ed.
+    """
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+class StateCache(object):
+    """
+    A small persistent mapping of keys to values, with each value being
+    associated with a number of files that it was derived from.  A value
+    is only returned if none of those files have been changed, as
+    determined by their stat fingerprint.
+    """
+
+    def __init__(self, cache_dir, name=STATE_CACHE_NAME):
+        self.path = join(cache_dir, name)
+
+    def _load(self):
+        entries = read_json(self.path)
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if not isinstance(entry, dict):
+            return None
+        for path, fingerprint in entry.get('files', {}).items():
+            if stat_fingerprint(path) != fingerprint:
+                logger.debug(
+                    "cached state '%s' invalidated by changes to '%s'",
+                    key, path)
+                return None
+        return entry.get('value')
+
+    def set(self, key, value, files=()):
+        entries = self._load()
+        entries[key] = {
+            'value': value,
+            'files': {path: stat_fingerprint(path) for path in files},
+        }
+        try:
+            write_json(self.path, entries)
+        except (OSError, IOError) as e:
+            logger.warning(
+                "failed to write state cache '%s': %s", self.path, e)
+
+
+def get_dist_version(name):
+    try:
+        return pkg_resources.get_distribution(name).version
+    except Exception:  # pragma: no cover
+        # the cache is still usable within the same environment.
+        return None
+
+
+def get_parser_version():
+    return get_dist_version('calmjs.parse')
+
+
+class ResultCache(object):
+    """
+    A persistent store of the results of functions applied to the text
+    of source files, such that unchanged files need not be processed
+    again.
+
+    The results are addressed by the name of the function, the versions
+    of calmjs.parse and calmjs.rjs, and the digest of the text.  The
+    digest for a path is tracked alongside its size and modification
+    time, such that the file is only read and hashed again when these
+    have changed; a file that was touched but with identical content
+    will still make use of the stored results.  Entries that were least
+    recently used will be evicted once the total size exceeds the
+    maximum size.
+    """
+
+    def __init__(
+            self, cache_dir, max_size=RESULT_CACHE_MAX_SIZE,
+            version=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.version = [RESULT_CACHE_VERSION, (
+            get_parser_version() if version is None else version),
+            get_dist_version('calmjs.rjs')]
+        # the number of the next entry to be written; the cache is only
+        # pruned once every RESULT_CACHE_PRUNE_INTERVAL entries written.
+        self.written = 1
+
+    def _path_index(self, path):
+        return join(self.cache_dir, 'paths', hash_key(abspath(path)) + '.json')
+
+    def _entry(self, name, digest):
+        key = hash_key(name, self.version, digest)
+        return join(self.cache_dir, 'entries', key[:2], key + '.json')
+
+    def _load(self, entry):
+        value = read_json(entry)
+        if not isinstance(value, dict) or 'value' not in value:
+            return None
+        try:
+            # mark this entry as recently used.
+            os.utime(entry, None)
+        except OSError:  # pragma: no cover
+            pass
+        return value
+
+    def _file(self, name, key, suffix):
+        key = hash_key(name, self.version, key)
+        return join(self.cache_dir, 'files', key[:2], key + suffix)
+
+    def _written(self):
+        if self.written % RESULT_CACHE_PRUNE_INTERVAL == 0:
+            self.prune()
+        self.written += 1
+
+    def _write(self, path, value):
+        try:
+            write_json(path, value)
+        except (TypeError, ValueError) as e:
+            logger.debug("value not cacheable for '%s': %s", path, e)
+            return
+        except (OSError, IOError) as e:
+            logger.warning("failed to write result cache '%s': %s", path, e)
+            return
+        self._written()
+
+    def get(self, name, key):
+        """
+        Return the value stored for the JSON serializable key under the
+        name, or None if there is none.
+        """
+
+        cached = self._load(self._entry(name, key))
+        return None if cached is None else cached['value']
+
+    def set(self, name, key, value):
+        self._write(self._entry(name, key), {'value': value})
+
+    def get_file(self, name, key, suffix='.js'):
+        """
+        Return the path to the file stored for the JSON serializable key
+        under the name, or None if there is none.
+        """
+
+        path = self._file(name, key, suffix)
+        try:
+            # mark this file as recently used.
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def set_file(self, name, key, source, suffix='.js'):
+        """
+        Store a copy of the file at source for the key under the name,
+        and return the path to the stored copy, or None on failure.
+        """
+
+        path = self._file(name, key, suffix)
+        try:
+            store_file(source, path)
+        except (OSError, IOError) as e:
+            logger.warning(
+                "failed to store '%s' in result cache: %s", source, e)
+            return None
+        self._written()
+        return path
+
+    def process(self, path, f, encoding='utf-8'):
+        """
+        Return the result of calling f with the text of the file at path,
+        making use of the stored result if available.  Exceptions from
+        reading the file or from the function are raised as is.
+        """
+
+        name = getattr(f, '__name__', None)
+        if name is None:
+            # not an identifiable function, e.g. a partial.
+            with codecs.open(path, encoding=encoding) as fd:
+                return f(fd.read())
+        name = '%s.%s' % (getattr(f, '__module__', None), name)
+
+        fingerprint = stat_fingerprint(path)
+        path_index = self._path_index(path)
+        index = read_json(path_index)
+        if (isinstance(index, dict) and fingerprint is not None and
+                index.get('stat') == fingerprint):
+            cached = self._load(self._entry(name, index.get('digest')))
+            if cached is not None:
+                return cached['value']
+
+        with codecs.open(path, encoding=encoding) as fd:
+            text = fd.read()
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        if not isinstance(index, dict) or index != {
+                'stat': fingerprint, 'digest': digest}:
+            self._write(path_index, {'stat': fingerprint, 'digest': digest})
+
+        entry = self._entry(name, digest)
+        cached = self._load(entry)
+        if cached is not None:
+            return cached['value']
+
+        value = f(text)
+        if value is not None:
+            self._write(entry, {'value': value})
+        return value
+
+    def prune(self):
+        """
+        Evict the least recently used files until the total size of the
+        cache is within the maximum size.
+        """
+
+        files = []
+        total = 0
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.startswith('.tmp'):
+                    # being written by some other process.
+                    continue
+                path = join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by a concurrent process.
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_size:
+            return
+        files.sort()
+        for mtime, size, path in files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+        logger.debug(
+            "pruned result cache '%s' to %d bytes", self.cache_dir, total)
+
+
+def get_result_cache(spec):
+    """
+    Return the ResultCache for the cache directory in the spec, or None
+    if it was not specified.  The instance is kept in the spec, such
+    that the entries written through it are counted across its users.
+    """
+
+    cache_dir = spec.get(CACHE_DIR)
+    if not cache_dir:
+        return None
+    result_cache = spec.get(RESULT_CACHE)
+    path = join(cache_dir, RESULT_CACHE_NAME)
+    if not isinstance(result_cache, ResultCache) or (
+            result_cache.cache_dir != path):
+        result_cache = spec[RESULT_CACHE] = ResultCache(path)
+    return result_cache
@@ -19,12 +19,25 @@ from calmjs.toolchain import SOURCE_PACKAGE_NAMES
 from calmjs.toolchain import WORKING_DIR
 from calmjs.rjs.registry import RJS_LOADER_PLUGIN_REGISTRY_NAME
 from calmjs.rjs.toolchain import STUB_MISSING_WITH_EMPTY
+from calmjs.rjs.toolchain import SIZE_BUDGET
+from calmjs.rjs.toolchain import SIZE_REPORT
+from calmjs.rjs.toolchain import DUPLICATE_MODULES_METHOD
+from calmjs.rjs.toolchain import CACHE_DIR
+from calmjs.rjs.toolchain import REPRODUCIBLE
+from calmjs.rjs.toolchain import DEFINE_MANIFEST
+from calmjs.rjs.toolchain import PRELOAD_CONFIG
+from calmjs.rjs.toolchain import PRELOAD_MANIFEST
+from calmjs.rjs.utils import MATERIALIZE_METHOD
+from calmjs.rjs.utils import PROCESSES
 
 from calmjs.rjs.toolchain import RJSToolchain
 
 from calmjs.rjs.dist import generate_transpile_sourcepaths
 from calmjs.rjs.dist import generate_bundle_sourcepaths
 from calmjs.rjs.dist import get_calmjs_module_registry_for
+from calmjs.rjs.dist import get_dist_cache
+from calmjs.rjs.lockfile import read_lockfile
+from calmjs.rjs.lockfile import write_lockfile
 
 default_toolchain = RJSToolchain()
 logger = logging.getLogger(__name__)
@@ -36,7 +49,12 @@ def create_spec(
         sourcepath_method='all', bundlepath_method='all',
         calmjs_loaderplugin_registry_name=RJS_LOADER_PLUGIN_REGISTRY_NAME,
         stub_missing_with_empty=False,
-        transpile_no_indent=False):
+        transpile_no_indent=False,
+        size_report=None, size_budget=None,
+        duplicate_modules_method='ignore',
+        cache_dir=None, materialize_method='copy', reproducible=False,
+        processes=None, define_manifest=False, preload_manifest=False,
+        preload_config=None, lockfile=None):
     """
     Produce a spec for the compilation through the RJSToolchain.
 
@@ -133,6 +151,115 @@ def create_spec(
     transpile_no_indent
         Ensure that the transpile targets have no indents.
 
+    size_report
+        The path to write a JSON report that attributes the raw and
+        gzipped bytes of the export_target to every module and to the
+        package that provided it.  Defaults to None, which produces no
+        report.
+
+    size_budget
+        The path to a JSON file that declares the size limits for the
+        artifact (the 'total' key) and/or for specific packages (under
+        the 'packages' key).  The build will fail if any of them are
+        exceeded.  Defaults to None.
+
+    duplicate_modules_method
+        The handling method for modules that are found to have the same
+        normalized content as some other module under a different name,
+        as they are typically duplicate copies of the same library.
+
+        'ignore'
+            Do not look for duplicate modules.
+        'report'
+            Report the duplicate modules as warnings.
+        'alias'
+            Same as report, but also alias the duplicate modules to the
+            canonical module in the generated configuration such that
+            only one copy will be included in the artifact.  Note that
+            this changes the identity of the aliased modules, as they
+            will be the same instance as the canonical module, so any
+            state kept by the module will be shared.  Modules with
+            relative imports are only aliased if those imports resolve
+            to the same modules.
+
+        Defaults to 'ignore'.
+
+    cache_dir
+        The directory where persistent state that may be reused across
+        builds will be kept, such as the location of the r.js binary,
+        the modules imported by every source file, and the registries
+        and sourcepaths resolved for the packages for as long as the
+        installed distributions remain unchanged.  Defaults to None,
+        which disables these caches.
+
+    materialize_method
+        The method used to place the bundled source files into the build
+        directory.  Choices are:
+
+        'copy'
+            Copy the files.
+        'hardlink'
+            Create hard links to the source files.
+        'reflink'
+            Create copy-on-write clones of the source files, for the
+            filesystems that support this.
+        'symlink'
+            Create symbolic links to the source files.
+
+        Where the filesystem does not support the selected method, the
+        file will be copied.  Defaults to 'copy'.
+
+    reproducible
+        Ensure that identical inputs will produce byte identical build
+        configuration files and artifact, by sorting all the emitted
+        mappings and the modules to include, and by making the paths
+        that reference the build directory relative to it.  The baseUrl
+        of the requirejs configuration (config.js) will then be '.',
+        which its consumers must resolve against the build directory;
+        the configuration for Node.js (node_config_js) is loaded from
+        arbitrary working directories, so its baseUrl remains the
+        absolute path to the build directory.  Defaults to False.
+
+    processes
+        The number of worker processes to use for processing the
+        artifacts for the test runner; 0 to use the number of CPUs.
+        Defaults to None, which processes them within the current
+        process.
+
+    define_manifest
+        Write a manifest of the modules defined by the export_target
+        along with their requirements next to it (with a
+        '.defines.json' suffix), such that the test runner will not need
+        to process the artifact again while it remains unchanged.
+        Defaults to False.
+
+    preload_manifest
+        Write a manifest of every file that will be fetched for the
+        export_target next to it (with a '.preload.json' suffix), in the
+        order they are required, i.e. the modules and loader plugin
+        resources that are required but not included, followed by the
+        export_target itself, such that pages making use of it may emit
+        the hints to preload them.  Defaults to False.
+
+    preload_config
+        The path to a JSON file with the requirejs config (i.e. the
+        baseUrl, paths and bundles) of the pages making use of the
+        export_target, for the locations of the files listed in the
+        preload manifest; a relative baseUrl is relative to the
+        export_target.  Defaults to None, where the files are located
+        relative to the export_target, as they would be for it being
+        the data-main of requirejs.
+
+    lockfile
+        The path to a lockfile recording the resolved registries,
+        transpile_sourcepath and bundle_sourcepath, along with the
+        fingerprints of the distributions and the source directories
+        that contributed to them.  If the lockfile was created with the
+        identical arguments and its fingerprints still match, the
+        recorded values will be used instead of resolving them through
+        the module registries; otherwise they will be resolved and the
+        lockfile written.  Defaults to None.
+
     """
 
     working_dir = working_dir if working_dir else default_toolchain.join_cwd()
@@ -150,27 +277,63 @@ def create_spec(
         transpile_no_indent=transpile_no_indent,
     )
 
-    if source_registries is None:
-        source_registries = get_calmjs_module_registry_for(
-            package_names, method=source_registry_method)
-        if source_registries:
+    lock_inputs = {
+        'package_names': list(package_names or ()),
+        'working_dir': working_dir,
+        'source_registry_method': source_registry_method,
+        'source_registries': (
+            None if source_registries is None else list(source_registries)),
+        'sourcepath_method': sourcepath_method,
+        'bundlepath_method': bundlepath_method,
+    }
+    locked = read_lockfile(lockfile, lock_inputs) if lockfile else None
+    if locked is not None:
+        source_registries, transpile_sourcepath, bundle_sourcepath = locked
+        logger.info(
+            "using registries %r and sourcepaths recorded in lockfile '%s'",
+            source_registries, lockfile,
+        )
+    else:
+        dist_cache = get_dist_cache(cache_dir)
+        if source_registries is None:
+            source_registries = get_calmjs_module_registry_for(
+                package_names, method=source_registry_method,
+                cache=dist_cache)
+            if source_registries:
+                logger.info(
+                    "automatically picked registries %r for sourcepaths",
+                    source_registries,
+                )
+            elif package_names:
+                logger.warning(
+                    "no module registry declarations found using packages %r "
+                    "using acquisition method '%s'",
+                    package_names, source_registry_method,
+                )
+            else:
+                logger.warning('no packages specified for spec construction')
+        else:
             logger.info(
-                "automatically picked registries %r for sourcepaths",
+                "using manually specified registries %r for sourcepaths",
                 source_registries,
             )
-        elif package_names:
-            logger.warning(
-                "no module registry declarations found using packages %r "
-                "using acquisition method '%s'",
-                package_names, source_registry_method,
-            )
-        else:
-            logger.warning('no packages specified for spec construction')
-    else:
-        logger.info(
-            "using manually specified registries %r for sourcepaths",
-            source_registries,
+
+        transpile_sourcepath = generate_transpile_sourcepaths(
+            package_names=package_names,
+            registries=source_registries,
+            method=sourcepath_method,
+            cache=dist_cache,
+        )
+        bundle_sourcepath = generate_bundle_sourcepaths(
+            package_names=package_names,
+            working_dir=working_dir,
+            method=bundlepath_method,
+            cache=dist_cache,
         )
+        if lockfile:
+            write_lockfile(
+                lockfile, lock_inputs, source_registries,
+                transpile_sourcepath, bundle_sourcepath)
 
     spec[BUILD_DIR] = build_dir
     spec[CALMJS_MODULE_REGISTRY_NAMES] = source_registries
@@ -178,19 +341,21 @@ def create_spec(
     spec[EXPORT_TARGET] = export_target
     spec[SOURCE_PACKAGE_NAMES] = package_names
     spec[STUB_MISSING_WITH_EMPTY] = stub_missing_with_empty
+    spec[SIZE_REPORT] = size_report
+    spec[SIZE_BUDGET] = size_budget
+    spec[DUPLICATE_MODULES_METHOD] = duplicate_modules_method
+    spec[CACHE_DIR] = cache_dir
+    spec[MATERIALIZE_METHOD] = materialize_method
+    spec[REPRODUCIBLE] = reproducible
+    spec[PROCESSES] = processes
+    spec[DEFINE_MANIFEST] = define_manifest
+    spec[PRELOAD_MANIFEST] = preload_manifest
+    spec[PRELOAD_CONFIG] = preload_config
     spec[WORKING_DIR] = working_dir
 
-    spec_update_sourcepath(spec, generate_transpile_sourcepaths(
-        package_names=package_names,
-        registries=source_registries,
-        method=sourcepath_method,
-    ), 'transpile_sourcepath')
-
-    spec_update_sourcepath(spec, generate_bundle_sourcepaths(
-        package_names=package_names,
-        working_dir=working_dir,
-        method=bundlepath_method,
-    ), 'bundle_sourcepath')
+    spec_update_sourcepath(
+        spec, transpile_sourcepath, 'transpile_sourcepath')
+    spec_update_sourcepath(spec, bundle_sourcepath, 'bundle_sourcepath')
 
     return spec
 
@@ -202,7 +367,11 @@ def compile_all(
         calmjs_loaderplugin_registry_name=RJS_LOADER_PLUGIN_REGISTRY_NAME,
         stub_missing_with_empty=False,
         transpile_no_indent=False,
-        toolchain=default_toolchain):
+        size_report=None, size_budget=None,
+        duplicate_modules_method='ignore',
+        cache_dir=None, materialize_method='copy', reproducible=False,
+        processes=None, define_manifest=False, preload_manifest=False,
+        preload_config=None, lockfile=None, toolchain=default_toolchain):
     """
     Invoke the r.js compiler to generate a JavaScript bundle file for a
     given Python package.  The bundle will include all the dependencies
@@ -234,6 +403,17 @@ def compile_all(
         calmjs_loaderplugin_registry_name=calmjs_loaderplugin_registry_name,
         stub_missing_with_empty=stub_missing_with_empty,
         transpile_no_indent=transpile_no_indent,
+        size_report=size_report,
+        size_budget=size_budget,
+        duplicate_modules_method=duplicate_modules_method,
+        cache_dir=cache_dir,
+        materialize_method=materialize_method,
+        reproducible=reproducible,
+        processes=processes,
+        define_manifest=define_manifest,
+        preload_manifest=preload_manifest,
+        preload_config=preload_config,
+        lockfile=lockfile,
     )
     toolchain(spec)
     return spec
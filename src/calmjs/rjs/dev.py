@@ -3,10 +3,15 @@
 Integration with various tools proided by the calmjs.dev package
 """
 
+import codecs
+import json
 import logging
 from os.path import basename
+from os.path import isfile
 from os.path import join
+from os.path import realpath
 from os.path import sep
+from subprocess import call
 
 from calmjs.exc import ToolchainAbort
 from calmjs.registry import get
@@ -14,27 +19,70 @@ from calmjs.toolchain import ARTIFACT_PATHS
 from calmjs.toolchain import BUILD_DIR
 from calmjs.toolchain import CONFIG_JS_FILES
 from calmjs.toolchain import TEST_MODULE_PATHS_MAP
+from calmjs.toolchain import TOOLCHAIN_BIN_PATH
+from calmjs.toolchain import WORKING_DIR
 from calmjs.toolchain import spec_update_loaderplugin_registry
 from calmjs.toolchain import CALMJS_LOADERPLUGIN_REGISTRY
 
-from calmjs.utils import json_dump
 from calmjs.utils import json_dumps
 
 try:
+    from calmjs.dev.karma import AFTER_KARMA
     from calmjs.dev.karma import BEFORE_KARMA
+    from calmjs.dev.toolchain import COVERAGE_ENABLE
     from calmjs.dev.toolchain import TEST_FILENAME_PREFIX
     from calmjs.dev.toolchain import TEST_FILENAME_PREFIX_DEFAULT
 except ImportError:  # pragma: no cover
     # Package not available; None is the advice blackhole
-    BEFORE_KARMA = None
-
+    AFTER_KARMA = BEFORE_KARMA = None
+
+from calmjs.rjs.cache import CACHE_DIR
+from calmjs.rjs.cache import StateCache
+from calmjs.rjs.cache import get_result_cache
+from calmjs.rjs.cache import hash_key
+from calmjs.rjs.cache import stat_fingerprint
+from calmjs.rjs.cache import store_file
+from calmjs.rjs.cache import write_text
+from calmjs.rjs.dist import EMPTY
+from calmjs.rjs.instrument import instrument_paths
+from calmjs.rjs.manifest import digest_path
+from calmjs.rjs.manifest import read_define_manifest
 from calmjs.rjs.registry import RJS_LOADER_PLUGIN_REGISTRY_NAME
-from calmjs.rjs.requirejs import extract_defines_with_deps_from_paths
+from calmjs.rjs.requirejs import extract_imports
+from calmjs.rjs.requirejs import iter_paths_defines_records
+from calmjs.rjs.requirejs import order_defines
+from calmjs.rjs.requirejs import process_path
+from calmjs.rjs.requirejs import sort_defines
+from calmjs.rjs.requirejs import transitive_closure
+from calmjs.rjs.requirejs import update_defines
 from calmjs.rjs.umdjs import UMD_REQUIREJS_JSON_EXPORT_HEADER
 from calmjs.rjs.umdjs import UMD_REQUIREJS_JSON_EXPORT_FOOTER
+from calmjs.rjs.utils import PROCESSES
 
 logger = logging.getLogger(__name__)
 
+# spec keys for the karma advice
+KARMA_SHARDS = 'karma_shards'
+KARMA_TEST_DURATIONS = 'karma_test_durations'
+KARMA_SELECT_CHANGED = 'karma_select_changed'
+KARMA_CHANGED_FILES = 'karma_changed_files'
+KARMA_MINIMAL_DEPS = 'karma_minimal_deps'
+KARMA_BUNDLE = 'karma_bundle'
+KARMA_COVERAGE_CACHE = 'karma_coverage_cache'
+
+# the default port of karma.
+KARMA_PORT = 9876
+
+KARMA_BUNDLE_NAME = 'karma_test_bundle.js'
+KARMA_BUNDLE_BUILD_NAME = 'karma_test_bundle.build.js'
+KARMA_BUNDLE_CACHE_NAME = 'calmjs.rjs.dev:bundle'
+
+# the durations in seconds assumed for a test module without a recorded
+# duration where no other durations are known, and for the loading of
+# every module that is not already loaded by a shard.
+DEFAULT_TEST_DURATION = 1.0
+MODULE_LOAD_DURATION = 0.005
+
 
 TEST_SCRIPT_TEMPLATE = """
 var deps = %s;
@@ -67,15 +115,476 @@ def rjs_advice(spec, extras=None):
     spec.advise(BEFORE_KARMA, karma_requirejs, spec)
 
 
-def process_artifacts(paths):
+def process_artifacts(paths, cache=None, processes=None, cycles=None):
     """
     If they are provided, assuming the defined modules there will not be
     listed as a deps for loading.
+
+    The define manifest written alongside an artifact will be used in
+    place of processing the artifact, if it is still valid for it.  The
+    circular requirements found are appended to the cycles list, if
+    provided.
+    """
+
+    return order_defines(process_artifacts_defines(
+        paths, cache=cache, processes=processes), cycles=cycles)
+
+
+def process_artifacts_defines(paths, cache=None, processes=None):
+    """
+    Return the mapping of the modules defined in the artifacts to the
+    modules they require, as used by the above function.
     """
 
     # TODO figure out how to have a flag to disable this feature for use
     # cases where this is undesirable (e.g. performance reasons).
-    return extract_defines_with_deps_from_paths(paths)
+    paths = list(paths)
+    records = {path: read_define_manifest(path) for path in paths}
+    unlisted = [path for path in paths if records[path] is None]
+    if unlisted:
+        logger.debug(
+            "processing %d of %d artifacts without a valid define manifest",
+            len(unlisted), len(paths))
+        records.update(iter_paths_defines_records(
+            unlisted, cache=cache, processes=processes))
+
+    defines = {}
+    for path in paths:
+        if records[path]:
+            update_defines(defines, records[path], path)
+    return defines
+
+
+def get_module_paths(spec):
+    """
+    Return the mapping of module names to the paths of the transpiled
+    and bundled modules in the build directory, along with the test
+    modules.
+    """
+
+    build_dir = spec[BUILD_DIR]
+    result = {}
+    for prefix in ('transpiled', 'bundled'):
+        modpaths = spec.get(prefix + '_modpaths', {})
+        for modname, target in spec.get(prefix + '_targetpaths', {}).items():
+            if modpaths.get(modname) == EMPTY or target == EMPTY:
+                continue
+            path = join(build_dir, *target.split('/'))
+            if isfile(path):
+                result[modname] = path
+    result.update(spec.get(TEST_MODULE_PATHS_MAP, {}))
+    return result
+
+
+def get_module_imports(module_paths, cache=None):
+    """
+    Return the mapping of module names to the list of module names that
+    they import, for the provided mapping of module names to paths.
+    """
+
+    return {
+        modname: process_path(path, extract_imports, cache=cache) or []
+        for modname, path in module_paths.items()
+    }
+
+
+def load_test_durations(path):
+    """
+    Load the recorded durations from a JSON file that maps the names of
+    the test modules to the number of seconds they took to run.
+    """
+
+    if not path:
+        return {}
+    try:
+        with open(path) as fd:
+            durations = json.load(fd)
+    except (OSError, IOError, ValueError) as e:
+        logger.warning(
+            "failed to load test durations from '%s': %s: %s",
+            path, type(e).__name__, e)
+        return {}
+    if not isinstance(durations, dict):
+        logger.warning(
+            "test durations in '%s' is not a mapping; ignoring", path)
+        return {}
+    return durations
+
+
+def partition_tests(tests, shards, durations=None, imports=None):
+    """
+    Partition the tests into at most the number of shards, such that
+    the shards will take a similar amount of time to run.
+
+    The tests are assigned to the shards in the order of their recorded
+    durations, longest first, with each test assigned to the shard where
+    it will finish the earliest, accounting for the modules imported by
+    the test (transitively, through the imports mapping) that have yet
+    to be loaded by that shard.  Tests without a recorded duration are
+    assumed to take the average of the known durations.
+    """
+
+    durations = durations or {}
+    imports = imports or {}
+    known = [durations[test] for test in tests if test in durations]
+    default = sum(known) / len(known) if known else DEFAULT_TEST_DURATION
+    costs = {test: durations.get(test, default) for test in tests}
+
+    count = max(1, min(shards, len(tests)))
+    loads = [0.0] * count
+    loaded = [set() for _ in range(count)]
+    result = [[] for _ in range(count)]
+
+    for test in sorted(tests, key=lambda test: (-costs[test], test)):
+        closure = transitive_closure(imports, [test])
+
+        def finish(idx):
+            return loads[idx] + costs[test] + MODULE_LOAD_DURATION * len(
+                closure - loaded[idx])
+
+        idx = min(range(count), key=lambda idx: (finish(idx), idx))
+        loads[idx] = finish(idx)
+        loaded[idx].update(closure)
+        result[idx].append(test)
+
+    order = {test: idx for idx, test in enumerate(tests)}
+    return [
+        sorted(shard, key=order.get) for shard in result if shard]
+
+
+def minimal_deps(tests, graph, modnames):
+    """
+    Return the module names amongst modnames that the tests require,
+    directly or transitively through the graph, ordered such that every
+    module will come after the modules that it requires.
+    """
+
+    closure = transitive_closure(graph, tests)
+    order, cycles = sort_defines({
+        modname: [dep for dep in graph.get(modname, ()) if dep in closure]
+        for modname in sorted(closure)
+    })
+    tests = set(tests)
+    return [
+        modname for modname in order
+        if modname in modnames and modname not in tests
+    ]
+
+
+def write_if_changed(path, text):
+    """
+    Atomically write the text to path, unless the file already has the
+    identical text such that it remains untouched for any watchers of
+    it, e.g. a karma server.  Returns True if the file was written.
+    """
+
+    try:
+        with codecs.open(path, encoding='utf-8') as fd:
+            if fd.read() == text:
+                return False
+    except (OSError, IOError, ValueError):
+        pass
+    write_text(path, text)
+    return True
+
+
+def write_karma_shards(spec, config, tests, imports, get_deps):
+    """
+    Write out the test script and the karma configuration file for each
+    of the shards the tests are partitioned into, such that they may be
+    executed by separate karma processes, as done by the RJSKarmaDriver.
+    The get_deps function returns the dependencies to be preloaded for
+    the tests of a shard.  Returns the list of paths to the
+    configuration files.
+    """
+
+    from calmjs.dev.karma import KARMA_CONF_TEMPLATE
+
+    build_dir = spec[BUILD_DIR]
+    shards = partition_tests(
+        tests, spec[KARMA_SHARDS],
+        load_test_durations(spec.get(KARMA_TEST_DURATIONS)), imports)
+
+    test_script_path = spec['karma_requirejs_test_script']
+    config_paths = []
+    for idx, shard_tests in enumerate(shards):
+        shard_script_path = join(build_dir, 'karma_test_init.%d.js' % idx)
+        write_if_changed(shard_script_path, TEST_SCRIPT_TEMPLATE % (
+            json_dumps(get_deps(shard_tests)), json_dumps(shard_tests)))
+
+        shard_config = dict(config)
+        # every concurrent karma process needs its own port.
+        shard_config['port'] = config.get('port', KARMA_PORT) + idx
+        # the artifacts are prepended as done for the main configuration.
+        shard_config['files'] = list(spec.get(ARTIFACT_PATHS) or []) + [
+            shard_script_path if f == test_script_path else f
+            for f in config['files']
+        ]
+        config_path = join(build_dir, 'karma.conf.%d.js' % idx)
+        write_if_changed(
+            config_path, KARMA_CONF_TEMPLATE % json_dumps(shard_config))
+        config_paths.append(config_path)
+        logger.debug(
+            "karma shard %d with %d test module(s) written to '%s'",
+            idx, len(shard_tests), config_path)
+
+    logger.info(
+        "wrote %d karma shard configuration(s) to '%s'",
+        len(config_paths), build_dir)
+    return config_paths
+
+
+def get_source_modules(spec):
+    """
+    Return the mapping of the real paths of the source files to the
+    names of the modules they provide, for all the modules in the spec.
+    """
+
+    result = {}
+    for key in (
+            'transpile_sourcepath', 'bundle_sourcepath',
+            TEST_MODULE_PATHS_MAP):
+        for modname, source in spec.get(key, {}).items():
+            if source == EMPTY or not isfile(source):
+                continue
+            result.setdefault(realpath(source), []).append(modname)
+    return result
+
+
+def get_sources_state_key(spec):
+    return hash_key(
+        'calmjs.rjs.dev:sources', sorted(spec.get(TEST_MODULE_PATHS_MAP, {})))
+
+
+def find_changed_files(spec, sources):
+    """
+    Return the list of the real paths of the files that are considered
+    to be changed, either as provided explicitly in the spec, or from
+    the files amongst the sources that have changed since the previous
+    successful test run as recorded in the cache directory.  None is
+    returned if that cannot be determined.
+    """
+
+    changed_files = spec.get(KARMA_CHANGED_FILES)
+    if changed_files is not None:
+        return [realpath(path) for path in changed_files]
+
+    if not spec.get(CACHE_DIR):
+        logger.warning(
+            "no cache directory specified; unable to determine the source "
+            "files changed since the previous test run")
+        return None
+
+    previous = StateCache(spec[CACHE_DIR]).get(get_sources_state_key(spec))
+    if not isinstance(previous, dict):
+        logger.info("no record of a previous successful test run found")
+        return None
+    return sorted(
+        path for path in sources
+        if previous.get(path) != stat_fingerprint(path))
+
+
+def select_tests(tests, imports, modnames):
+    """
+    Return the tests that import any of the module names, directly or
+    transitively through the imports mapping.
+    """
+
+    modnames = set(modnames)
+    return [
+        test for test in tests
+        if transitive_closure(imports, [test]) & modnames
+    ]
+
+
+def record_sources(spec, fingerprints):
+    """
+    Record the fingerprints of the source files into the cache directory
+    if the karma run was successful.
+    """
+
+    from calmjs.dev.karma import KARMA_RETURN_CODE
+
+    if spec.get(KARMA_RETURN_CODE) != 0 or not spec.get(CACHE_DIR):
+        return
+    StateCache(spec[CACHE_DIR]).set(get_sources_state_key(spec), fingerprints)
+
+
+def karma_select_changed_tests(spec, tests, imports):
+    """
+    Return the tests affected by the changed source files, and have the
+    fingerprints of the sources recorded after a successful test run.
+    All the tests are returned if the changed files cannot be found.
+    """
+
+    sources = get_source_modules(spec)
+    if spec.get(CACHE_DIR):
+        spec.advise(AFTER_KARMA, record_sources, spec, {
+            path: stat_fingerprint(path) for path in sources})
+
+    changed_files = find_changed_files(spec, sources)
+    if changed_files is None:
+        logger.info("running all %d test module(s)", len(tests))
+        return tests
+
+    modnames = []
+    for path in changed_files:
+        if path not in sources:
+            logger.debug(
+                "changed file '%s' does not provide any module", path)
+        modnames.extend(sources.get(path, ()))
+    selected = select_tests(tests, imports, modnames)
+    logger.info(
+        "selected %d of %d test module(s) affected by %d changed file(s)",
+        len(selected), len(tests), len(changed_files))
+    return selected
+
+
+def read_build_manifest(path):
+    """
+    Read the build configuration written by RJSToolchain.assemble.
+    """
+
+    with open(path) as fd:
+        text = fd.read().strip()
+    # the JSON is wrapped in parentheses for r.js.
+    return json.loads(text[1:-1])
+
+
+def get_karma_bundle_paths(spec, modnames):
+    """
+    Return the mapping of the module names amongst modnames that can be
+    linked into the bundle for the test runner to their paths, i.e. the
+    modules in the build directory and the test modules.
+    """
+
+    return {
+        modname: path for modname, path in get_module_paths(spec).items()
+        if modname in modnames and '!' not in modname and
+        path.endswith('.js')
+    }
+
+
+def build_karma_bundle(spec, modnames):
+    """
+    Link the modules amongst modnames that are in the build directory or
+    are test modules, along with what they require, into a single bundle
+    using r.js with the build configuration produced by the toolchain.
+    Returns the path to the bundle, or None if it cannot be built.
+
+    If a cache directory is provided through the spec, the bundle is
+    kept in the result cache there (subject to its size limit) and
+    reused for as long as the build configuration (other than the build
+    directory) and the content of the linked modules are unchanged.
+    """
+
+    rjs_bin = spec.get(TOOLCHAIN_BIN_PATH)
+    if not rjs_bin or not spec.get('build_manifest_path'):
+        logger.warning(
+            "r.js binary or build manifest not available in spec; unable to "
+            "build bundle for the test runner")
+        return None
+
+    build_dir = spec[BUILD_DIR]
+    test_module_paths_map = spec.get(TEST_MODULE_PATHS_MAP, {})
+    module_paths = get_karma_bundle_paths(spec, modnames)
+    include = [modname for modname in modnames if modname in module_paths]
+    if not include:
+        return None
+
+    config = read_build_manifest(spec['build_manifest_path'])
+    config['include'] = include
+    config.pop('out', None)
+    config.pop('baseUrl', None)
+    for modname in include:
+        # the test modules reside outside of the build directory.
+        if modname in test_module_paths_map:
+            config['paths'][modname] = module_paths[modname][:-3]
+    for modname in modnames:
+        # the modules provided elsewhere, such as by the artifacts.
+        if modname not in module_paths:
+            config['paths'].setdefault(modname, EMPTY)
+
+    # the build directory is typically a new temporary directory for
+    # every run, so it must not be part of the key.
+    key = hash_key(config, {
+        modname: digest_path(path)
+        for modname, path in get_module_paths(spec).items()})
+    target = join(build_dir, KARMA_BUNDLE_NAME)
+    cache = get_result_cache(spec)
+    cached = cache and cache.get_file(KARMA_BUNDLE_CACHE_NAME, key)
+    if cached:
+        try:
+            store_file(cached, target)
+        except (OSError, IOError) as e:
+            logger.warning(
+                "failed to reuse test bundle '%s': %s", cached, e)
+        else:
+            logger.info("reusing test bundle '%s'", cached)
+            return target
+
+    config['baseUrl'] = build_dir
+    config['out'] = target
+    build_config_path = join(build_dir, KARMA_BUNDLE_BUILD_NAME)
+    with open(build_config_path, 'w') as fd:
+        fd.write('(\n')
+        json.dump(config, fd, indent=4)
+        fd.write('\n)')
+
+    args = (rjs_bin, '-o', build_config_path)
+    logger.info('invoking %s %s %s', *args)
+    rc = call(args)
+    if rc != 0:
+        logger.warning(
+            "r.js exited with return code %s; the test modules will be "
+            "loaded without the bundle", rc)
+        return None
+
+    if cache:
+        cache.set_file(KARMA_BUNDLE_CACHE_NAME, key, target)
+    return target
+
+
+def apply_coverage_cache(spec, config, test_conf):
+    """
+    Instrument the covered modules in the build directory through the
+    instrumenter with the outputs kept in the result cache, and have the
+    test runner make use of those outputs in place of the coverage
+    preprocessor.  The requirejs test configuration is updated to load
+    the modules from the instrumented outputs, and the list of their
+    paths is returned such that they may be served.
+    """
+
+    cache = get_result_cache(spec)
+    if cache is None:
+        logger.warning(
+            "no cache directory specified; the modules will be instrumented "
+            "by the karma coverage preprocessor")
+        return []
+
+    build_dir = spec[BUILD_DIR]
+    preprocessors = config.get('preprocessors', {})
+    covered = {}
+    for key in ('transpiled_targetpaths', 'bundled_targetpaths'):
+        for modname, target in spec.get(key, {}).items():
+            if target.endswith('.js') and 'coverage' in preprocessors.get(
+                    target, ()):
+                covered[modname] = target
+
+    instrumented = instrument_paths(
+        [join(build_dir, target) for target in covered.values()],
+        cache, build_dir, working_dir=spec.get(WORKING_DIR))
+    paths = []
+    for modname, target in sorted(covered.items()):
+        path = instrumented.get(join(build_dir, target))
+        if path is None:
+            continue
+        preprocessors[target].remove('coverage')
+        if not preprocessors[target]:
+            preprocessors.pop(target)
+        test_conf['paths'][modname] = path[:-3]
+        paths.append(path)
+    return paths
 
 
 def karma_requirejs(spec):
@@ -127,6 +636,10 @@ def karma_requirejs(spec):
     test_conf = plugin_registry.modname_targetpath_mapping_to_config_paths(
         test_module_paths_map)
 
+    coverage_paths = []
+    if spec.get(KARMA_COVERAGE_CACHE) and spec.get(COVERAGE_ENABLE):
+        coverage_paths = apply_coverage_cache(spec, config, test_conf)
+
     # Ensure '/absolute' is prefixed like so to eliminate spurious error
     # messages in the test runner, simply because the requirejs plugin
     # will try to go through this mechanism to find a timestamp and fail
@@ -140,21 +653,31 @@ def karma_requirejs(spec):
         for k, v in test_conf['paths'].items()
     }
 
+    # the paths for usage outside of the test browser.
+    spec['karma_requirejs_test_paths'] = test_conf['paths']
     test_conf['paths'] = new_paths
     test_config_path = spec['karma_requirejs_test_config'] = join(
         build_dir, 'requirejs_test_config.js')
-    with open(test_config_path, 'w') as fd:
-        fd.write(UMD_REQUIREJS_JSON_EXPORT_HEADER)
-        json_dump(test_conf, fd)
-        fd.write(UMD_REQUIREJS_JSON_EXPORT_FOOTER)
+    # only written when changed, such that a karma server watching the
+    # files will not reload for a module set that remained the same.
+    write_if_changed(test_config_path, UMD_REQUIREJS_JSON_EXPORT_HEADER + (
+        json_dumps(test_conf)) + UMD_REQUIREJS_JSON_EXPORT_FOOTER)
 
     # Export all the module dependencies first so they get pre-loaded
     # and thus be able to be loaded synchronously by test modules.
     deps = sorted(spec.get('export_module_names', []))
 
+    artifact_defines = {}
     if spec.get(ARTIFACT_PATHS):
         # TODO have a flag of some sort for flagging this as optional.
-        deps.extend(process_artifacts(spec.get(ARTIFACT_PATHS)))
+        artifact_defines = process_artifacts_defines(
+            spec.get(ARTIFACT_PATHS), cache=get_result_cache(spec),
+            processes=spec.get(PROCESSES),
+        )
+        # the circular requirements between the modules in the
+        # artifacts are kept for the consumers of the spec.
+        cycles = spec['karma_requirejs_artifact_cycles'] = []
+        deps.extend(order_defines(artifact_defines, cycles=cycles))
 
     test_prefix = spec.get(TEST_FILENAME_PREFIX, TEST_FILENAME_PREFIX_DEFAULT)
     tests = []
@@ -166,10 +689,61 @@ def karma_requirejs(spec):
         else:
             deps.append(k)
 
+    select_changed = bool(spec.get(KARMA_SELECT_CHANGED) or (
+        spec.get(KARMA_CHANGED_FILES) is not None))
+    imports = None
+    if select_changed or spec.get(KARMA_MINIMAL_DEPS) or (
+            spec.get(KARMA_SHARDS) or 0) > 1:
+        imports = get_module_imports(
+            get_module_paths(spec), cache=get_result_cache(spec))
+
+    if select_changed:
+        tests = karma_select_changed_tests(spec, tests, imports)
+        if not tests:
+            # karma fails on empty test suites by default.
+            config['failOnEmptyTestSuite'] = False
+
+    if spec.get(KARMA_MINIMAL_DEPS):
+        # only preload what the tests require, with the requirements of
+        # the modules in the artifacts also followed.
+        graph = dict(artifact_defines)
+        graph.update(imports)
+        modnames = set(deps)
+
+        def get_deps(tests):
+            return minimal_deps(tests, graph, modnames)
+
+        all_deps = deps
+        deps = get_deps(tests)
+        logger.info(
+            "preloading %d of %d modules required by the test modules",
+            len(deps), len(all_deps))
+    else:
+        def get_deps(tests):
+            return deps
+
+    bundle_path = None
+    if spec.get(KARMA_BUNDLE):
+        # the test modules are linked in also, such that only the test
+        # script remains to be loaded outside of the bundle.
+        bundle_path = spec['karma_requirejs_test_bundle'] = (
+            build_karma_bundle(spec, deps + tests))
+    if bundle_path:
+        # the modules linked into the bundle need not be served, unless
+        # they are to be preprocessed (e.g. for coverage).
+        bundled = set(get_karma_bundle_paths(spec, deps + tests).values())
+        preprocessors = config.get('preprocessors', {})
+        config_files = [
+            f for f in config_files
+            if f not in bundled or f in preprocessors
+        ]
+
+    spec['karma_requirejs_test_deps'] = deps
+    spec['karma_requirejs_tests'] = tests
     test_script_path = spec['karma_requirejs_test_script'] = join(
         build_dir, 'karma_test_init.js')
-    with open(test_script_path, 'w') as fd:
-        fd.write(TEST_SCRIPT_TEMPLATE % (json_dumps(deps), json_dumps(tests)))
+    write_if_changed(test_script_path, TEST_SCRIPT_TEMPLATE % (
+        json_dumps(deps), json_dumps(tests)))
 
     frameworks = ['requirejs']
     frameworks.extend(config['frameworks'])
@@ -181,10 +755,19 @@ def karma_requirejs(spec):
     files.extend(spec.get(CONFIG_JS_FILES, []))
     # then append the test configuration path
     files.append(test_config_path)
+    # then the bundle that defines the dependencies, if built
+    if bundle_path:
+        files.append(bundle_path)
     # then the script
     files.append(test_script_path)
     # then extend the configured paths but do not auto-include them.
     files.extend({'pattern': f, 'included': False} for f in config_files)
+    # along with the instrumented modules that replace the ones above.
+    files.extend({'pattern': f, 'included': False} for f in coverage_paths)
     # update the file listing with modifications; this will be written
     # out as part of karma.conf.js by the KarmaRuntime.
     config['files'] = files
+
+    if (spec.get(KARMA_SHARDS) or 0) > 1:
+        spec['karma_requirejs_test_shards'] = write_karma_shards(
+            spec, config, tests, imports, get_deps)
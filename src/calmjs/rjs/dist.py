@@ -5,10 +5,15 @@ Module that links to the calmjs.dist, for use with RJSToolchain.
 
 import logging
 
+from collections import OrderedDict
 from os import getcwd
+from os import listdir
+from os.path import dirname
 from os.path import join
 from os.path import isdir
 
+from calmjs import dist as calmjs_dist
+from calmjs.base import BaseModuleRegistry
 from calmjs.registry import get
 from calmjs.dist import get_extras_calmjs
 from calmjs.dist import get_module_registry_dependencies
@@ -17,6 +22,11 @@ from calmjs.dist import flatten_extras_calmjs
 from calmjs.dist import flatten_module_registry_dependencies
 from calmjs.dist import flatten_module_registry_names
 
+from calmjs.rjs.cache import RESULT_CACHE_NAME
+from calmjs.rjs.cache import ResultCache
+from calmjs.rjs.cache import hash_key
+from calmjs.rjs.cache import stat_fingerprint
+
 logger = logging.getLogger(__name__)
 EMPTY = 'empty:'
 _default = 'all'
@@ -74,7 +84,208 @@ def acquire_method(methods, key, default=_default):
     return methods.get(key, methods.get(default))
 
 
-def get_calmjs_module_registry_for(package_names, method=_default):
+def get_dist_fingerprint(dist):
+    """
+    Return the fingerprint of the distribution, derived from its name,
+    version, location and the stat of the files of its metadata.
+    """
+
+    metadata = getattr(dist, 'egg_info', None) or dist.location
+    files = {}
+    if metadata and isdir(metadata):
+        for name in sorted(listdir(metadata)):
+            files[name] = stat_fingerprint(join(metadata, name))
+    elif metadata:
+        files[metadata] = stat_fingerprint(metadata)
+    return [dist.project_name, dist.version, dist.location, files]
+
+
+def get_paths_fingerprint(*sourcepaths):
+    """
+    Return the fingerprints of the directories containing the paths in
+    the sourcepath mappings, such that added or removed sources will
+    be noticed.
+    """
+
+    return {
+        path: stat_fingerprint(path)
+        for path in sorted(set(
+            dirname(value)
+            for sourcepath in sourcepaths
+            for value in sourcepath.values()
+            if value != EMPTY
+        ))
+    }
+
+
+def get_working_set_fingerprint(working_set=None):
+    """
+    Return a digest of the entries of the working set and the metadata
+    of every distribution within it, such that the installation, removal
+    or update of any distribution will produce a different digest.
+    """
+
+    working_set = working_set or calmjs_dist.default_working_set
+    return hash_key(
+        [[entry, stat_fingerprint(entry)] for entry in working_set.entries],
+        [get_dist_fingerprint(dist) for dist in working_set],
+    )
+
+
+def dump_ordered(value):
+    """
+    Return the value with every mapping within it encoded as a list of
+    its items, as the serialization of mappings by the cache does not
+    preserve their order.
+    """
+
+    if isinstance(value, dict):
+        return {'items': [[k, dump_ordered(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [dump_ordered(v) for v in value]
+    return value
+
+
+def load_ordered(value):
+    """
+    Return the value encoded by dump_ordered, with its mappings restored
+    in their original order.
+    """
+
+    if isinstance(value, dict):
+        return OrderedDict((k, load_ordered(v)) for k, v in value['items'])
+    if isinstance(value, list):
+        return [load_ordered(v) for v in value]
+    return value
+
+
+class DistCache(object):
+    """
+    Persistent memoization of the calmjs.dist functions used for the
+    resolution of the registries and sourcepaths, through a ResultCache.
+
+    The results are addressed by the function, the package names, the
+    registry name and the fingerprint of the working set, which is only
+    computed once for every instance.  As the module registries record
+    the source files found on disk, the results that map module names
+    to paths are further validated against the directories of those
+    paths, such that added or removed sources will be noticed.
+    """
+
+    def __init__(self, cache, working_set=None):
+        self.cache = cache
+        self.working_set = working_set
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = get_working_set_fingerprint(self.working_set)
+        return self._fingerprint
+
+    def call(self, f, package_names, **kw):
+        """
+        Return the result of f for the package_names and the keyword
+        arguments, making use of the stored result if available.  The
+        keyword arguments specify the registries, which imply that the
+        result maps module names to paths.
+        """
+
+        name = '%s.%s' % (getattr(f, '__module__', None), f.__name__)
+        key = [list(package_names), kw, self.fingerprint]
+        cached = self.cache.get(name, key)
+        if isinstance(cached, dict) and 'ordered' in cached:
+            # the order of the mappings determines the order of the
+            # modules within the build configuration.
+            value = load_ordered(cached['ordered'])
+            if not kw or get_paths_fingerprint(value) == cached.get('paths'):
+                logger.debug(
+                    "reusing cached result of '%s' for %r",
+                    name, package_names)
+                return value
+
+        value = f(package_names, **kw)
+        self.cache.set(name, key, {
+            'ordered': dump_ordered(value),
+            'paths': get_paths_fingerprint(value) if kw else None,
+        })
+        return value
+
+
+def get_dist_cache(cache_dir):
+    """
+    Return the DistCache for the cache directory, or None if it was not
+    specified.
+    """
+
+    if not cache_dir:
+        return None
+    return DistCache(ResultCache(join(cache_dir, RESULT_CACHE_NAME)))
+
+
+def call_dist(cache, f, package_names, **kw):
+    """
+    Call f for the package_names through the cache, if provided.
+    """
+
+    if cache is not None:
+        return cache.call(f, package_names, **kw)
+    return f(package_names, **kw)
+
+
+def get_tagged_module_registry_dependencies(
+        package_names, registries, working_set=None):
+    """
+    Walk the dependency graph for the package_names once, and return
+    the records from all the registries as a mapping of module names to
+    a tuple of its path and whether it was explicitly declared by the
+    specified packages, as opposed to inherited from their dependencies.
+    Where both are the case, the explicit declaration takes precedence.
+    """
+
+    dists = calmjs_dist.find_packages_requirements_dists(
+        package_names, working_set=working_set)
+    inherited = {}
+    explicit = {}
+    for registry_name in registries:
+        registry = get(registry_name)
+        if not isinstance(registry, BaseModuleRegistry):
+            continue
+        for dist in dists:
+            inherited.update(
+                registry.get_records_for_package(dist.project_name))
+        for package_name in package_names:
+            explicit.update(registry.get_records_for_package(package_name))
+
+    results = {k: (v, False) for k, v in inherited.items()}
+    results.update((k, (v, True)) for k, v in explicit.items())
+    return results
+
+
+def explicit_module_registry_dependencies(
+        package_names, registries=(), working_set=None):
+    """
+    Produce the source map for the 'explicit' method in a single pass
+    across all the registries; the sources for the modules inherited
+    from the dependencies are stubbed out using 'empty:'.
+    """
+
+    return {
+        k: path if explicit else EMPTY
+        for k, (path, explicit) in get_tagged_module_registry_dependencies(
+            package_names, registries, working_set=working_set).items()
+    }
+
+
+# the methods that resolve the source map across all the registries at
+# once, in place of the functions in sourcepath_methods_list.
+sourcepath_resolvers = {
+    'explicit': explicit_module_registry_dependencies,
+}
+
+
+def get_calmjs_module_registry_for(
+        package_names, method=_default, cache=None):
     """
     Acquire the module registries required for the package_names.
 
@@ -96,15 +307,18 @@ def get_calmjs_module_registry_for(package_names, method=_default):
             Produce an empty source map.
 
         All options not on above list defaults to 'all'
+    cache
+        An optional DistCache for the results.
     """
 
-    registries = acquire_method(
-        calmjs_module_registry_methods, method)(package_names)
+    registries = call_dist(cache, acquire_method(
+        calmjs_module_registry_methods, method), package_names)
     return registries
 
 
 def generate_transpile_sourcepaths(
-        package_names, registries=('calmjs.modules'), method=_default):
+        package_names, registries=('calmjs.modules'), method=_default,
+        cache=None):
     """
     Invoke the module_registry_dependencies family of dist functions,
     with the specified registries, to produce the required source maps.
@@ -132,8 +346,15 @@ def generate_transpile_sourcepaths(
             Produce an empty source map.
 
         Defaults to 'all'.
+    cache
+        An optional DistCache for the results.
     """
 
+    resolver = sourcepath_resolvers.get(method)
+    if resolver is not None:
+        return call_dist(
+            cache, resolver, package_names, registries=list(registries))
+
     sourcepath_methods = acquire_method(sourcepath_methods_list, method)
     transpile_sourcepath = {}
 
@@ -147,8 +368,9 @@ def generate_transpile_sourcepaths(
     for source_f, n_filter in sourcepath_methods:
         for registry_name in registries:
             transpile_sourcepath.update(
-                (k, n_filter(v)) for k, v in source_f(
-                    package_names, registry_name=registry_name
+                (k, n_filter(v)) for k, v in call_dist(
+                    cache, source_f, package_names,
+                    registry_name=registry_name,
                 ).items()
             )
 
@@ -156,7 +378,7 @@ def generate_transpile_sourcepaths(
 
 
 def generate_bundle_sourcepaths(
-        package_names, working_dir=None, method=_default):
+        package_names, working_dir=None, method=_default, cache=None):
     """
     Acquire the bundle source maps through the calmjs registry system.
 
@@ -190,6 +412,8 @@ def generate_bundle_sourcepaths(
             under the appropriate keys.
 
         Defaults to 'all'.
+    cache
+        An optional DistCache for the results.
     """
 
     working_dir = working_dir if working_dir else getcwd()
@@ -200,7 +424,7 @@ def generate_bundle_sourcepaths(
     # the extras keys will be treated as valid Node.js package manager
     # subdirectories.
     valid_pkgmgr_dirs = set(get('calmjs.extras_keys').iter_records())
-    extras_calmjs = acquire_extras_calmjs(package_names)
+    extras_calmjs = call_dist(cache, acquire_extras_calmjs, package_names)
     bundle_sourcepath = {}
 
     for mgr in extras_calmjs:
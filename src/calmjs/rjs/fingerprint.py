@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Content fingerprinting of the modules that get compiled into a build.
+
+It is entirely possible for a package to provide a copy of some library
+through its ``transpile_sourcepath`` while the very same library is
+also made available under a different name through ``extras_calmjs``
+from ``node_modules``.  As requirejs only knows about module names, both
+copies will end up in the artifact, so the helpers here can be used to
+find these modules by the normalized content of their source files.
+
+Note that aliasing a duplicate module to its canonical module changes
+the identity of the module, as both names will then refer to the same
+instance; modules that keep state will share that state.  Modules that
+require other modules through relative names are only considered to be
+duplicates if those names resolve to the same modules.
+"""
+
+import hashlib
+import logging
+import posixpath
+from os.path import isfile
+
+from calmjs.rjs.dist import EMPTY
+from calmjs.rjs.requirejs import extract_imports
+
+logger = logging.getLogger(__name__)
+
+# the sourcepath keys, in the order of preference for the selection of
+# the canonical module amongst a group of duplicates.
+SOURCEPATH_KEYS = ('transpile_sourcepath', 'bundle_sourcepath')
+
+
+def normalize_js(text):
+    """
+    Normalize the provided JavaScript source text such that differences
+    in line endings, indentation, blank lines and full line comments
+    are ignored.
+    """
+
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(
+        line for line in lines if line and not line.startswith('//'))
+
+
+def fingerprint_text(text):
+    return hashlib.sha256(normalize_js(text).encode('utf-8')).hexdigest()
+
+
+def _read_text(path):
+    try:
+        with open(path, 'rb') as fd:
+            return fd.read().decode('utf-8', 'replace')
+    except (OSError, IOError) as e:
+        logger.debug(
+            "failed to fingerprint '%s': %s: %s", path, type(e).__name__, e)
+        return None
+
+
+def fingerprint_path(path):
+    """
+    Return the fingerprint for the file at path, or None if it cannot
+    be read.
+    """
+
+    text = _read_text(path)
+    return None if text is None else fingerprint_text(text)
+
+
+def resolve_relative_import(modname, name):
+    """
+    Resolve the imported name, which may be relative to the module, to
+    the absolute module name; the segments of loader plugin names are
+    resolved individually.
+    """
+
+    return '!'.join(
+        posixpath.normpath(posixpath.join(posixpath.dirname(modname), part))
+        if part.startswith('./') or part.startswith('../') else part
+        for part in name.split('!')
+    )
+
+
+def get_relative_imports(modname, text):
+    """
+    Return the sorted list of the relative imports of the module, as
+    resolved against its name, or None if it cannot be determined.
+    """
+
+    try:
+        imports = extract_imports(text)
+    except Exception as e:
+        logger.debug(
+            "failed to extract the imports for '%s': %s: %s",
+            modname, type(e).__name__, e)
+        return None
+    return sorted(
+        resolve_relative_import(modname, name)
+        for name in imports if './' in name
+    )
+
+
+def find_duplicate_modules(spec, keys=SOURCEPATH_KEYS):
+    """
+    Fingerprint all the source files referenced by the sourcepath keys
+    in the spec, and return a mapping from the name of every module that
+    was found to be a duplicate to the name of its canonical module.
+
+    Modules with relative imports are only grouped with the modules
+    where those imports resolve to the same modules, and modules where
+    the imports cannot be determined are never considered duplicates.
+
+    Modules from the earlier keys are preferred as the canonical module,
+    followed by the ordering of the module names.
+    """
+
+    groups = {}
+    for key in keys:
+        for modname, source in sorted(spec.get(key, {}).items()):
+            if source == EMPTY or not isfile(source):
+                continue
+            text = _read_text(source)
+            if text is None:
+                continue
+            relative = get_relative_imports(modname, text)
+            if relative is None:
+                continue
+            groups.setdefault(
+                (fingerprint_text(text), tuple(relative)), []).append(modname)
+
+    result = {}
+    for modnames in groups.values():
+        canonical = modnames[0]
+        for modname in modnames[1:]:
+            if modname != canonical:
+                result[modname] = canonical
+    return result
+
+
+def log_duplicate_modules(duplicates, log=logger.warning):
+    canonicals = {}
+    for modname, canonical in duplicates.items():
+        canonicals.setdefault(canonical, []).append(modname)
+    for canonical, modnames in sorted(canonicals.items()):
+        log(
+            "module '%s' has identical content as module(s) %s; the "
+            "artifact may contain duplicate copies of the same library",
+            canonical, ', '.join(repr(m) for m in sorted(modnames)),
+        )
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Coverage instrumentation of the modules in the build directory, with
+the instrumented outputs kept in the result cache.
+
+The karma coverage preprocessor instruments every covered module again
+for every test run.  As the instrumented output only depends on the
+content of the module, its path (which gets embedded for the coverage
+report), and the version of the instrumenter, the modules are instead
+instrumented here through ``istanbul-lib-instrument`` in a single Node.js
+process, such that the unchanged modules will simply make use of their
+previously instrumented outputs.
+
+As the build directory is typically a new temporary directory for every
+run, the modules are instrumented with their paths relative to a
+placeholder in place of the build directory, and the placeholder is
+replaced with the actual build directory whenever an output is written
+into the build directory, such that the outputs may be reused across
+builds.
+"""
+
+import codecs
+import json
+
+import logging
+import os
+from os.path import exists
+from os.path import join
+from os.path import pathsep
+from os.path import relpath
+from subprocess import CalledProcessError
+from subprocess import STDOUT
+from subprocess import call
+from subprocess import check_output
+
+from calmjs.utils import which
+
+from calmjs.rjs.cache import hash_key
+from calmjs.rjs.cache import write_json
+from calmjs.rjs.cache import write_text
+from calmjs.rjs.manifest import digest_path
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTED_CACHE_NAME = 'instrumented'
+INSTRUMENT_SCRIPT_NAME = 'calmjs_rjs_instrument.js'
+INSTRUMENT_JOBS_NAME = 'calmjs_rjs_instrument.json'
+INSTRUMENT_CACHE_NAME = 'calmjs.rjs.instrument'
+# stands in for the build directory within the paths embedded into the
+# instrumented outputs.
+BUILD_DIR_PLACEHOLDER = '@@calmjs.rjs.build_dir@@'
+
+INSTRUMENT_SCRIPT = """
+var fs = require('fs');
+var instrument = require('istanbul-lib-instrument');
+
+if (process.argv[2] === '--version') {
+    process.stdout.write(
+        require('istanbul-lib-instrument/package.json').version);
+}
+else {
+    var instrumenter = instrument.createInstrumenter();
+    var jobs = JSON.parse(fs.readFileSync(process.argv[2], 'utf8'));
+    jobs.forEach(function(job) {
+        try {
+            var code = fs.readFileSync(job.source, 'utf8');
+            fs.writeFileSync(
+                job.target, instrumenter.instrumentSync(code, job.filename));
+        }
+        catch (e) {
+            console.error('failed to instrument ' + job.source + ': ' + e);
+        }
+    });
+}
+"""
+
+
+def get_node_env(working_dir=None):
+    """
+    Return the environment for Node.js such that the instrumenter will
+    be found in the node_modules of the working directory.
+    """
+
+    env = dict(os.environ)
+    node_modules = join(working_dir or os.getcwd(), 'node_modules')
+    env['NODE_PATH'] = pathsep.join(
+        p for p in (node_modules, env.get('NODE_PATH')) if p)
+    return env
+
+
+def get_instrumenter_version(node_bin, script_path, env=None):
+    try:
+        output = check_output(
+            [node_bin, script_path, '--version'], env=env, stderr=STDOUT)
+    except (OSError, CalledProcessError) as e:
+        logger.debug("failed to query the instrumenter version: %s", e)
+        return None
+    return output.decode('utf-8').strip() or None
+
+
+def materialize_instrumented(source, target, build_dir):
+    """
+    Write the instrumented output at source to target, with the build
+    directory placeholder in the embedded paths replaced by build_dir.
+    """
+
+    with codecs.open(source, encoding='utf-8') as fd:
+        text = fd.read()
+    # the paths are embedded as string literals.
+    write_text(target, text.replace(
+        BUILD_DIR_PLACEHOLDER, json.dumps(build_dir)[1:-1]))
+
+
+def instrument_paths(paths, cache, build_dir, working_dir=None):
+    """
+    Instrument the files at paths within the build directory for
+    coverage, reusing the outputs stored in the ResultCache where
+    available.  Returns a mapping from every path that was instrumented
+    to the path of its instrumented output, written into the build
+    directory.
+    """
+
+    node_bin = which('node')
+    if node_bin is None:
+        logger.warning("node not found; unable to instrument modules")
+        return {}
+
+    script_path = join(build_dir, INSTRUMENT_SCRIPT_NAME)
+    write_text(script_path, INSTRUMENT_SCRIPT)
+    env = get_node_env(working_dir)
+    version = get_instrumenter_version(node_bin, script_path, env=env)
+    if version is None:
+        logger.warning(
+            "istanbul-lib-instrument not available; unable to instrument "
+            "modules")
+        return {}
+
+    instrumented_dir = join(build_dir, INSTRUMENTED_CACHE_NAME)
+    results = {}
+    jobs = []
+    for path in sorted(paths):
+        digest = digest_path(path)
+        if digest is None:
+            continue
+        name = relpath(path, build_dir)
+        key = [version, '/'.join(name.split(os.sep)), digest]
+        target = join(instrumented_dir, name)
+        cached = cache.get_file(INSTRUMENT_CACHE_NAME, key)
+        if cached is None:
+            jobs.append({
+                'source': path,
+                'filename': join(BUILD_DIR_PLACEHOLDER, name),
+                'target': join(
+                    instrumented_dir, hash_key(key) + '.instrumented.js'),
+                'key': key,
+                'output': target,
+            })
+            continue
+        try:
+            materialize_instrumented(cached, target, build_dir)
+        except (OSError, IOError) as e:
+            logger.debug("failed to reuse instrumented '%s': %s", path, e)
+            continue
+        results[path] = target
+
+    reused = len(results)
+    if jobs:
+        if not exists(instrumented_dir):
+            os.makedirs(instrumented_dir)
+        jobs_path = join(build_dir, INSTRUMENT_JOBS_NAME)
+        write_json(jobs_path, [{
+            'source': job['source'],
+            'filename': job['filename'],
+            'target': job['target'],
+        } for job in jobs])
+        rc = call([node_bin, script_path, jobs_path], env=env)
+        if rc != 0:
+            logger.warning("instrumenter exited with return code %s", rc)
+        for job in jobs:
+            try:
+                materialize_instrumented(
+                    job['target'], job['output'], build_dir)
+            except (OSError, IOError) as e:
+                logger.debug(
+                    "failed to instrument '%s': %s", job['source'], e)
+                continue
+            cache.set_file(INSTRUMENT_CACHE_NAME, job['key'], job['target'])
+            results[job['source']] = job['output']
+
+    logger.info(
+        "instrumented %d module(s) for coverage, with %d reused from '%s'",
+        len(results), reused, cache.cache_dir)
+    return results
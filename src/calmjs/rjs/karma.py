@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+Integration with a persistent karma server.
+
+The default karma driver provided by calmjs.dev starts a new karma
+process, which launches the browsers from scratch, for every test run.
+The driver here will instead keep a karma server running against the
+configuration written to the build directory, and have the tests be
+executed through ``karma run`` against that live server, such that the
+browsers already captured by the server will be reused.
+
+As the server continues to serve the files from the build directory, it
+must be explicitly specified; otherwise the build directory would be a
+temporary one that gets removed after every run.  The server will only
+be restarted when the karma configuration itself was changed, which is
+the case when the set of files to be served is no longer the same, as
+the requirejs test configuration and the test script within that set
+are only ever rewritten by the advice when their contents differ and
+will simply be picked up by the server, as ``karma run`` refreshes the
+files before every run.  The server does not watch the files itself, as
+that would trigger another run concurrently with the explicit one.
+
+The options specific to the requirejs integration with karma, i.e. the
+ones that tune how the karma advice sets up the test runner, are
+provided by the karma runtimes here rather than by the runtime for the
+generation of artifacts, as they have no effect on the artifacts.
+
+This module requires calmjs.dev; the runtimes are not provided without
+it.
+"""
+
+import errno
+import logging
+import os
+import re
+import signal
+import socket
+import sys
+import time
+from os.path import exists
+from os.path import getsize
+from os.path import join
+from os.path import pathsep
+from subprocess import CalledProcessError
+from subprocess import PIPE
+from subprocess import Popen
+from subprocess import STDOUT
+from subprocess import check_output
+
+from calmjs.argparse import StorePathSepDelimitedList
+from calmjs.exc import AdviceAbort
+from calmjs.toolchain import ARTIFACT_PATHS
+from calmjs.toolchain import BUILD_DIR
+
+try:
+    from calmjs.dev import karma
+    from calmjs.dev import utils
+    from calmjs.dev.cli import KarmaDriver
+    from calmjs.dev.runtime import KarmaRuntime
+    from calmjs.dev.toolchain import prepare_spec_from_runtime
+except ImportError:  # pragma: no cover
+    # Package not available; the drivers will not be usable and the
+    # runtimes will not be provided.
+    karma = utils = prepare_spec_from_runtime = None
+    KarmaDriver = KarmaRuntime = object
+
+from calmjs.rjs.cache import read_json
+from calmjs.rjs.cache import write_json
+from calmjs.rjs.dev import KARMA_BUNDLE
+from calmjs.rjs.dev import KARMA_CHANGED_FILES
+from calmjs.rjs.dev import KARMA_COVERAGE_CACHE
+from calmjs.rjs.dev import KARMA_MINIMAL_DEPS
+from calmjs.rjs.dev import KARMA_PORT
+from calmjs.rjs.dev import KARMA_SELECT_CHANGED
+from calmjs.rjs.dev import KARMA_SHARDS
+from calmjs.rjs.dev import KARMA_TEST_DURATIONS
+from calmjs.rjs.dev import write_if_changed
+from calmjs.rjs.manifest import digest_path
+
+logger = logging.getLogger(__name__)
+
+# the spec key for flagging the use of the karma server for a spec.
+KARMA_SERVER = 'karma_server'
+
+KARMA_SERVER_STATE = 'karma_server.json'
+KARMA_SERVER_LOG = 'karma_server.log'
+KARMA_SERVER_PORT = KARMA_PORT
+# the duration in seconds to wait for a new server to start listening,
+# or for a stopped server to exit.
+KARMA_SERVER_STARTUP_TIMEOUT = 30
+# the duration in seconds to retry karma run for a browser to be
+# captured by a new server.
+KARMA_SERVER_CAPTURE_TIMEOUT = 60
+KARMA_RUN_RETRY_INTERVAL = 1
+
+# the messages from karma for the port the server is listening on, and
+# for karma run when the server has yet to capture a browser.
+KARMA_SERVER_STARTED_PATTERN = re.compile(
+    r'server started at \S+?:(\d+)/', re.I)
+KARMA_NO_CAPTURED_BROWSER = 'no captured browser'
+
+# the spec keys for the options provided by init_argparser_karma_requirejs
+KARMA_REQUIREJS_SPEC_KEYS = (
+    KARMA_SHARDS,
+    KARMA_TEST_DURATIONS,
+    KARMA_SELECT_CHANGED,
+    KARMA_CHANGED_FILES,
+    KARMA_MINIMAL_DEPS,
+    KARMA_BUNDLE,
+    KARMA_COVERAGE_CACHE,
+)
+
+
+def init_argparser_karma_requirejs(argparser):
+    """
+    Add the options for the karma advice for requirejs to argparser.
+    """
+
+    argparser.add_argument(
+        '--karma-shards', default=None, type=int,
+        dest=KARMA_SHARDS, metavar='N',
+        help='partition the test modules into N shards, each with its '
+             'own test script and karma configuration file written into '
+             'the build directory, to be executed by concurrent karma '
+             'processes through the rjskarma runtime',
+    )
+
+    argparser.add_argument(
+        '--test-durations', default=None,
+        dest=KARMA_TEST_DURATIONS, metavar='PATH',
+        help='a JSON file mapping the names of the test modules to '
+             'their recorded durations in seconds, for balancing the '
+             'karma shards',
+    )
+
+    argparser.add_argument(
+        '--select-changed', default=False,
+        dest=KARMA_SELECT_CHANGED, action='store_true',
+        help='only run the test modules affected by the source files '
+             'changed since the previous successful test run, as '
+             'recorded in the cache directory',
+    )
+
+    argparser.add_argument(
+        '--changed-file', default=None,
+        dest=KARMA_CHANGED_FILES, action=StorePathSepDelimitedList,
+        metavar='<file>[%s<file>...]' % pathsep,
+        help="changed source file(s), such that only the test modules "
+             "affected by them will be run; multiple files may be "
+             "specified using multiple separate flags, or be specified "
+             "under a single flag with each path separated by the "
+             "platform's path separation character '%s'; implies "
+             "--select-changed" % pathsep,
+    )
+
+    argparser.add_argument(
+        '--minimal-deps', default=False,
+        dest=KARMA_MINIMAL_DEPS, action='store_true',
+        help='only preload the modules required by the test modules to '
+             'be run, instead of every exported module',
+    )
+
+    argparser.add_argument(
+        '--karma-bundle', default=False,
+        dest=KARMA_BUNDLE, action='store_true',
+        help='link the modules preloaded for the test runner into a '
+             'single bundle using r.js, instead of having each of them '
+             'requested individually by the test browser',
+    )
+
+    argparser.add_argument(
+        '--coverage-cache', default=False,
+        dest=KARMA_COVERAGE_CACHE, action='store_true',
+        help='for test runs with coverage, instrument the modules '
+             'ahead of the test runner and keep the instrumented '
+             'modules in the cache directory for reuse; requires '
+             '--cache-dir',
+    )
+
+
+def update_spec_for_karma_requirejs(spec, **kwargs):
+    """
+    Assign the values of the options for the karma advice for requirejs
+    in kwargs to the spec, as the toolchain runtimes do not pass them
+    through.
+    """
+
+    for key in KARMA_REQUIREJS_SPEC_KEYS:
+        if kwargs.get(key) is not None:
+            spec[key] = kwargs[key]
+
+
+def is_process_alive(pid):
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_process_identity(pid):
+    """
+    Return a string that identifies the process with the pid through its
+    start time and command line, such that another process that reused
+    the pid will not be mistaken for it, or None if not available.
+    """
+
+    try:
+        with open('/proc/%d/stat' % pid) as fd:
+            stat = fd.read()
+        with open('/proc/%d/cmdline' % pid, 'rb') as fd:
+            cmdline = fd.read().decode('utf-8', 'replace')
+    except (OSError, IOError):
+        pass
+    else:
+        # the start time is the 22nd field, counting from the ones
+        # before the command name which may contain spaces.
+        return '%s %s' % (
+            stat.rsplit(')', 1)[-1].split()[19],
+            ' '.join(cmdline.split('\0')).strip(),
+        )
+
+    try:
+        output = check_output(
+            ['ps', '-o', 'lstart=', '-o', 'command=', '-p', str(pid)])
+    except (OSError, CalledProcessError):
+        return None
+    return output.decode('utf-8', 'replace').strip() or None
+
+
+def is_server_alive(state):
+    """
+    Return True if the server process recorded in state is still alive
+    and is the same process.
+    """
+
+    pid = state.get('pid')
+    return bool(is_process_alive(pid) and state.get('identity') and (
+        get_process_identity(pid) == state['identity']))
+
+
+def stop_process(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError as e:
+        logger.debug("failed to stop process %d: %s", pid, e)
+
+
+def wait_for_exit(pid, timeout):
+    """
+    Return True once the process with the pid has exited, or False if
+    it did not do so before the timeout.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            # reap the process if it was started from here.
+            os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            pass
+        if not is_process_alive(pid):
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+
+
+def wait_for_server_port(proc, log_path, offset, timeout):
+    """
+    Return the port that the karma server started as proc reported in
+    its log at log_path (from offset), or None if it exited or did not
+    report one before the timeout.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with open(log_path, 'rb') as fd:
+                fd.seek(offset)
+                text = fd.read().decode('utf-8', 'replace')
+        except (OSError, IOError):
+            text = ''
+        match = KARMA_SERVER_STARTED_PATTERN.search(text)
+        if match:
+            return int(match.group(1))
+        if proc.poll() is not None or time.time() >= deadline:
+            return None
+        time.sleep(0.25)
+
+
+def wait_for_port(port, timeout, host='localhost'):
+    """
+    Return True once the port on the host accepts connections, or False
+    if it did not do so before the timeout.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+        except (OSError, socket.error):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.25)
+        else:
+            return True
+
+
+class RJSKarmaDriver(KarmaDriver):
+    """
+    The karma driver that executes the shards written by the karma
+    advice for requirejs, if any, through concurrent karma processes.
+    """
+
+    def karma(self, spec):
+        """
+        Run the tests with the provided spec through karma, with every
+        shard in its own karma process.
+        """
+
+        if (spec.get(KARMA_SHARDS) or 0) <= 1:
+            return super(RJSKarmaDriver, self).karma(spec)
+
+        spec.handle(karma.BEFORE_KARMA)
+
+        config_paths = spec.get('karma_requirejs_test_shards') or [
+            join(spec[BUILD_DIR], self.karma_conf_js)]
+        call_kw = self._gen_call_kws(**utils.extract_gui_environ_keys())
+        binary = self.which() or self.which_with_node_modules()
+        if binary is None:
+            raise AdviceAbort('karma not found')
+
+        procs = []
+        for config_fn in config_paths:
+            logger.info('invoking %s start %r', self.binary, config_fn)
+            procs.append(Popen(
+                [binary, 'start', config_fn, '--color'], **call_kw))
+
+        return_code = 0
+        for config_fn, proc in zip(config_paths, procs):
+            rc = proc.wait()
+            if rc:
+                logger.error(
+                    "karma exited with return code %s for '%s'",
+                    rc, config_fn)
+                return_code = return_code or rc
+        logger.info(
+            "executed %d karma shard(s) concurrently", len(config_paths))
+        spec[karma.KARMA_RETURN_CODE] = return_code
+
+        spec.handle(karma.AFTER_KARMA)
+
+
+class KarmaServerDriver(RJSKarmaDriver):
+    """
+    The karma driver that executes the tests through a persistent karma
+    server.
+    """
+
+    def __init__(
+            self, port=KARMA_SERVER_PORT,
+            startup_timeout=KARMA_SERVER_STARTUP_TIMEOUT,
+            capture_timeout=KARMA_SERVER_CAPTURE_TIMEOUT, *a, **kw):
+        """
+        Arguments
+
+        port
+            The port for the karma server; defaults to 9876.
+        startup_timeout
+            The number of seconds to wait for a newly started server to
+            listen on the port, and for a stopped server to exit.
+        capture_timeout
+            The number of seconds to keep retrying karma run while the
+            server has yet to capture a browser.
+
+        All other arguments are passed to KarmaDriver.
+        """
+
+        super(KarmaServerDriver, self).__init__(*a, **kw)
+        self.port = port
+        self.startup_timeout = startup_timeout
+        self.capture_timeout = capture_timeout
+
+    def setup_toolchain_spec(self, toolchain, spec):
+        spec[KARMA_SERVER] = BUILD_DIR in spec and os.name != 'nt'
+        if not spec[KARMA_SERVER]:
+            logger.warning(
+                "a persistent karma server requires an explicitly specified "
+                "build directory and a POSIX platform; starting karma for "
+                "a single run instead")
+        super(KarmaServerDriver, self).setup_toolchain_spec(toolchain, spec)
+
+    def _write_config(self, spec):
+        karma_config = spec.get(karma.KARMA_CONFIG)
+        if not spec.get(KARMA_SERVER) or not isinstance(karma_config, dict):
+            return super(KarmaServerDriver, self)._write_config(spec)
+
+        karma_config['singleRun'] = False
+        # the runs are driven by karma run.
+        karma_config['autoWatch'] = False
+        karma_config['port'] = self.port
+
+        files = []
+        # prepend the file listing with the source artifacts.
+        for f in (spec.get(ARTIFACT_PATHS), karma_config.get('files')):
+            if isinstance(f, (tuple, list)):
+                files.extend(f)
+        karma_config['files'] = files
+
+        config_fn = join(spec[BUILD_DIR], self.karma_conf_js)
+        write_if_changed(
+            config_fn, karma.KARMA_CONF_TEMPLATE % self.dumps(karma_config))
+        return config_fn
+
+    def stop_server(self, state):
+        """
+        Stop the server recorded in state and wait for it to exit.
+        """
+
+        logger.info(
+            "karma configuration changed; stopping karma server (pid %d)",
+            state['pid'])
+        stop_process(state['pid'])
+        if not wait_for_exit(state['pid'], self.startup_timeout):
+            raise AdviceAbort(
+                'karma server (pid %d) did not exit within %d seconds' % (
+                    state['pid'], self.startup_timeout))
+
+    def ensure_server(self, spec, binary, config_fn, call_kw):
+        """
+        Ensure that a karma server is running for the configuration,
+        with the one that was started for a different configuration
+        stopped and replaced.  Returns True if a new server was started.
+        """
+
+        build_dir = spec[BUILD_DIR]
+        state_path = join(build_dir, KARMA_SERVER_STATE)
+        key = digest_path(config_fn)
+        state = read_json(state_path)
+        if isinstance(state, dict) and is_server_alive(state):
+            if state.get('key') == key and state.get('port') == self.port:
+                logger.info(
+                    "reusing karma server (pid %d) on port %d",
+                    state['pid'], self.port)
+                return False
+            self.stop_server(state)
+
+        # karma would silently listen on another port if this one is
+        # taken, while karma run would reach whatever is listening here.
+        if wait_for_port(self.port, 0):
+            raise AdviceAbort(
+                'port %d is in use; unable to start karma server' % self.port)
+
+        log_path = join(build_dir, KARMA_SERVER_LOG)
+        offset = getsize(log_path) if exists(log_path) else 0
+        logger.info(
+            "invoking %s start %r in the background, with its output "
+            "written to '%s'", self.binary, config_fn, log_path)
+        with open(log_path, 'ab') as log:
+            proc = Popen(
+                [binary, 'start', config_fn, '--no-single-run'],
+                stdout=log, stderr=STDOUT, **call_kw)
+        port = wait_for_server_port(
+            proc, log_path, offset, self.startup_timeout)
+        # only identify the process once it has executed karma, as the
+        # command line of a child right after the fork is the parent's.
+        write_json(state_path, {
+            'pid': proc.pid, 'key': key, 'port': self.port,
+            'identity': get_process_identity(proc.pid),
+        })
+        if port is None:
+            if proc.poll() is not None:
+                raise AdviceAbort(
+                    "karma server exited with return code %s; refer to "
+                    "'%s' for details" % (proc.returncode, log_path))
+            logger.warning(
+                "karma server did not report its port within %d seconds",
+                self.startup_timeout)
+        elif port != self.port:
+            stop_process(proc.pid)
+            raise AdviceAbort(
+                'karma server started on port %d instead of port %d' % (
+                    port, self.port))
+        return True
+
+    def run_karma(self, binary, config_fn, call_kw, retry=False):
+        """
+        Execute karma run against the server and return its return code,
+        retrying while the server has yet to capture a browser if retry
+        is True.
+        """
+
+        deadline = time.time() + self.capture_timeout
+        while True:
+            logger.info('invoking %s run %r', self.binary, config_fn)
+            proc = Popen([
+                binary, 'run', config_fn, '--port', str(self.port), '--color',
+            ], stdout=PIPE, stderr=STDOUT, **call_kw)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+            if not (retry and proc.returncode and (
+                    KARMA_NO_CAPTURED_BROWSER in output.lower()) and (
+                    time.time() < deadline)):
+                break
+            logger.info(
+                "karma server has yet to capture a browser; retrying")
+            time.sleep(KARMA_RUN_RETRY_INTERVAL)
+        sys.stdout.write(output)
+        sys.stdout.flush()
+        return proc.returncode
+
+    def karma(self, spec):
+        """
+        Run the tests with the provided spec through the karma server.
+        """
+
+        if not spec.get(KARMA_SERVER):
+            return super(KarmaServerDriver, self).karma(spec)
+
+        if (spec.get(KARMA_SHARDS) or 0) > 1:
+            logger.warning(
+                "karma shards are not executed through the karma server; "
+                "running all the tests through the single server")
+
+        spec.handle(karma.BEFORE_KARMA)
+
+        config_fn = join(spec[BUILD_DIR], self.karma_conf_js)
+        call_kw = self._gen_call_kws(**utils.extract_gui_environ_keys())
+        binary = self.which() or self.which_with_node_modules()
+        if binary is None:
+            raise AdviceAbort('karma not found')
+        started = self.ensure_server(spec, binary, config_fn, call_kw)
+        # a new server needs some time to capture the browsers.
+        spec[karma.KARMA_RETURN_CODE] = self.run_karma(
+            binary, config_fn, call_kw, retry=started)
+
+        spec.handle(karma.AFTER_KARMA)
+
+
+class RJSKarmaRuntime(KarmaRuntime):
+    """
+    The karma runtime with the options for the karma advice for
+    requirejs.
+    """
+
+    def init_argparser(self, argparser):
+        super(RJSKarmaRuntime, self).init_argparser(argparser)
+        init_argparser_karma_requirejs(argparser)
+
+    def _run_runtime(self, runtime, **kwargs):
+        spec = prepare_spec_from_runtime(runtime, **kwargs)
+        update_spec_for_karma_requirejs(spec, **kwargs)
+        self.cli_driver.run(runtime.toolchain, spec)
+        return spec
+
+
+if karma is None:  # pragma: no cover
+    rjs_karma = karma_server = None
+else:
+    rjs_karma = RJSKarmaRuntime(
+        RJSKarmaDriver.create(),
+        description='karma testrunner integration for calmjs, with the '
+                    'options for the requirejs test runner setup',
+    )
+    karma_server = RJSKarmaRuntime(
+        KarmaServerDriver.create(),
+        description='karma testrunner integration for calmjs through a '
+                    'persistent karma server',
+    )
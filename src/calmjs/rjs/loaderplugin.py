@@ -31,7 +31,6 @@ not import anything from the calmjs namespace.
 """
 
 import logging
-import shutil
 from os import makedirs
 from os.path import dirname
 from os.path import exists
@@ -40,6 +39,9 @@ from os.path import join
 from calmjs.loaderplugin import NPMLoaderPluginHandler
 from calmjs.loaderplugin import BaseLoaderPluginHandler
 
+from .utils import MATERIALIZE_METHOD
+from .utils import materialize
+
 logger = logging.getLogger(__name__)
 
 
@@ -359,7 +361,7 @@ class TextPlugin(NPMLoaderPluginHandler, RJSLoaderPluginHandlerMixin):
         copy_target = join(spec['build_dir'], stripped_target)
         if not exists(dirname(copy_target)):
             makedirs(dirname(copy_target))
-        shutil.copy(source, copy_target)
+        materialize(source, copy_target, spec.get(MATERIALIZE_METHOD))
 
         bundled_modpaths = {modname: modpath}
         bundled_targets = self.modname_target_to_config_paths(modname, target)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+A lockfile for the registries and sourcepaths resolved for a build.
+
+Resolving the module registries, the transpile_sourcepath and the
+bundle_sourcepath for a set of packages requires the construction of
+every module registry involved, which walks through the entry points of
+all the installed distributions.  As the results only change when the
+distributions that contributed to them have been changed, they may be
+recorded into a lockfile along with the fingerprints of those
+distributions (their metadata, location and version) and the directories
+that contain the resolved sources, such that subsequent builds with the
+same arguments may skip the resolution entirely while the fingerprints
+remain unchanged.
+"""
+
+import logging
+
+from calmjs import dist as calmjs_dist
+
+from calmjs.rjs.cache import read_json
+from calmjs.rjs.cache import write_json
+from calmjs.rjs.dist import dump_ordered
+from calmjs.rjs.dist import get_dist_fingerprint
+from calmjs.rjs.dist import get_paths_fingerprint
+from calmjs.rjs.dist import load_ordered
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the resolution of the values recorded, or the
+# format of the lockfile, has changed.
+LOCKFILE_VERSION = 2
+
+
+def get_dists_fingerprint(package_names):
+    """
+    Return the fingerprints of the distributions for the packages along
+    with all their requirements, or None if they cannot be resolved.
+    """
+
+    try:
+        dists = calmjs_dist.find_packages_requirements_dists(package_names)
+    except Exception as e:
+        logger.debug(
+            "failed to resolve the distributions for %r: %s",
+            package_names, e)
+        return None
+    return [get_dist_fingerprint(dist) for dist in dists]
+
+
+def read_lockfile(path, inputs):
+    """
+    Return the tuple of the registries, the transpile_sourcepath and the
+    bundle_sourcepath recorded in the lockfile at path, or None if the
+    lockfile was not created with the identical inputs or if any of its
+    fingerprints no longer match.
+    """
+
+    lock = read_json(path)
+    if not isinstance(lock, dict):
+        return None
+    if lock.get('version') != LOCKFILE_VERSION or lock.get(
+            'inputs') != inputs:
+        logger.info(
+            "lockfile '%s' was created with different arguments; "
+            "resolving the sourcepaths", path)
+        return None
+
+    try:
+        registries = lock['registries']
+        transpile_sourcepath = load_ordered(lock['transpile_sourcepath'])
+        bundle_sourcepath = load_ordered(lock['bundle_sourcepath'])
+        dists = lock['dists']
+        paths = lock['paths']
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning("ignoring incomplete lockfile '%s': %s", path, e)
+        return None
+
+    if get_dists_fingerprint(inputs['package_names']) != dists:
+        logger.info(
+            "distributions changed since the creation of lockfile '%s'; "
+            "resolving the sourcepaths", path)
+        return None
+
+    if get_paths_fingerprint(
+            transpile_sourcepath, bundle_sourcepath) != paths:
+        logger.info(
+            "source directories changed since the creation of lockfile "
+            "'%s'; resolving the sourcepaths", path)
+        return None
+
+    return registries, transpile_sourcepath, bundle_sourcepath
+
+
+def write_lockfile(
+        path, inputs, registries, transpile_sourcepath, bundle_sourcepath):
+    """
+    Write the resolved registries and sourcepaths for the inputs into
+    the lockfile at path, along with the fingerprints needed to validate
+    them.
+    """
+
+    dists = get_dists_fingerprint(inputs['package_names'])
+    if dists is None:
+        logger.warning(
+            "unable to fingerprint the distributions for %r; lockfile '%s' "
+            "not written", inputs['package_names'], path)
+        return False
+
+    try:
+        write_json(path, {
+            'version': LOCKFILE_VERSION,
+            'inputs': inputs,
+            'registries': registries,
+            # as ordered, for the order of the modules in the build.
+            'transpile_sourcepath': dump_ordered(transpile_sourcepath),
+            'bundle_sourcepath': dump_ordered(bundle_sourcepath),
+            'dists': dists,
+            'paths': get_paths_fingerprint(
+                transpile_sourcepath, bundle_sourcepath),
+        })
+    except (OSError, IOError) as e:
+        logger.warning("failed to write lockfile '%s': %s", path, e)
+        return False
+    logger.info("wrote resolved sourcepaths to lockfile '%s'", path)
+    return True
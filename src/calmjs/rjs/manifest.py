@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Sidecar manifests written alongside the artifacts generated by the
+RJSToolchain, such that the information derived from an artifact at the
+time it was built need not be derived again by every consumer of it.
+
+Every manifest records the digest of the artifact it was produced from,
+and it will only be used for as long as the artifact remains unchanged.
+"""
+
+import codecs
+import hashlib
+import json
+import logging
+import posixpath
+import re
+from collections import OrderedDict
+from os.path import basename
+
+from calmjs.rjs.cache import read_json
+from calmjs.rjs.cache import write_json
+from calmjs.rjs.requirejs import process_path_defines_records
+from calmjs.rjs.requirejs import sort_defines
+from calmjs.rjs.requirejs import update_defines
+
+logger = logging.getLogger(__name__)
+
+DEFINE_MANIFEST_SUFFIX = '.defines.json'
+# Bump this whenever the format of the define manifest is changed.
+DEFINE_MANIFEST_VERSION = 1
+PRELOAD_MANIFEST_SUFFIX = '.preload.json'
+# Bump this whenever the format of the preload manifest is changed.
+PRELOAD_MANIFEST_VERSION = 2
+
+# the names that requirejs will use as urls as is, and the urls that it
+# will not resolve against the baseUrl.
+_URL_NAME = re.compile(r'^/|:|\?|\.js$')
+_ABSOLUTE_URL = re.compile(r'^/|^[\w+.-]+:')
+
+
+def digest_path(path):
+    """
+    Return the hex digest of the content of the file at path, or None if
+    it cannot be read.
+    """
+
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(65536), b''):
+                digest.update(chunk)
+    except (OSError, IOError):
+        return None
+    return digest.hexdigest()
+
+
+def get_define_manifest_path(artifact):
+    return artifact + DEFINE_MANIFEST_SUFFIX
+
+
+def write_define_manifest(artifact, cache=None):
+    """
+    Extract the define records from the artifact and write them to the
+    define manifest next to it.  Returns the path to the manifest, or
+    None if the artifact could not be processed.
+    """
+
+    digest = digest_path(artifact)
+    records = process_path_defines_records(artifact, cache=cache)
+    if digest is None or records is None:
+        return None
+    path = get_define_manifest_path(artifact)
+    write_json(path, {
+        'version': DEFINE_MANIFEST_VERSION,
+        'sha1': digest,
+        'records': records,
+    })
+    return path
+
+
+def read_define_manifest(artifact):
+    """
+    Return the define records for the artifact, in the order they were
+    defined, from the define manifest next to it; None if the manifest
+    is missing or if it is no longer valid for the artifact.
+    """
+
+    path = get_define_manifest_path(artifact)
+    manifest = read_json(path)
+    if not isinstance(manifest, dict):
+        return None
+    if manifest.get('version') != DEFINE_MANIFEST_VERSION:
+        logger.debug("ignoring define manifest '%s' of another version", path)
+        return None
+    if manifest.get('sha1') != digest_path(artifact):
+        logger.debug(
+            "ignoring define manifest '%s' as it does not match its "
+            "artifact", path)
+        return None
+    return manifest.get('records')
+
+
+def get_preload_manifest_path(artifact):
+    return artifact + PRELOAD_MANIFEST_SUFFIX
+
+
+def resolve_url(name, config, ext='.js'):
+    """
+    Resolve the name into the url that requirejs will fetch it from with
+    the config, through its paths and baseUrl the same way as requirejs
+    would, with the ext appended.  A relative baseUrl (which defaults to
+    '.') is taken as relative to the artifact, as it would be for an
+    artifact loaded as the data-main of requirejs, such that the
+    relative urls returned are relative to the artifact.
+    """
+
+    if _URL_NAME.search(name):
+        return name
+    paths = config.get('paths') or {}
+    segments = name.split('/')
+    for idx in range(len(segments), 0, -1):
+        path = paths.get('/'.join(segments[:idx]))
+        if path is None:
+            continue
+        if isinstance(path, list):
+            # the first of the fallback paths.
+            path = path[0]
+        segments[:idx] = [path]
+        break
+    url = '/'.join(segments)
+    if '?' not in url:
+        url += ext
+    if _ABSOLUTE_URL.match(url):
+        return url
+    return posixpath.normpath(posixpath.join(config.get('baseUrl', '.'), url))
+
+
+def resolve_resource_url(resource, config):
+    """
+    Resolve the resource required through a loader plugin into its url,
+    the same way as require.toUrl would, i.e. with its own extension.
+    """
+
+    name, ext = posixpath.splitext(resource)
+    if not name or name.endswith('/'):
+        # a leading dot is not an extension.
+        name, ext = resource, ''
+    return resolve_url(name, config, ext)
+
+
+def load_preload_config(path):
+    with codecs.open(path, encoding='utf-8') as fd:
+        return json.load(fd)
+
+
+def get_preload_entries(records, artifact, external=(), config=None):
+    """
+    Return the list of entries for every file that will be fetched for
+    the artifact with the define records, in the order they should be
+    loaded.  These are the external modules, i.e. the ones that were
+    marked as empty for the build, with the resources required through
+    loader plugins distinguished, and the layers that provide them,
+    followed by the artifact itself.
+
+    The path of every entry is the url it will be fetched from, resolved
+    through the paths, bundles and baseUrl of the requirejs config for
+    the pages that make use of the artifact, which defaults to the
+    external modules being located relative to the artifact; relative
+    paths are relative to the artifact.
+
+    The external modules are ordered by their first requirement by the
+    modules defined in the artifact, with the remainder sorted by name.
+    """
+
+    config = config or {}
+    bundles = {}
+    for bundle, modnames in sorted((config.get('bundles') or {}).items()):
+        for modname in modnames:
+            bundles.setdefault(modname, bundle)
+
+    external = set(external)
+    defines = {}
+    update_defines(defines, records, artifact)
+    graph = OrderedDict()
+    for modname, deps in records:
+        graph.setdefault(modname, [
+            dep for dep in defines[modname]
+            if dep in defines or dep in external
+        ])
+    for modname in sorted(external):
+        # the external modules are leaves amongst the defined modules.
+        graph.setdefault(modname, [])
+    order, cycles = sort_defines(graph)
+
+    entries = []
+    layers = {}
+    paths = set()
+    for modname in order:
+        if modname not in external or modname in defines:
+            continue
+        if modname in bundles:
+            # the module is provided by the layer, which is only to be
+            # fetched the once.
+            bundle = bundles[modname]
+            if bundle not in layers:
+                layers[bundle] = {
+                    'type': 'layer', 'name': bundle,
+                    'path': resolve_url(bundle, config), 'modules': [],
+                }
+                entries.append(layers[bundle])
+            layers[bundle]['modules'].append(modname)
+            continue
+        if '!' in modname:
+            plugin, resource = modname.split('!', 1)
+            entry = {
+                'type': 'resource', 'name': modname,
+                'plugin': plugin, 'resource': resource,
+                'path': resolve_resource_url(resource, config),
+            }
+        else:
+            entry = {
+                'type': 'module', 'name': modname,
+                'path': resolve_url(modname, config),
+            }
+        if entry['path'] in paths:
+            continue
+        paths.add(entry['path'])
+        entries.append(entry)
+    entries.append({'type': 'artifact', 'path': basename(artifact)})
+    return entries
+
+
+def write_preload_manifest(artifact, external=(), cache=None, config=None):
+    """
+    Write the preload manifest for the artifact next to it, listing the
+    files that will be fetched for the artifact along with the external
+    modules, such that the pages that make use of the artifact may have
+    them preloaded; the config is the requirejs config of those pages
+    (refer to get_preload_entries).  The define records are taken from
+    the define manifest if it is still valid.  Returns the path to the
+    manifest, or None if the artifact could not be processed.
+    """
+
+    digest = digest_path(artifact)
+    records = read_define_manifest(artifact)
+    if records is None:
+        records = process_path_defines_records(artifact, cache=cache)
+    if digest is None or records is None:
+        return None
+    path = get_preload_manifest_path(artifact)
+    write_json(path, {
+        'version': PRELOAD_MANIFEST_VERSION,
+        'sha1': digest,
+        'files': get_preload_entries(records, artifact, external, config),
+    })
+    return path
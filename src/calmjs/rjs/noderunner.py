@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+A test runner that executes the tests through requirejs within Node.js
+processes, in place of karma and its browsers.
+
+The build is loaded using the ``node_config_js`` written by the
+RJSToolchain, with the test modules and their dependencies determined
+by the same advice that sets up the karma test runner.  The test modules
+are partitioned into shards, as done for the karma shards, with every
+shard executed by mocha within its own Node.js worker process, such that
+test suites which only exercise logic (i.e. without any reliance on the
+DOM) may be executed without the start-up costs of a browser and across
+all the available processors.  A worker that does not finish within
+the timeout is killed, with that recorded as an error.
+
+The results are written to the build directory as a JSON object, with
+the list of the results of every test (its suite, description, success,
+whether it was skipped, time and log) under ``results``, and the list
+of the errors that prevented the tests from being executed under
+``errors``; these are summarized in the log in a similar manner as done
+by karma.
+
+The driver and the runtime provided by this module require calmjs.dev.
+"""
+
+import json
+import logging
+import time
+from multiprocessing import cpu_count
+from os.path import exists
+from os.path import join
+from subprocess import Popen
+
+from calmjs.toolchain import ARTIFACT_PATHS
+from calmjs.toolchain import BUILD_DIR
+from calmjs.toolchain import TOOLCHAIN_BIN_PATH
+from calmjs.toolchain import WORKING_DIR
+from calmjs.utils import which
+
+try:
+    from calmjs.dev import karma
+    from calmjs.dev.cli import KarmaDriver
+except ImportError:  # pragma: no cover
+    # Package not available; the driver will not be usable and the
+    # runtime will not be provided.
+    karma = None
+    KarmaDriver = object
+
+from calmjs.rjs.cache import read_json
+from calmjs.rjs.cache import write_json
+from calmjs.rjs.cache import write_text
+from calmjs.rjs.dev import KARMA_TEST_DURATIONS
+from calmjs.rjs.dev import load_test_durations
+from calmjs.rjs.dev import partition_tests
+from calmjs.rjs.instrument import get_node_env
+from calmjs.rjs.karma import RJSKarmaRuntime
+from calmjs.rjs.utils import PROCESSES
+
+logger = logging.getLogger(__name__)
+
+NODE_TEST_SCRIPT_NAME = 'calmjs_rjs_node_test.js'
+NODE_TEST_RESULTS_NAME = 'node_test_results.json'
+# the number of seconds a worker may take to execute its test modules.
+NODE_TEST_TIMEOUT = 600
+
+NODE_TEST_SCRIPT = """
+var fs = require('fs');
+var vm = require('vm');
+
+var job = JSON.parse(fs.readFileSync(process.argv[2], 'utf8'));
+var requirejs = require(job.rjs);
+var Mocha = require('mocha');
+var results = {errors: [], results: []};
+
+// the assertion libraries provided by the default karma frameworks.
+try {
+    global.chai = require('chai');
+    global.assert = global.chai.assert;
+}
+catch (e) {}
+try {
+    global.expect = require('expect.js');
+}
+catch (e) {}
+try {
+    global.sinon = require('sinon');
+}
+catch (e) {}
+
+var finish = function() {
+    fs.writeFileSync(job.output, JSON.stringify(results));
+    process.exit(0);
+};
+
+var fail = function(e) {
+    results.errors.push(String(e && e.stack || e));
+    finish();
+};
+
+var titles = function(suite) {
+    var result = [];
+    for (; suite && !suite.root; suite = suite.parent) {
+        result.unshift(suite.title);
+    }
+    return result;
+};
+
+var record = function(test, success, skipped, log) {
+    results.results.push({
+        suite: titles(test.parent),
+        description: test.title,
+        success: success,
+        skipped: skipped,
+        time: test.duration || 0,
+        log: log
+    });
+};
+
+var mocha = new Mocha({reporter: function() {}});
+mocha.suite.emit('pre-require', global, null, mocha);
+
+requirejs.config(require(job.config));
+requirejs.config({paths: job.paths});
+// the test modules expect the requirejs globals, as in the browser.
+global.define = requirejs.define;
+global.requirejs = global.require = requirejs;
+job.artifacts.forEach(function(path) {
+    vm.runInThisContext(fs.readFileSync(path, 'utf8'), {filename: path});
+});
+
+requirejs(job.deps, function() {
+    requirejs(job.tests, function() {
+        var runner = mocha.run(finish);
+        runner.on('pass', function(test) {
+            record(test, true, false, []);
+        });
+        runner.on('fail', function(test, e) {
+            record(test, false, false, [String(e && e.stack || e)]);
+        });
+        runner.on('pending', function(test) {
+            record(test, true, true, []);
+        });
+    }, fail);
+}, fail);
+"""
+
+
+def get_test_results(paths):
+    """
+    Merge the results written by the workers at the paths; a worker that
+    did not write its results is recorded as an error.
+    """
+
+    merged = {'errors': [], 'results': []}
+    for path in paths:
+        results = read_json(path)
+        if not isinstance(results, dict):
+            merged['errors'].append(
+                "no test results were written to '%s'" % path)
+            continue
+        merged['errors'].extend(results.get('errors', []))
+        merged['results'].extend(results.get('results', []))
+    return merged
+
+
+def log_test_results(results):
+    """
+    Log the results, summarized as done by karma, and return the number
+    of failures.
+    """
+
+    failed = skipped = 0
+    for result in results['results']:
+        if result.get('skipped'):
+            skipped += 1
+        elif not result.get('success'):
+            failed += 1
+            logger.error(
+                "FAILED %s\n%s", ' '.join(
+                    list(result.get('suite', [])) + [result['description']]),
+                '\n'.join(result.get('log', [])))
+    for error in results['errors']:
+        logger.error("ERROR %s", error)
+
+    total = len(results['results'])
+    logger.info(
+        "Executed %d of %d%s%s", total - skipped, total,
+        " (%d FAILED)" % failed if failed else '',
+        " (skipped %d)" % skipped if skipped else '',
+    )
+    return failed + len(results['errors'])
+
+
+def wait_for_workers(procs, timeout):
+    """
+    Wait for the worker processes, killing the ones that did not finish
+    within the timeout in seconds.  Returns the list of the indexes of
+    the workers that were killed.
+    """
+
+    deadline = time.time() + timeout
+    killed = []
+    for idx, proc in enumerate(procs):
+        while proc.poll() is None:
+            if time.time() >= deadline:
+                proc.kill()
+                proc.wait()
+                killed.append(idx)
+                break
+            time.sleep(0.1)
+    return killed
+
+
+def run_node_tests(spec, processes=None, timeout=NODE_TEST_TIMEOUT):
+    """
+    Run the tests set up by the karma advice through mocha in Node.js
+    worker processes, with the results written to the build directory.
+    Every worker is killed if it has not finished within the timeout in
+    seconds.  Returns the return code, which is non-zero if any test
+    failed or if the tests could not be executed.
+    """
+
+    build_dir = spec[BUILD_DIR]
+    node_bin = which('node')
+    rjs_bin = spec.get(TOOLCHAIN_BIN_PATH)
+    node_config_js = spec.get('node_config_js')
+    if not (node_bin and rjs_bin and node_config_js and exists(
+            node_config_js)):
+        logger.error(
+            "node, r.js and the node_config_js for the build are required "
+            "for the execution of the tests through Node.js")
+        return 1
+
+    tests = spec.get('karma_requirejs_tests', [])
+    if not tests:
+        logger.warning("no test modules to be executed")
+        return 0
+
+    workers = min(processes or cpu_count(), len(tests))
+    shards = partition_tests(
+        tests, workers, load_test_durations(spec.get(KARMA_TEST_DURATIONS)))
+    script_path = join(build_dir, NODE_TEST_SCRIPT_NAME)
+    write_text(script_path, NODE_TEST_SCRIPT)
+    env = get_node_env(spec.get(WORKING_DIR))
+
+    procs = []
+    outputs = []
+    for idx, shard_tests in enumerate(shards):
+        job_path = join(build_dir, 'node_test.%d.json' % idx)
+        output = join(build_dir, 'node_test.%d.result.json' % idx)
+        write_json(job_path, {
+            'rjs': rjs_bin,
+            'config': node_config_js,
+            'paths': spec.get('karma_requirejs_test_paths', {}),
+            'artifacts': list(spec.get(ARTIFACT_PATHS) or []),
+            'deps': spec.get('karma_requirejs_test_deps', []),
+            'tests': shard_tests,
+            'output': output,
+        })
+        logger.debug(
+            "starting node test worker %d with %d test module(s)",
+            idx, len(shard_tests))
+        # requirejs resolves the relative paths in the configuration,
+        # such as the baseUrl, from the current working directory.
+        procs.append(Popen(
+            [node_bin, script_path, job_path], env=env, cwd=build_dir))
+        outputs.append(output)
+
+    killed = wait_for_workers(procs, timeout)
+    results = get_test_results(
+        [output for idx, output in enumerate(outputs) if idx not in killed])
+    results['errors'][:0] = [
+        "node test worker %d did not finish within %s seconds and was "
+        "killed; its test modules were: %s" % (
+            idx, timeout, ', '.join(shards[idx]))
+        for idx in killed
+    ]
+    results_path = spec['node_test_results'] = join(
+        build_dir, NODE_TEST_RESULTS_NAME)
+    with open(results_path, 'w') as fd:
+        json.dump(results, fd, indent=4)
+    logger.info(
+        "executed %d test module(s) in %d node worker(s); results written "
+        "to '%s'", len(tests), len(procs), results_path)
+    return 1 if log_test_results(results) else 0
+
+
+class NodeTestDriver(KarmaDriver):
+    """
+    The karma driver that executes the tests through Node.js in place
+    of karma.
+    """
+
+    def __init__(self, processes=None, timeout=NODE_TEST_TIMEOUT, *a, **kw):
+        """
+        Arguments
+
+        processes
+            The number of Node.js worker processes; defaults to the
+            value specified in the spec, or the number of processors.
+        timeout
+            The number of seconds for every worker to finish before it
+            is killed; defaults to 600.
+
+        All other arguments are passed to KarmaDriver.
+        """
+
+        super(NodeTestDriver, self).__init__(*a, **kw)
+        self.processes = processes
+        self.timeout = timeout
+
+    def karma(self, spec):
+        """
+        Run the tests with the provided spec through Node.js.
+        """
+
+        spec.handle(karma.BEFORE_KARMA)
+        spec[karma.KARMA_RETURN_CODE] = run_node_tests(
+            spec, processes=self.processes or spec.get(PROCESSES),
+            timeout=self.timeout)
+        spec.handle(karma.AFTER_KARMA)
+
+
+node_test = None if karma is None else RJSKarmaRuntime(
+    NodeTestDriver.create(),
+    description='test runner integration for calmjs through Node.js, for '
+                'test suites that do not require a browser',
+)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Size attribution reports for artifacts generated by the RJSToolchain.
+
+As the artifact produced by r.js is simply the concatenation of all the
+modules that got copied or transpiled into the build directory, the
+size of each of those files can be used to attribute the bytes of the
+final export_target back to the module and then to the package that
+provided it, using the provenance information available in the spec
+(i.e. the ``transpile_sourcepath`` and ``bundle_sourcepath`` mappings,
+along with the module registries that sourced them).
+"""
+
+import codecs
+import json
+import logging
+import zlib
+from os.path import basename
+from os.path import isfile
+from os.path import join
+from os.path import normpath
+from os.path import sep
+
+from calmjs.registry import get
+from calmjs.toolchain import BUILD_DIR
+from calmjs.toolchain import CALMJS_MODULE_REGISTRY_NAMES
+from calmjs.toolchain import EXPORT_TARGET
+
+from calmjs.rjs.dist import EMPTY
+
+logger = logging.getLogger(__name__)
+
+NODE_MODULES = 'node_modules'
+UNKNOWN_PACKAGE = '<unknown>'
+UNATTRIBUTED = '<unattributed>'
+
+
+def gzip_size(data):
+    """
+    Return the length of the gzip compressed data, using the default
+    level typically used by web servers.  The gzip header is produced
+    without a timestamp so the result is stable.
+    """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return len(compressor.compress(data) + compressor.flush())
+
+
+def sizes(data):
+    return {'raw': len(data), 'gzip': gzip_size(data)}
+
+
+def get_modname_package_map(registry_names):
+    """
+    Produce a mapping of module names to the Python package that have
+    declared them through the module registries identified by the
+    provided registry_names.
+    """
+
+    result = {}
+    for registry_name in registry_names or ():
+        registry = get(registry_name)
+        package_module_map = getattr(registry, 'package_module_map', None)
+        if package_module_map is None:
+            continue
+        for package_name in package_module_map:
+            for modname in registry.get_records_for_package(package_name):
+                result.setdefault(modname, package_name)
+    return result
+
+
+def get_node_module_package_name(path):
+    """
+    Return the npm package name for a path that is located inside some
+    node_modules directory, or None if the path is not inside one.
+    """
+
+    frags = normpath(path).split(sep)
+    if NODE_MODULES not in frags:
+        return None
+    # the innermost node_modules is where the package is from.
+    idx = len(frags) - frags[::-1].index(NODE_MODULES)
+    names = frags[idx:idx + 2]
+    if not names or (names[0].startswith('@') and len(names) < 2):
+        return None
+    return '/'.join(names) if names[0].startswith('@') else names[0]
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+def generate_size_report(spec):
+    """
+    Attribute the bytes (both raw and gzipped) of the export_target in
+    the spec to each of the modules that have been compiled into the
+    build directory, then group them by the package that provided them.
+
+    The spec must have gone through the link step.
+    """
+
+    build_dir = spec[BUILD_DIR]
+    modname_package_map = get_modname_package_map(
+        spec.get(CALMJS_MODULE_REGISTRY_NAMES))
+    artifact = _read_bytes(spec[EXPORT_TARGET])
+
+    modules = {}
+    package_data = {}
+
+    def record(modname, path, source):
+        data = _read_bytes(path)
+        package = (
+            modname_package_map.get(modname) or
+            get_node_module_package_name(source) or
+            UNKNOWN_PACKAGE
+        )
+        modules[modname] = sizes(data)
+        modules[modname]['package'] = package
+        modules[modname]['source'] = source
+        package_data.setdefault(package, []).append((modname, data))
+
+    for prefix, sourcepath_key in (
+            ('transpiled', 'transpile_sourcepath'),
+            ('bundled', 'bundle_sourcepath')):
+        sourcepath = spec.get(sourcepath_key, {})
+        modpaths = spec.get(prefix + '_modpaths', {})
+        for modname, target in spec.get(prefix + '_targetpaths', {}).items():
+            if modpaths.get(modname) == EMPTY or target == EMPTY:
+                continue
+            path = join(build_dir, *target.split('/'))
+            if isfile(path):
+                record(modname, path, sourcepath.get(modname, path))
+
+    # loader plugin resources are inlined using their source.
+    for modname, source in spec.get('plugin_sourcepath', {}).items():
+        if spec.get('plugins_modpaths', {}).get(modname) == EMPTY:
+            continue
+        if isfile(source):
+            record(modname, source, source)
+
+    packages = {}
+    attributed = 0
+    for package, items in package_data.items():
+        data = b''.join(data for modname, data in items)
+        packages[package] = sizes(data)
+        packages[package]['modules'] = sorted(modname for modname, _ in items)
+        attributed += len(data)
+
+    report = {
+        EXPORT_TARGET: spec[EXPORT_TARGET],
+        'total': sizes(artifact),
+        'packages': packages,
+        'modules': modules,
+    }
+    # whatever remains is from wrappers and loader plugins that got
+    # added by r.js itself.
+    report[UNATTRIBUTED] = {'raw': max(0, len(artifact) - attributed)}
+    return report
+
+
+def _normalize_limit(limit):
+    if isinstance(limit, dict):
+        return {k: v for k, v in limit.items() if k in ('raw', 'gzip')}
+    return {'raw': limit}
+
+
+def check_size_budget(report, budget):
+    """
+    Check the report against the budget, returning a list of messages
+    for every limit that was exceeded.
+
+    The budget is a dict that may contain the key 'total' for the whole
+    artifact and 'packages', which is a mapping of package names to
+    their limits.  A limit can be the number of raw bytes or a dict with
+    the keys 'raw' and/or 'gzip' for the respective number of bytes.
+    """
+
+    failures = []
+
+    def check(label, actual, limit):
+        for key, value in sorted(_normalize_limit(limit).items()):
+            if actual.get(key, 0) > value:
+                failures.append("%s is %d bytes %s; exceeds budget of %d" % (
+                    label, actual[key], key, value))
+
+    if 'total' in budget:
+        check("artifact '%s'" % basename(report[EXPORT_TARGET]),
+              report['total'], budget['total'])
+
+    for package, limit in sorted(budget.get('packages', {}).items()):
+        check("package '%s'" % package,
+              report['packages'].get(package, {}), limit)
+
+    return failures
+
+
+def load_size_budget(path):
+    with codecs.open(path, encoding='utf-8') as fd:
+        return json.load(fd)
+
+
+def log_size_report(report):
+    total = report['total']
+    logger.info(
+        "artifact '%s' is %d bytes (%d bytes gzipped)",
+        report[EXPORT_TARGET], total['raw'], total['gzip'],
+    )
+    for package, value in sorted(
+            report['packages'].items(), key=lambda i: -i[1]['raw']):
+        logger.info(
+            "package '%s' contributed %d bytes (%d bytes gzipped) from %d "
+            "module(s)", package, value['raw'], value['gzip'],
+            len(value['modules']),
+        )
@@ -8,16 +8,165 @@ details that the requirejs library made.
 
 import logging
 import codecs
-from functools import partial
+import hashlib
+import multiprocessing
+import re
+import threading
+from copy import deepcopy
+from os.path import abspath
 
 from calmjs.parse import asttypes
-from calmjs.parse.parsers.es5 import parse
+from calmjs.parse.parsers.es5 import Parser
 
+from calmjs.interrogate import define_wrapped
+from calmjs.interrogate import reserved_module
+from calmjs.interrogate import strip_quotes
+from calmjs.interrogate import strip_slashes
 from calmjs.interrogate import to_str
 from calmjs.interrogate import filter_function_argument
+from calmjs.interrogate import yield_module_imports
 
 logger = logging.getLogger(__name__)
 
+# the parser instances, one for each thread.
+_local = threading.local()
+
+
+def _get_parser():
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = Parser()
+        # the initial state of the lexer, as it is not reset by input.
+        _local.lexer_state = {
+            key: value for key, value in vars(parser.lexer).items()
+            if isinstance(value, (type(None), bool, list, dict))
+        }
+    return parser
+
+
+def _reset_parser(parser):
+    """
+    Reset the state left behind in the parser by the previous input.
+    As this state is internal to calmjs.parse and ply, return False
+    without touching the parser if it is not laid out as expected.
+    """
+
+    lexer = getattr(getattr(parser, 'lexer', None), 'lexer', None)
+    if not (
+            isinstance(getattr(lexer, 'lexstatestack', None), list) and
+            hasattr(lexer, 'lineno') and hasattr(lexer, 'begin') and
+            hasattr(getattr(parser, 'parser', None), 'errorok')):
+        return False
+    for key, value in _local.lexer_state.items():
+        setattr(parser.lexer, key, deepcopy(value))
+    lexer.lineno = 1
+    del lexer.lexstatestack[:]
+    lexer.begin('INITIAL')
+    parser.parser.errorok = True
+    return True
+
+
+def parse(text):
+    """
+    Return the syntax tree for the ES5 source text, using the parser
+    instance that is kept for the current thread, such that the cost of
+    constructing the parser and the lexer is only paid once.  A new
+    parser is used for every text should the kept one be impossible to
+    reset.
+    """
+
+    parser = _get_parser()
+    if not _reset_parser(parser):
+        logger.debug("unable to reset parser; using a new parser instance")
+        parser = Parser()
+    try:
+        return parser.parse(text)
+    finally:
+        lr = parser.parser
+        if hasattr(lr, 'statestack'):
+            # release the references to the tree held by the stacks.
+            lr.restart()
+
+
+def parse_texts(texts):
+    """
+    Yield the syntax tree for each of the provided ES5 source texts in
+    order, all using the parser instance for the current thread.
+    """
+
+    for text in texts:
+        yield parse(text)
+
+
+# node types that will never have any FunctionCall nodes beneath them.
+LEAF_NODE_TYPES = (
+    asttypes.Boolean,
+    asttypes.Break,
+    asttypes.Comment,
+    asttypes.Continue,
+    asttypes.Debugger,
+    asttypes.Elision,
+    asttypes.EmptyStatement,
+    asttypes.Identifier,
+    asttypes.Null,
+    asttypes.Number,
+    asttypes.Regex,
+    asttypes.String,
+    asttypes.This,
+)
+
+
+def iter_defines_with_deps(node):
+    """
+    Yield a 2-tuple of module name and the list of module names it
+    requires synchronously for every define call with a string literal
+    module name found within the node, in the order of their appearance
+    in the source.
+
+    Calls to any other named function are not descended into, as that
+    is where the requirejs optimizer would have placed them.  The tree
+    is walked using an explicit stack of child iterators, such that the
+    deeply nested expressions commonly found in minified artifacts will
+    not exhaust the recursion limit.
+    """
+
+    f_name = 'define'
+    f_argn = 0
+    f_argt = asttypes.String
+
+    stack = [iter(node)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, asttypes.FunctionCall) and isinstance(
+                    child.identifier, asttypes.Identifier):
+                if child.identifier.value == f_name and f_argn < len(
+                        child.args.items) and isinstance(
+                            child.args.items[f_argn], f_argt):
+                    yield to_str(child.args.items[f_argn]), list(
+                        filter_function_argument(
+                            child, 'require', 0, asttypes.String))
+            elif not isinstance(child, LEAF_NODE_TYPES):
+                stack.append(iter(child))
+                break
+        else:
+            stack.pop()
+
+
+def update_defines(defines, records, node_name):
+    """
+    Update the defines mapping with the records produced by the above
+    function, which were extracted from the node identified by the name.
+    """
+
+    for modname, moddeps in records:
+        if modname in defines:
+            logger.warning(
+                "module '%s' defined again in '%s'", modname, node_name)
+            # don't do anything more since requirejs doesn't permit
+            # redefinition in general.
+            continue
+        defines[modname] = moddeps
+
 
 def extract_defines_with_deps_visitor(node_map):
     """
@@ -29,79 +178,618 @@ def extract_defines_with_deps_visitor(node_map):
     """
 
     defines = {}
-    yielded = set()
 
-    def extract_defines_visitor(node, node_name):
-        f_name = 'define'
-        f_argn = 0
-        f_argt = asttypes.String
+    # first flatten it into a dependency map
+    for node_name, node in node_map:
+        update_defines(defines, iter_defines_with_deps(node), node_name)
+
+    # then process that map to generate the values in correct order.
+    for modname in order_defines(defines):
+        yield modname
 
-        for child in node:
-            if isinstance(child, asttypes.FunctionCall) and isinstance(
-                    child.identifier, asttypes.Identifier):
-                if child.identifier.value == f_name and f_argn < len(
-                        child.args.items) and isinstance(
-                            child.args.items[f_argn], f_argt):
-                    modname = to_str(child.args.items[f_argn])
-                    moddeps = list(filter_function_argument(
-                        child, 'require', 0, asttypes.String))
-                    if modname in defines:
+
+def order_defines(defines, cycles=None):
+    """
+    Return the list of module names from the defines mapping in the
+    order they should be loaded, with any circular requirements found
+    logged as warnings.  If a list is provided as cycles, every cycle
+    found (as returned by sort_defines) is appended to it.
+    """
+
+    order, found = sort_defines(defines)
+    for cycle in found:
+        logger.warning(
+            "circular dependency between modules: %s",
+            ' -> '.join(repr(modname) for modname in cycle + cycle[:1]),
+        )
+    if cycles is not None:
+        cycles.extend(found)
+    return order
+
+
+def sort_defines(defines):
+    """
+    Topologically sort the defines mapping, such that every module will
+    come after the modules that it requires.  Returns a 2-tuple of the
+    ordered list of all the defined module names, and a list of cycles,
+    each being the list of module names that form a circular chain of
+    requirements in the order they require each other.
+
+    This is done through a depth first traversal with an explicit stack
+    which visits every module and requirement exactly once, with the
+    modules being visited in the order of the defines mapping and their
+    requirements in the order they are listed.  When a cycle is found,
+    the requirement that closes it is simply skipped, so all modules
+    will still be present in the ordering.  Requirements to modules that
+    are not defined are logged and omitted.
+    """
+
+    order = []
+    cycles = []
+    done = set()
+    missing = set()
+
+    for root in defines:
+        if root in done:
+            continue
+        # the current path, as a list and as the positions within.
+        path = [root]
+        active = {root: 0}
+        stack = [iter(defines[root])]
+        while stack:
+            for modname in stack[-1]:
+                if modname in done:
+                    continue
+                if modname not in defines:
+                    if modname not in missing:
+                        missing.add(modname)
                         logger.warning(
-                            "module '%s' defined again in '%s'",
-                            modname, node_name,
-                        )
-                        # don't do anything more since requirejs doesn't
-                        # permit redefinition in general.
-                        continue
-                    defines[modname] = moddeps
+                            "module '%s' required but seems to be missing",
+                            modname)
+                    continue
+                if modname in active:
+                    cycles.append(path[active[modname]:])
+                    continue
+                active[modname] = len(path)
+                path.append(modname)
+                stack.append(iter(defines[modname]))
+                break
             else:
-                extract_defines_visitor(child, node_name)
+                stack.pop()
+                modname = path.pop()
+                active.pop(modname)
+                done.add(modname)
+                order.append(modname)
 
-    # first flatten it into a dependency map
-    for node_name, node in node_map:
-        extract_defines_visitor(node, node_name)
+    return order, cycles
 
-    # then process that map to generate the values in correct order.
-    def process_defines(modname):
-        if modname not in yielded:
-            for modname_ in defines.get(modname, ()):
-                for mn in process_defines(modname_):
-                    yield mn
-            if modname in defines:
-                yielded.add(modname)
-                yield modname
+
+def transitive_closure(graph, roots):
+    """
+    Return the set of the roots and all the nodes that can be reached
+    from them through the graph, a mapping of every node to the nodes
+    it refers to.
+    """
+
+    result = set()
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if node in result:
+            continue
+        result.add(node)
+        stack.extend(graph.get(node, ()))
+    return result
+
+
+# The lexical prescan, for deriving the same results as the functions
+# that work on the syntax trees without having to parse the source text
+# for the simple, unambiguous cases.  The functions return None if they
+# are unable to come to the same results with certainty, such that the
+# caller may fall back to using the complete parser.
+
+KEYWORDS = frozenset([
+    'break', 'case', 'catch', 'class', 'const', 'continue', 'debugger',
+    'default', 'delete', 'do', 'else', 'enum', 'export', 'extends',
+    'false', 'finally', 'for', 'function', 'if', 'implements', 'import',
+    'in', 'instanceof', 'interface', 'let', 'new', 'null', 'package',
+    'private', 'protected', 'public', 'return', 'static', 'super',
+    'switch', 'this', 'throw', 'true', 'try', 'typeof', 'var', 'void',
+    'while', 'with', 'yield',
+])
+# keywords after which a slash starts a regular expression literal.
+REGEX_AFTER_KEYWORDS = KEYWORDS - frozenset(
+    ['false', 'null', 'super', 'this', 'true'])
+# keywords with a parenthesized head, after which a regular expression
+# literal may start.
+PAREN_HEAD_KEYWORDS = frozenset(['for', 'if', 'while', 'with'])
+# tokens preceding an identifier followed by arguments that will not
+# result in a function call with that identifier.
+NOT_CALL_PRECEDING = frozenset(['.', 'function', 'new'])
+BRACKETS = {')': '(', ']': '[', '}': '{'}
+# the keywords that may end or start an expression.
+LITERAL_KEYWORDS = frozenset(['false', 'null', 'this', 'true'])
+EXPR_START_KEYWORDS = LITERAL_KEYWORDS | frozenset(
+    ['delete', 'function', 'new', 'typeof', 'void'])
+
+NAME, NUMBER, STRING, REGEX, PUNCT = (
+    'name', 'number', 'string', 'regex', 'punct')
+
+_token_re = re.compile(r"""
+    (?P<skip>\s+|//[^\n\r]*|/\*[\s\S]*?\*/)
+  | (?P<name>(?:[^\W\d]|\$)[\w$]*)
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>
+        "(?:[^"\\\n\r]|\\(?:\r\n|[\s\S]))*"
+      | '(?:[^'\\\n\r]|\\(?:\r\n|[\s\S]))*'
+    )
+  | (?P<unsupported>=>|\.\.\.|`|\\)
+  | (?P<punct>
+        >>>=|===|!==|>>>|<<=|>>=|==|!=|<=|>=|&&|\|\||\+\+|--
+      | \+=|-=|\*=|%=|&=|\|=|\^=|<<|>>|[{}()\[\];,.<>+\-*%&|^!~?:=]
+    )
+  | (?P<slash>/)
+""", re.VERBOSE | re.UNICODE)
+
+_regex_re = re.compile(
+    r'/(?:[^/\\\[\n\r]|\\.|\[(?:[^\]\\\n\r]|\\.)*\])+/[\w$]*',
+    re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Produce a 3-tuple of the list of token kinds, the list of the token
+    values and the list mapping the position of every opening bracket to
+    the position of its closing bracket, for the provided ES5 source
+    text.  Whitespaces and comments are omitted.  None is returned for
+    any text that cannot be tokenized unambiguously without parsing, and
+    also for the obvious syntax errors of consecutive expressions on the
+    same line, such that the parser will get to report them.
+    """
+
+    kinds = []
+    values = []
+    match = []
+    # the positions of the currently open brackets, along with whether
+    # each of the parentheses are the head of a statement.
+    opened = []
+    paren_heads = []
+    # whether a slash would start a regular expression literal; None if
+    # that would be ambiguous.
+    regex_ok = True
+    # whether the previous token has ended an expression, and whether a
+    # line terminator was found after it.
+    expr_end = False
+    newline = False
+    pos = 0
+    end = len(text)
+
+    while pos < end:
+        m = _token_re.match(text, pos)
+        if m is None:
+            return None
+        kind = m.lastgroup
+        value = m.group()
+        pos = m.end()
+        if kind == 'skip':
+            newline = newline or '\n' in value or '\r' in value
+            continue
+        elif kind == 'unsupported':
+            return None
+        elif kind == 'slash':
+            if regex_ok is None or text.startswith('*', pos):
+                # ambiguous, or an unterminated comment.
+                return None
+            if regex_ok:
+                m = _regex_re.match(text, pos - 1)
+                if m is None:
+                    return None
+                kind = REGEX
+                value = m.group()
+                pos = m.end()
             else:
-                logger.warning(
-                    "module '%s' required but seems to be missing", modname)
+                kind = PUNCT
+                if text.startswith('=', pos):
+                    value = '/='
+                    pos += 1
+
+        if expr_end and not newline and (kind in (NUMBER, STRING) or (
+                kind == NAME and (
+                    value not in KEYWORDS or value in EXPR_START_KEYWORDS))):
+            return None
+        newline = False
+
+        index = len(values)
+        kinds.append(kind)
+        values.append(value)
+        match.append(-1)
+
+        if kind == NAME:
+            regex_ok = value in REGEX_AFTER_KEYWORDS
+            expr_end = value not in KEYWORDS or value in LITERAL_KEYWORDS
+        elif kind != PUNCT:
+            regex_ok = False
+            expr_end = True
+        elif value in '([{':
+            paren_heads.append(value == '(' and index > 0 and (
+                values[index - 1] in PAREN_HEAD_KEYWORDS))
+            opened.append(index)
+            regex_ok = True
+            expr_end = False
+        elif value in BRACKETS:
+            if not opened or values[opened[-1]] != BRACKETS[value]:
+                return None
+            match[opened.pop()] = index
+            is_head = paren_heads.pop()
+            regex_ok = (
+                None if value == '}' else value == ')' and is_head)
+            expr_end = value == ']' or value == ')' and not is_head
+        elif value in ('++', '--'):
+            regex_ok = None
+            expr_end = False
+        else:
+            regex_ok = True
+            expr_end = False
 
-    for modname in defines.keys():
-        for mn in process_defines(modname):
-            yield mn
+    if opened:
+        return None
+    return kinds, values, match
 
 
-def extract_defines_with_deps(text):
-    tree = parse(text)
-    return list(extract_defines_with_deps_visitor([('<text>', tree)]))
+def _to_str(value):
+    # the equivalent of calmjs.interrogate.to_str for a string token.
+    return strip_slashes(strip_quotes(value))
 
 
-def extract_defines_with_deps_from_paths(paths):
-    items = []
+def _is_named_call(kinds, values, i):
+    # whether the token at i is the identifier of a function call.
+    return (
+        kinds[i] == NAME and values[i] not in KEYWORDS and
+        i + 1 < len(values) and values[i + 1] == '(' and
+        not (i and values[i - 1] in NOT_CALL_PRECEDING)
+    )
 
-    def append_tree(path, text):
-        items.append((path, parse(text)))
 
-    for path in paths:
-        process_path(path, partial(append_tree, path))
+def _function_end(values, match, i):
+    # the position of the closing brace of the function starting at i.
+    i += 1
+    if values[i] != '(':
+        i += 1
+    if values[i] != '(':
+        return None
+    i = match[i] + 1
+    if values[i] != '{':
+        return None
+    return match[i]
 
-    return list(extract_defines_with_deps_visitor(items))
+
+def _amd_names(kinds, values, match, i):
+    """
+    Return the names from the array starting at i, if it is followed by
+    a function expression as the next argument; None if the items are
+    not simple enough to be certain about.
+    """
+
+    close = match[i]
+    after = close + 1
+    if values[after] != ',' or values[after + 1] != 'function':
+        # not an array followed by a function expression.
+        return []
+    func_end = _function_end(values, match, after + 1)
+    if func_end is None:
+        return None
+    if values[func_end + 1] not in (',', ')'):
+        # the function expression is part of some other expression.
+        return []
+
+    result = []
+    for idx, pos in enumerate(range(i + 1, close, 2)):
+        if not (kinds[pos] == STRING or (
+                kinds[pos] == NAME and values[pos] not in KEYWORDS)):
+            return None
+        if values[pos + 1] not in (',', ']') or (
+                values[pos + 1] == ',' and pos + 2 == close):
+            return None
+        if kinds[pos] == STRING:
+            name = _to_str(values[pos])
+            if name not in reserved_module and (
+                    name != define_wrapped.get(idx)):
+                result.append(name)
+    return result
+
+
+def prescan_module_imports(text):
+    """
+    Return the list of module names as would be produced by
+    calmjs.interrogate.extract_module_imports for the provided text, or
+    None if that cannot be determined without parsing.
+
+    The text is always tokenized, even if it has no calls that can be
+    imports, such that the syntax errors caught by the tokenizer will
+    be reported by the parser.
+    """
+
+    tokens = tokenize(text)
+    if tokens is None:
+        return None
+    kinds, values, match = tokens
+
+    result = []
+    for i, value in enumerate(values):
+        if value not in ('require', 'define') or not _is_named_call(
+                kinds, values, i):
+            continue
+        close = match[i + 1]
+        j = i + 2
+        if j == close:
+            continue
+        if value == 'require' and kinds[j] == STRING:
+            # only a single string argument is an import.
+            if j + 1 == close:
+                result.append(_to_str(values[j]))
+            continue
+        if value == 'define' and values[j + 1] == ',' and (
+                kinds[j] == STRING or (
+                    kinds[j] == NAME and values[j] not in KEYWORDS)):
+            # the named define, with the array as the second argument.
+            j += 2
+        if values[j] != '[':
+            continue
+        names = _amd_names(kinds, values, match, j)
+        if names is None:
+            return None
+        result.extend(names)
+
+    return result
+
+
+def _require_string_arguments(kinds, values, match, i, close):
+    # equivalent to filter_function_argument(node, 'require', 0, String)
+    # for the tokens in between i and close.
+    result = []
+    while i < close:
+        if not _is_named_call(kinds, values, i):
+            i += 1
+            continue
+        end = match[i + 1]
+        if values[i] == 'require' and i + 2 < end and (
+                kinds[i + 2] == STRING and values[i + 3] in (',', ')')):
+            result.append(_to_str(values[i + 2]))
+        i = end + 1
+    return result
+
+
+def prescan_defines_records(text):
+    """
+    Return the list of define records as would be produced by the
+    function iter_defines_with_deps for the syntax tree of the provided
+    text, or None if that cannot be determined without parsing.  As with
+    prescan_module_imports, the text is always tokenized.
+    """
+
+    tokens = tokenize(text)
+    if tokens is None:
+        return None
+    return _defines_records(*tokens)
+
+
+def _defines_records(kinds, values, match):
+    result = []
+    i = 0
+    count = len(values)
+    while i < count:
+        if not _is_named_call(kinds, values, i):
+            i += 1
+            continue
+        close = match[i + 1]
+        j = i + 2
+        if values[i] == 'define' and j < close and kinds[j] == STRING and (
+                values[j + 1] in (',', ')')):
+            result.append((_to_str(values[j]), _require_string_arguments(
+                kinds, values, match, j + 1, close)))
+        # calls to named functions are not descended into.
+        i = close + 1
+
+    return result
+
+
+def extract_imports(text):
+    """
+    Return the list of module names imported by the source text, using
+    the lexical prescan where possible.
+    """
+
+    result = prescan_module_imports(text)
+    if result is None:
+        result = list(yield_module_imports(parse(text)))
+    return result
+
+
+def extract_defines_records(text):
+    """
+    Return the list of define records as produced by the function
+    iter_defines_with_deps for the provided source text, using the
+    lexical prescan where possible.
+    """
+
+    result = prescan_defines_records(text)
+    if result is None:
+        result = list(iter_defines_with_deps(parse(text)))
+    return result
+
+
+# the name of the segment maps persisted in the ResultCache.
+SEGMENTS_CACHE_NAME = 'calmjs.rjs.requirejs.segments'
+
+_segment_re = re.compile(r'^define\(', re.MULTILINE)
+
+
+def split_segments(text):
+    """
+    Split the text at every define call found at the start of a line,
+    which is where r.js places the definition of every module included
+    into an artifact.
+    """
+
+    starts = [m.start() for m in _segment_re.finditer(text)]
+    if not starts or starts[0]:
+        starts.insert(0, 0)
+    return [
+        text[start:end] for start, end in zip(starts, starts[1:] + [None])]
+
+
+def extract_defines_records_incremental(text, segments=None):
+    """
+    Return a 2-tuple of the list of define records for the provided
+    text, and the mapping of the digest of every segment of the text to
+    the define records produced by it.
+
+    Segments with their digest found in the provided mapping from some
+    previous invocation are not processed again.  Should any segment be
+    unable to be tokenized on its own (e.g. it is part of some function
+    wrapping the entire artifact), the text will be processed as a whole
+    and an empty mapping is returned.
+    """
+
+    previous = segments or {}
+    current = {}
+    result = []
+    for segment in split_segments(text):
+        digest = hashlib.sha1(segment.encode('utf-8')).hexdigest()
+        records = current.get(digest, previous.get(digest))
+        if records is None:
+            tokens = tokenize(segment)
+            if tokens is None:
+                return extract_defines_records(text), {}
+            records = _defines_records(*tokens)
+        current[digest] = records
+        result.extend(records)
+    return result, current
+
+
+def process_path_defines_records(path, cache=None):
+    """
+    Return the define records for the file at path.  If a ResultCache is
+    provided, the records of each segment of the file are persisted in
+    it also, such that only the segments that were changed since the
+    previous invocation will need to be processed again.
+    """
+
+    if cache is None:
+        return process_path(path, extract_defines_records)
+
+    key = abspath(path)
+
+    def extract_segments_defines_records(text):
+        segments = cache.get(SEGMENTS_CACHE_NAME, key)
+        records, current = extract_defines_records_incremental(
+            text, segments)
+        if segments:
+            logger.debug(
+                "reused %d of %d segments from '%s'",
+                len(set(segments) & set(current)), len(current), path)
+        cache.set(SEGMENTS_CACHE_NAME, key, current)
+        return records
+
+    return process_path(path, extract_segments_defines_records, cache=cache)
+
+
+def extract_defines_with_deps(text, cycles=None):
+    defines = {}
+    update_defines(defines, extract_defines_records(text), '<text>')
+    return order_defines(defines, cycles=cycles)
+
+
+class _MessageCollector(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+def _defines_records_worker(args):
+    # for the process pool; the log messages produced are collected and
+    # returned such that they can be emitted by the parent process.
+    path, cache = args
+    collector = _MessageCollector()
+    propagate = logger.propagate
+    logger.addHandler(collector)
+    logger.propagate = False
+    try:
+        records = process_path_defines_records(path, cache=cache)
+    finally:
+        logger.removeHandler(collector)
+        logger.propagate = propagate
+    return records, collector.messages
+
+
+def iter_paths_defines_records(paths, cache=None, processes=None):
+    """
+    Yield a 2-tuple of path and the define records extracted from the
+    file at that path, for each of the provided paths in their order.
+
+    If processes is greater than 1, the files are processed using a pool
+    of that many worker processes, with only the records being returned
+    from each of them; a value of 0 will use the number of CPUs.
+    """
+
+    paths = list(paths)
+    if processes == 0:
+        processes = multiprocessing.cpu_count()
+    if not processes or processes <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield path, process_path_defines_records(path, cache=cache)
+        return
+
+    pool = multiprocessing.Pool(min(processes, len(paths)))
+    try:
+        results = pool.imap(
+            _defines_records_worker, [(path, cache) for path in paths])
+        for path, (records, messages) in zip(paths, results):
+            for levelno, message in messages:
+                logger.log(levelno, message)
+            yield path, records
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def extract_defines_with_deps_from_paths(
+        paths, cache=None, processes=None, cycles=None):
+    """
+    Return the ordered list of module names defined in the files at the
+    provided paths, with the records extracted from each of the files
+    (and from each of their segments) stored in the ResultCache if one
+    is provided.  The circular requirements found are appended to the
+    cycles list, if provided.
+
+    The files are processed one at a time, or through a pool of worker
+    processes as specified, with only the define records being retained
+    from each of them, such that the memory usage will be bound to what
+    is required for the syntax tree of the largest files.  The records
+    are always merged in the order of the paths, such that the first
+    definition of any module will be the one used.
+    """
+
+    defines = {}
+    for path, records in iter_paths_defines_records(paths, cache, processes):
+        if records:
+            update_defines(defines, records, path)
+    return order_defines(defines, cycles=cycles)
 
 
-def process_path(path, f, encoding='utf-8'):
+def process_path(path, f, encoding='utf-8', cache=None):
     """
-    Take the path and process it through one of the above functions
+    Take the path and process it through one of the above functions,
+    through the ResultCache if one is provided.
     """
 
     try:
+        if cache is not None:
+            return cache.process(path, f, encoding=encoding)
         with codecs.open(path, encoding=encoding) as fd:
             text = fd.read()
         return f(text)
@@ -13,6 +13,8 @@ from calmjs.rjs.dist import calmjs_module_registry_methods
 from calmjs.rjs.cli import create_spec
 from calmjs.rjs.cli import default_toolchain
 from calmjs.rjs.toolchain import STUB_MISSING_WITH_EMPTY
+from calmjs.rjs.toolchain import DUPLICATE_MODULES_METHODS
+from calmjs.rjs.utils import materialize_methods
 
 
 class DeprecatedStoreAction(argparse._StoreAction):
@@ -139,6 +141,100 @@ class RJSRuntime(SourcePackageToolchainRuntime):
             help='disable indentation of transpile sources',
         )
 
+        argparser.add_argument(
+            '--size-report', default=None,
+            dest='size_report', metavar='PATH',
+            help='write a JSON report attributing the bytes of the artifact '
+                 'to its modules and their source packages to this path',
+        )
+
+        argparser.add_argument(
+            '--size-budget', default=None,
+            dest='size_budget', metavar='PATH',
+            help='a JSON file declaring the size limits for the artifact '
+                 'and/or its source packages; the build fails if any of '
+                 'them are exceeded',
+        )
+
+        argparser.add_argument(
+            '--duplicate-modules', default='ignore',
+            dest='duplicate_modules_method',
+            choices=DUPLICATE_MODULES_METHODS,
+            help='the handling method for modules with identical content '
+                 'provided under different names; report them, or alias '
+                 'them to a single canonical module (which will then be '
+                 'the same instance, sharing any state it keeps); default: '
+                 'ignore',
+        )
+
+        argparser.add_argument(
+            '--cache-dir', default=None,
+            dest='cache_dir', metavar='DIR',
+            help='directory to keep persistent state that may be reused '
+                 'across builds, such as the location of the r.js binary, '
+                 'the modules imported by every source file, and the '
+                 'registries and sourcepaths resolved for the packages',
+        )
+
+        argparser.add_argument(
+            '--materialize-method', default='copy',
+            dest='materialize_method',
+            choices=sorted(materialize_methods),
+            help='the method for placing bundled source files into the '
+                 'build directory; falls back to copy where the filesystem '
+                 'does not support the selected method; default: copy',
+        )
+
+        argparser.add_argument(
+            '--reproducible', default=False,
+            dest='reproducible', action='store_true',
+            help='produce byte identical configuration files and artifact '
+                 'for identical inputs, such that they may be cached',
+        )
+
+        argparser.add_argument(
+            '--processes', default=None, type=int,
+            dest='processes', metavar='N',
+            help='the number of worker processes for processing the '
+                 'artifacts for the test runner; 0 to use the number of '
+                 'CPUs; default is to process them in the current process',
+        )
+
+        argparser.add_argument(
+            '--define-manifest', default=False,
+            dest='define_manifest', action='store_true',
+            help='write a manifest of the modules defined by the artifact '
+                 'next to it, such that the test runner need not process '
+                 'the artifact again while it remains unchanged',
+        )
+
+        argparser.add_argument(
+            '--preload-manifest', default=False,
+            dest='preload_manifest', action='store_true',
+            help='write a manifest of every file that will be fetched for '
+                 'the artifact next to it, in the order they are required, '
+                 'such that the pages making use of the artifact may have '
+                 'them preloaded',
+        )
+
+        argparser.add_argument(
+            '--preload-config', default=None,
+            dest='preload_config', metavar='PATH',
+            help='a JSON file with the requirejs config (baseUrl, paths '
+                 'and bundles) of the pages making use of the artifact, '
+                 'for locating the files listed in the preload manifest; '
+                 'default is to locate them relative to the artifact',
+        )
+
+        argparser.add_argument(
+            '--lockfile', default=None,
+            dest='lockfile', metavar='PATH',
+            help='a lockfile for the resolved registries and sourcepaths; '
+                 'these will be reused from it for as long as the '
+                 'arguments and the contributing distributions remain '
+                 'unchanged, otherwise resolved and written to it',
+        )
+
     def create_spec(
             self, source_package_names=(), export_target=None,
             stub_missing_with_empty=False,
@@ -148,7 +244,16 @@ class RJSRuntime(SourcePackageToolchainRuntime):
             source_registry_method='all',
             sourcepath_method='all', bundlepath_method='all',
             transpile_no_indent=False,
-            toolchain=None, **kwargs):
+            size_report=None, size_budget=None,
+            duplicate_modules_method='ignore',
+            cache_dir=None,
+            materialize_method='copy',
+            reproducible=False,
+            processes=None,
+            define_manifest=False,
+            preload_manifest=False,
+            preload_config=None,
+            lockfile=None, toolchain=None, **kwargs):
         """
         Accept all arguments, but also the explicit set of arguments
         that get passed down onto the toolchain.
@@ -167,6 +272,17 @@ class RJSRuntime(SourcePackageToolchainRuntime):
             sourcepath_method=sourcepath_method,
             bundlepath_method=bundlepath_method,
             transpile_no_indent=transpile_no_indent,
+            size_report=size_report,
+            size_budget=size_budget,
+            duplicate_modules_method=duplicate_modules_method,
+            cache_dir=cache_dir,
+            materialize_method=materialize_method,
+            reproducible=reproducible,
+            processes=processes,
+            define_manifest=define_manifest,
+            preload_manifest=preload_manifest,
+            preload_config=preload_config,
+            lockfile=lockfile,
         )
 
 
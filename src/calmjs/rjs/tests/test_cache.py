@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import time
+from functools import partial
+from os.path import exists
+from os.path import join
+
+from calmjs.toolchain import Spec
+
+from calmjs.utils import pretty_logging
+
+from calmjs.rjs import cache
+
+from calmjs.testing import utils
+from calmjs.testing.mocks import StringIO
+
+
+class CacheHelpersTestCase(unittest.TestCase):
+
+    def test_hash_key(self):
+        self.assertEqual(cache.hash_key('a', 1), cache.hash_key('a', 1))
+        self.assertNotEqual(cache.hash_key('a', 1), cache.hash_key('a', 2))
+        self.assertEqual(
+            cache.hash_key({'a': 1, 'b': 2}), cache.hash_key({'b': 2, 'a': 1}))
+
+    def test_read_write_json(self):
+        tmpdir = utils.mkdtemp(self)
+        target = join(tmpdir, 'nested', 'value.json')
+        self.assertIsNone(cache.read_json(target))
+        cache.write_json(target, {'value': [1, 2]})
+        self.assertEqual(cache.read_json(target), {'value': [1, 2]})
+        # no leftover temporary files.
+        self.assertEqual(os.listdir(join(tmpdir, 'nested')), ['value.json'])
+
+    def test_read_json_corrupted(self):
+        tmpdir = utils.mkdtemp(self)
+        target = join(tmpdir, 'value.json')
+        with open(target, 'w') as fd:
+            fd.write('{')
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(cache.read_json(target))
+        self.assertIn('ignoring corrupted cache file', s.getvalue())
+
+    def test_write_text(self):
+        tmpdir = utils.mkdtemp(self)
+        target = join(tmpdir, 'nested', 'value.js')
+        cache.write_text(target, u'var value = "\u00e9";')
+        with open(target, 'rb') as fd:
+            self.assertEqual(fd.read(), b'var value = "\xc3\xa9";')
+        self.assertEqual(os.listdir(join(tmpdir, 'nested')), ['value.js'])
+
+    def test_store_file(self):
+        tmpdir = utils.mkdtemp(self)
+        source = join(tmpdir, 'source')
+        with open(source, 'w') as fd:
+            fd.write('data')
+        target = join(tmpdir, 'nested', 'target')
+        cache.store_file(source, target)
+        with open(target) as fd:
+            self.assertEqual(fd.read(), 'data')
+        self.assertEqual(os.listdir(join(tmpdir, 'nested')), ['target'])
+
+        with self.assertRaises(IOError):
+            cache.store_file(join(tmpdir, 'missing'), target)
+        self.assertEqual(os.listdir(join(tmpdir, 'nested')), ['target'])
+
+    def test_stat_fingerprint(self):
+        tmpdir = utils.mkdtemp(self)
+        target = join(tmpdir, 'file')
+        self.assertIsNone(cache.stat_fingerprint(target))
+        with open(target, 'w') as fd:
+            fd.write('data')
+        self.assertEqual(cache.stat_fingerprint(target)[0], 4)
+
+
+class StateCacheTestCase(unittest.TestCase):
+
+    def test_state_cache_set_get(self):
+        tmpdir = utils.mkdtemp(self)
+        tracked = join(tmpdir, 'tracked')
+        with open(tracked, 'w') as fd:
+            fd.write('1')
+
+        state_cache = cache.StateCache(join(tmpdir, 'cache'))
+        self.assertIsNone(state_cache.get('key'))
+        state_cache.set('key', {'value': 1}, files=[tracked])
+        self.assertTrue(exists(join(tmpdir, 'cache', 'state.json')))
+        self.assertEqual(state_cache.get('key'), {'value': 1})
+        # a fresh instance will read the same thing.
+        self.assertEqual(
+            cache.StateCache(join(tmpdir, 'cache')).get('key'), {'value': 1})
+
+        with open(tracked, 'w') as fd:
+            fd.write('changed')
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(state_cache.get('key'))
+        self.assertIn("invalidated by changes to '%s'" % tracked, s.getvalue())
+
+    def test_state_cache_removed_file(self):
+        tmpdir = utils.mkdtemp(self)
+        tracked = join(tmpdir, 'tracked')
+        with open(tracked, 'w') as fd:
+            fd.write('1')
+        state_cache = cache.StateCache(tmpdir)
+        state_cache.set('key', 'value', files=[tracked])
+        os.remove(tracked)
+        self.assertIsNone(state_cache.get('key'))
+
+
+calls = []
+
+
+def upper(text):
+    calls.append(text)
+    return [text.upper()]
+
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = utils.mkdtemp(self)
+        self.cache_dir = join(self.tmpdir, 'cache')
+        self.source = join(self.tmpdir, 'source.js')
+        with open(self.source, 'w') as fd:
+            fd.write('source')
+        calls[:] = []
+
+    def test_process_cached(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        self.assertEqual(result_cache.process(self.source, upper), ['SOURCE'])
+        self.assertEqual(result_cache.process(self.source, upper), ['SOURCE'])
+        # a new instance shares the same persisted results.
+        self.assertEqual(cache.ResultCache(self.cache_dir).process(
+            self.source, upper), ['SOURCE'])
+        self.assertEqual(calls, ['source'])
+
+    def test_process_content_fallback(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        result_cache.process(self.source, upper)
+        # a copy elsewhere with identical content.
+        other = join(self.tmpdir, 'other.js')
+        with open(other, 'w') as fd:
+            fd.write('source')
+        self.assertEqual(result_cache.process(other, upper), ['SOURCE'])
+        self.assertEqual(calls, ['source'])
+
+        with open(self.source, 'w') as fd:
+            fd.write('changed')
+        self.assertEqual(result_cache.process(self.source, upper), ['CHANGED'])
+        self.assertEqual(calls, ['source', 'changed'])
+
+    def test_process_version(self):
+        cache.ResultCache(self.cache_dir, version='1').process(
+            self.source, upper)
+        cache.ResultCache(self.cache_dir, version='2').process(
+            self.source, upper)
+        self.assertEqual(calls, ['source', 'source'])
+
+    def test_process_not_cached(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        # partials are not identifiable
+        f = partial(upper)
+        result_cache.process(self.source, f)
+        result_cache.process(self.source, f)
+        self.assertEqual(calls, ['source', 'source'])
+
+        # neither are values that cannot be serialized.
+        def unserializable(text):
+            calls.append(text)
+            return object()
+
+        result_cache.process(self.source, unserializable)
+        result_cache.process(self.source, unserializable)
+        self.assertEqual(len(calls), 4)
+
+    def test_process_errors(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        with self.assertRaises(IOError):
+            result_cache.process(join(self.tmpdir, 'missing.js'), upper)
+
+        def fail(text):
+            raise SyntaxError('bad')
+
+        with self.assertRaises(SyntaxError):
+            result_cache.process(self.source, fail)
+
+    def test_get_set(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        self.assertIsNone(result_cache.get('name', 'key'))
+        result_cache.set('name', 'key', {'a': [1]})
+        self.assertEqual(result_cache.get('name', 'key'), {'a': [1]})
+        self.assertIsNone(result_cache.get('other', 'key'))
+        self.assertIsNone(cache.ResultCache(
+            self.cache_dir, version='other').get('name', 'key'))
+
+    def test_get_set_file(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        self.assertIsNone(result_cache.get_file('name', 'key'))
+        path = result_cache.set_file('name', 'key', self.source)
+        self.assertTrue(path.startswith(self.cache_dir))
+        self.assertEqual(result_cache.get_file('name', 'key'), path)
+        with open(path) as fd:
+            self.assertEqual(fd.read(), 'source')
+        self.assertIsNone(result_cache.get_file('other', 'key'))
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(result_cache.set_file(
+                'name', 'key', join(self.tmpdir, 'missing.js')))
+        self.assertIn('failed to store', s.getvalue())
+
+    def test_prune(self):
+        result_cache = cache.ResultCache(self.cache_dir)
+        result_cache.process(self.source, upper)
+        entries = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            entries.extend(join(root, name) for name in names)
+        self.assertEqual(len(entries), 2)
+        # make the first entry the least recently used.
+        old = time.time() - 100
+        os.utime(entries[0], (old, old))
+        result_cache.max_size = os.stat(entries[1]).st_size
+        result_cache.prune()
+        self.assertFalse(exists(entries[0]))
+        self.assertTrue(exists(entries[1]))
+
+    def test_prune_interval(self):
+        result_cache = cache.ResultCache(self.cache_dir, max_size=0)
+        pruned = []
+        utils.stub_item_attr_value(
+            self, result_cache, 'prune', lambda: pruned.append(
+                result_cache.written))
+        # the first write of an instance does not prune.
+        result_cache.set('name', 'key', 'value')
+        self.assertEqual(pruned, [])
+        for idx in range(cache.RESULT_CACHE_PRUNE_INTERVAL):
+            result_cache.set('name', idx, 'value')
+        self.assertEqual(pruned, [cache.RESULT_CACHE_PRUNE_INTERVAL])
+
+    def test_version(self):
+        result_cache = cache.ResultCache(self.cache_dir, version='1')
+        self.assertEqual(result_cache.version, [
+            cache.RESULT_CACHE_VERSION, '1',
+            cache.get_dist_version('calmjs.rjs')])
+
+    def test_get_result_cache(self):
+        self.assertIsNone(cache.get_result_cache(Spec()))
+        spec = Spec(rjs_cache_dir=self.cache_dir)
+        result_cache = cache.get_result_cache(spec)
+        self.assertEqual(
+            result_cache.cache_dir, join(self.cache_dir, 'results'))
+        # the same instance is kept for the spec.
+        self.assertIs(cache.get_result_cache(spec), result_cache)
+        spec['rjs_cache_dir'] = join(self.cache_dir, 'other')
+        other = cache.get_result_cache(spec)
+        self.assertIsNot(other, result_cache)
+        self.assertEqual(
+            other.cache_dir, join(self.cache_dir, 'other', 'results'))
@@ -102,3 +102,12 @@ class CliTestCase(unittest.TestCase):
         self.assertIn('no packages specified', stream.getvalue())
         self.assertTrue(isinstance(spec, Spec))
         self.assertTrue(spec['transpile_no_indent'])
+
+    def test_toolchain_size_report_budget(self):
+        with pretty_logging(stream=StringIO()):
+            spec = compile_all(
+                [], toolchain=dict,
+                size_report='report.json', size_budget='budget.json')
+
+        self.assertEqual(spec['size_report'], 'report.json')
+        self.assertEqual(spec['size_budget'], 'budget.json')
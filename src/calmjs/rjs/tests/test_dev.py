@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import unittest
 import json
+import os
 from codecs import open
 from os.path import exists
 from os.path import join
+from os.path import realpath
 
 # This is for emulating absent calmjs.dev module
 try:
@@ -23,9 +25,15 @@ from calmjs.registry import get
 from calmjs.toolchain import Spec
 from calmjs.utils import pretty_logging
 
+from calmjs.rjs import dev
+from calmjs.rjs.cache import RESULT_CACHE_PRUNE_INTERVAL
+from calmjs.rjs.cache import ResultCache
 from calmjs.rjs.dev import karma_requirejs
 from calmjs.rjs.dev import process_artifacts
+from calmjs.rjs.cache import stat_fingerprint
+from calmjs.rjs.manifest import write_define_manifest
 from calmjs.rjs.registry import RJS_LOADER_PLUGIN_REGISTRY_NAME
+from calmjs.rjs import requirejs
 
 from calmjs.testing.mocks import StringIO
 from calmjs.testing.utils import mkdtemp
@@ -88,6 +96,341 @@ class ProcessArtifactsTestCase(unittest.TestCase):
         self.assertIn('syntax error in', s.getvalue())
         self.assertIn(source2, s.getvalue())
 
+    def test_process_paths_define_manifest(self):
+        build_dir = mkdtemp(self)
+        source1 = join(build_dir, 'source1.js')
+        source2 = join(build_dir, 'source2.js')
+        with open(source1, 'w') as fd:
+            fd.write(
+                "define('source1/mod1', ['require'], function (require) {\n"
+                "    require('source2/mod1');\n"
+                "});\n"
+            )
+        with open(source2, 'w') as fd:
+            fd.write("define('source2/mod1', [], function () {});\n")
+        expected = process_artifacts([source1, source2])
+        self.assertEqual(expected, ['source2/mod1', 'source1/mod1'])
+        write_define_manifest(source1)
+
+        processed = []
+
+        def process_path_defines_records(path, cache=None):
+            processed.append(path)
+            return [('source2/mod1', [])]
+
+        stub_item_attr_value(
+            self, requirejs, 'process_path_defines_records',
+            process_path_defines_records)
+        with pretty_logging(
+                logger='calmjs.rjs', level='DEBUG', stream=StringIO()) as s:
+            self.assertEqual(
+                expected, process_artifacts([source1, source2]))
+        # only the artifact without a manifest is processed.
+        self.assertEqual(processed, [source2])
+        self.assertIn('processing 1 of 2 artifacts', s.getvalue())
+
+
+class WriteIfChangedTestCase(unittest.TestCase):
+
+    def test_write_if_changed(self):
+        target = join(mkdtemp(self), 'script.js')
+        self.assertTrue(dev.write_if_changed(target, 'var a = 1;'))
+        os.utime(target, (0, 0))
+        self.assertFalse(dev.write_if_changed(target, 'var a = 1;'))
+        self.assertEqual(os.stat(target).st_mtime, 0)
+        self.assertTrue(dev.write_if_changed(target, 'var a = 2;'))
+        with open(target, encoding='utf-8') as fd:
+            self.assertEqual(fd.read(), 'var a = 2;')
+
+
+class ShardsTestCase(unittest.TestCase):
+
+    def test_get_module_paths(self):
+        build_dir = mkdtemp(self)
+        with open(join(build_dir, 'mod.js'), 'w') as fd:
+            fd.write("define(['dep'], function(dep) {});")
+        spec = Spec(
+            build_dir=build_dir,
+            transpiled_modpaths={'mod': 'mod', 'missing': 'missing'},
+            transpiled_targetpaths={
+                'mod': 'mod.js', 'missing': 'missing.js'},
+            bundled_modpaths={'stubbed': 'empty:'},
+            bundled_targetpaths={'stubbed': 'stubbed.js'},
+            test_module_paths_map={'test_mod': '/src/test_mod.js'},
+        )
+        paths = dev.get_module_paths(spec)
+        self.assertEqual(paths, {
+            'mod': join(build_dir, 'mod.js'),
+            'test_mod': '/src/test_mod.js',
+        })
+        with pretty_logging(stream=StringIO()):
+            self.assertEqual(dev.get_module_imports(paths), {
+                'mod': ['dep'],
+                'test_mod': [],
+            })
+
+    def test_load_test_durations(self):
+        tmpdir = mkdtemp(self)
+        path = join(tmpdir, 'durations.json')
+        self.assertEqual(dev.load_test_durations(None), {})
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(dev.load_test_durations(path), {})
+        self.assertIn('failed to load test durations', s.getvalue())
+
+        with open(path, 'w') as fd:
+            json.dump([], fd)
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(dev.load_test_durations(path), {})
+        self.assertIn('is not a mapping', s.getvalue())
+
+        with open(path, 'w') as fd:
+            json.dump({'test_a': 1.5}, fd)
+        self.assertEqual(dev.load_test_durations(path), {'test_a': 1.5})
+
+    def test_partition_tests_durations(self):
+        tests = ['test_a', 'test_b', 'test_c', 'test_d']
+        self.assertEqual(dev.partition_tests(tests, 2, {
+            'test_a': 10, 'test_b': 6, 'test_c': 5, 'test_d': 1,
+        }), [['test_a', 'test_d'], ['test_b', 'test_c']])
+        # unknown durations are assumed to be the average.
+        self.assertEqual(dev.partition_tests(tests, 2, {
+            'test_a': 9, 'test_b': 3,
+        }), [['test_a', 'test_b'], ['test_c', 'test_d']])
+        self.assertEqual(
+            dev.partition_tests(tests, 3),
+            [['test_a', 'test_d'], ['test_b'], ['test_c']])
+
+    def test_partition_tests_imports(self):
+        tests = ['test_a', 'test_b', 'test_c', 'test_d']
+        imports = {
+            'test_a': ['lib1'],
+            'test_b': ['lib2'],
+            'test_c': ['lib1'],
+            'test_d': ['lib2'],
+            'lib2': ['lib3'],
+        }
+        # the tests sharing the same imports are kept together.
+        self.assertEqual(
+            dev.partition_tests(tests, 2, imports=imports),
+            [['test_a', 'test_c'], ['test_b', 'test_d']])
+
+    def test_partition_tests_fewer(self):
+        self.assertEqual(dev.partition_tests(['test_a'], 4), [['test_a']])
+        self.assertEqual(dev.partition_tests([], 4), [])
+
+
+class SelectChangedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(self)
+        self.lib = join(self.tmpdir, 'lib.js')
+        self.test_lib = join(self.tmpdir, 'test_lib.js')
+        for path in (self.lib, self.test_lib):
+            with open(path, 'w') as fd:
+                fd.write('')
+        self.spec = Spec(
+            transpile_sourcepath={
+                'lib': self.lib,
+                'missing': join(self.tmpdir, 'missing.js'),
+            },
+            bundle_sourcepath={'stubbed': 'empty:'},
+            test_module_paths_map={'test_lib': self.test_lib},
+        )
+
+    def test_get_source_modules(self):
+        self.assertEqual(dev.get_source_modules(self.spec), {
+            realpath(self.lib): ['lib'],
+            realpath(self.test_lib): ['test_lib'],
+        })
+
+    def test_find_changed_files_explicit(self):
+        self.spec['karma_changed_files'] = [self.lib]
+        self.assertEqual(dev.find_changed_files(self.spec, {}), [
+            realpath(self.lib)])
+
+    def test_find_changed_files_recorded(self):
+        sources = dev.get_source_modules(self.spec)
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(dev.find_changed_files(self.spec, sources))
+        self.assertIn('no cache directory specified', s.getvalue())
+
+        self.spec['rjs_cache_dir'] = join(self.tmpdir, 'cache')
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(dev.find_changed_files(self.spec, sources))
+        self.assertIn('no record of a previous successful', s.getvalue())
+
+        fingerprints = {path: stat_fingerprint(path) for path in sources}
+        # nothing recorded for a failed run.
+        self.spec['karma_return_code'] = 1
+        dev.record_sources(self.spec, fingerprints)
+        with pretty_logging(stream=StringIO()):
+            self.assertIsNone(dev.find_changed_files(self.spec, sources))
+
+        self.spec['karma_return_code'] = 0
+        dev.record_sources(self.spec, fingerprints)
+        self.assertEqual(dev.find_changed_files(self.spec, sources), [])
+        with open(self.lib, 'w') as fd:
+            fd.write('var lib = 1;')
+        self.assertEqual(dev.find_changed_files(self.spec, sources), [
+            realpath(self.lib)])
+
+    def test_select_tests(self):
+        tests = ['test_a', 'test_b', 'test_c']
+        imports = {
+            'test_a': ['lib1'],
+            'test_b': ['lib2'],
+            'lib2': ['lib3'],
+        }
+        self.assertEqual(dev.select_tests(tests, imports, ['lib3']), [
+            'test_b'])
+        self.assertEqual(dev.select_tests(tests, imports, ['test_c']), [
+            'test_c'])
+        self.assertEqual(dev.select_tests(tests, imports, []), [])
+
+
+class MinimalDepsTestCase(unittest.TestCase):
+
+    def test_minimal_deps(self):
+        graph = {
+            'test_a': ['app', 'text!data.txt'],
+            'test_b': ['lib2'],
+            'app': ['lib2', 'lib1'],
+            'lib1': ['lib2'],
+            'lib2': [],
+            'lib3': [],
+        }
+        modnames = {'app', 'lib1', 'lib2', 'lib3', 'text!data.txt'}
+        self.assertEqual(dev.minimal_deps(['test_a'], graph, modnames), [
+            'lib2', 'lib1', 'app', 'text!data.txt'])
+        self.assertEqual(dev.minimal_deps(['test_b'], graph, modnames), [
+            'lib2'])
+        self.assertEqual(dev.minimal_deps([], graph, modnames), [])
+
+    def test_minimal_deps_cycles(self):
+        graph = {'test_a': ['a'], 'a': ['b'], 'b': ['a']}
+        self.assertEqual(
+            dev.minimal_deps(['test_a'], graph, {'a', 'b'}), ['b', 'a'])
+
+
+class KarmaBundleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = mkdtemp(self)
+        self.spec = self.make_spec(self.build_dir)
+        self.calls = []
+
+        def call(args):
+            self.calls.append(args)
+            config = dev.read_build_manifest(args[2])
+            with open(config['out'], 'w') as fd:
+                fd.write('// %s\n' % ' '.join(config['include']))
+            self.config = config
+            return 0
+
+        stub_item_attr_value(self, dev, 'call', call)
+
+    def make_spec(self, build_dir):
+        for name in ('lib', 'app'):
+            with open(join(build_dir, name + '.js'), 'w') as fd:
+                fd.write("define(['require'], function(require) {});")
+        build_manifest_path = join(build_dir, 'build.js')
+        with open(build_manifest_path, 'w') as fd:
+            fd.write('(\n')
+            json.dump({
+                'baseUrl': build_dir,
+                'paths': {'stubbed': 'empty:'},
+                'out': join(build_dir, 'export.js'),
+                'include': ['lib', 'app'],
+            }, fd)
+            fd.write('\n)')
+        return Spec(
+            build_dir=build_dir,
+            build_manifest_path=build_manifest_path,
+            toolchain_bin_path='r.js',
+            transpiled_modpaths={'lib': 'lib', 'app': 'app'},
+            transpiled_targetpaths={'lib': 'lib.js', 'app': 'app.js'},
+            test_module_paths_map={'test_app': '/src/test_app.js'},
+        )
+
+    def test_build_karma_bundle(self):
+        with pretty_logging(stream=StringIO()):
+            bundle = dev.build_karma_bundle(
+                self.spec, ['lib', 'app', 'vendor', 'test_app'])
+        self.assertEqual(bundle, join(self.build_dir, 'karma_test_bundle.js'))
+        self.assertEqual(len(self.calls), 1)
+        # the test modules are linked in from where they reside.
+        self.assertEqual(self.config['include'], ['lib', 'app', 'test_app'])
+        self.assertEqual(self.config['baseUrl'], self.build_dir)
+        self.assertEqual(self.config['paths'], {
+            'stubbed': 'empty:',
+            'vendor': 'empty:',
+            'test_app': '/src/test_app',
+        })
+
+    def test_build_karma_bundle_unavailable(self):
+        with pretty_logging(stream=StringIO()):
+            self.assertIsNone(dev.build_karma_bundle(self.spec, ['vendor']))
+        self.spec.pop('toolchain_bin_path')
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(dev.build_karma_bundle(self.spec, ['lib']))
+        self.assertIn('unable to build bundle', s.getvalue())
+        self.assertEqual(self.calls, [])
+
+    def test_build_karma_bundle_failure(self):
+        stub_item_attr_value(self, dev, 'call', lambda args: 1)
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(dev.build_karma_bundle(self.spec, ['lib']))
+        self.assertIn('r.js exited with return code 1', s.getvalue())
+
+    def test_build_karma_bundle_cached(self):
+        cache_dir = mkdtemp(self)
+        self.spec['rjs_cache_dir'] = cache_dir
+        with pretty_logging(stream=StringIO()):
+            bundle = dev.build_karma_bundle(self.spec, ['lib', 'app'])
+            self.assertEqual(len(self.calls), 1)
+            os.remove(bundle)
+            reused = dev.build_karma_bundle(self.spec, ['lib', 'app'])
+            self.assertEqual(len(self.calls), 1)
+        self.assertEqual(bundle, reused)
+        with open(reused) as fd:
+            self.assertEqual(fd.read(), '// lib app\n')
+
+        # a build with identical content in a different build directory
+        # will reuse the same bundle.
+        build_dir = mkdtemp(self)
+        spec = self.make_spec(build_dir)
+        spec['rjs_cache_dir'] = cache_dir
+        with pretty_logging(stream=StringIO()) as s:
+            bundle = dev.build_karma_bundle(spec, ['lib', 'app'])
+        self.assertEqual(len(self.calls), 1)
+        self.assertIn('reusing test bundle', s.getvalue())
+        self.assertEqual(bundle, join(build_dir, 'karma_test_bundle.js'))
+        with open(bundle) as fd:
+            self.assertEqual(fd.read(), '// lib app\n')
+
+        # a change to any module in the build directory.
+        with open(join(self.build_dir, 'lib.js'), 'w') as fd:
+            fd.write("define([], function() {});")
+        with pretty_logging(stream=StringIO()):
+            dev.build_karma_bundle(self.spec, ['lib', 'app'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.config['baseUrl'], self.build_dir)
+
+    def test_build_karma_bundle_cache_pruned(self):
+        cache_dir = self.spec['rjs_cache_dir'] = mkdtemp(self)
+        result_cache = ResultCache(cache_dir, max_size=0)
+        # the write that is due for the pruning.
+        result_cache.written = RESULT_CACHE_PRUNE_INTERVAL
+        stub_item_attr_value(
+            self, dev, 'get_result_cache', lambda spec: result_cache)
+        with pretty_logging(stream=StringIO()):
+            dev.build_karma_bundle(self.spec, ['lib', 'app'])
+        # the result cache is kept within its size limit.
+        self.assertEqual([
+            name for root, dirs, names in os.walk(cache_dir)
+            for name in names
+        ], [])
+
 
 class KarmaAbsentTestCase(unittest.TestCase):
     """
@@ -213,3 +556,284 @@ class KarmaTestCase(unittest.TestCase):
         self.assertEqual(['example/package/tests/test_some_module'], tests)
         self.assertEqual(
             ['preexported', 'example/package/tests/some_test_data'], deps)
+
+    def test_karma_shards(self):
+        build_dir = mkdtemp(self)
+        karma_config = karma.build_base_config()
+        karma_config['files'] = ['example/package/lib.js']
+        test_module_paths_map = {}
+        for name in ('test_a', 'test_b', 'test_c'):
+            path = test_module_paths_map['example/package/tests/' + name] = (
+                join(build_dir, name + '.js'))
+            with open(path, 'w') as fd:
+                fd.write("require('example/package/lib');\n")
+        spec = Spec(
+            karma_config=karma_config,
+            build_dir=build_dir,
+            artifact_paths=['/artifact.js'],
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            export_module_names=['example/package/lib'],
+            test_module_paths_map=test_module_paths_map,
+            karma_shards=2,
+        )
+        stub_item_attr_value(
+            self, dev, 'process_artifacts_defines', lambda *a, **kw: {})
+
+        with pretty_logging(stream=StringIO()) as s:
+            karma_requirejs(spec)
+        self.assertIn('wrote 2 karma shard configuration(s)', s.getvalue())
+
+        shards = spec['karma_requirejs_test_shards']
+        self.assertEqual(shards, [
+            join(build_dir, 'karma.conf.0.js'),
+            join(build_dir, 'karma.conf.1.js'),
+        ])
+        # the main configuration remains unchanged.
+        self.assertEqual(
+            spec['karma_config']['files'][1],
+            spec['karma_requirejs_test_script'])
+
+        tests = []
+        for idx, shard in enumerate(shards):
+            with open(shard, encoding='utf-8') as fd:
+                text = fd.read()
+            script_path = join(build_dir, 'karma_test_init.%d.js' % idx)
+            self.assertIn(json.dumps(script_path), text)
+            self.assertIn('"/artifact.js"', text)
+            self.assertIn('"port": %d' % (9876 + idx), text)
+            self.assertNotIn(
+                json.dumps(spec['karma_requirejs_test_script']), text)
+            with open(script_path, encoding='utf-8') as fd:
+                script = es5(fd.read())
+            deps = json.loads(
+                str(script.children()[0].children()[0].initializer))
+            self.assertEqual(['example/package/lib'], deps)
+            tests.extend(json.loads(
+                str(script.children()[1].children()[0].initializer)))
+        self.assertEqual(sorted(tests), sorted(test_module_paths_map))
+
+    def test_karma_select_changed(self):
+        build_dir = mkdtemp(self)
+        karma_config = karma.build_base_config()
+        test_module_paths_map = {}
+        for name, source in (
+                ('test_a', "require('lib_a');"),
+                ('test_b', "require('lib_b');"),
+                ('lib_a', ''),
+                ('lib_b', '')):
+            path = join(build_dir, name + '.js')
+            with open(path, 'w') as fd:
+                fd.write(source)
+            test_module_paths_map[name] = path
+        spec = Spec(
+            karma_config=karma_config,
+            build_dir=build_dir,
+            rjs_cache_dir=join(build_dir, 'cache'),
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            test_module_paths_map=test_module_paths_map,
+            karma_changed_files=[join(build_dir, 'lib_b.js')],
+        )
+
+        with pretty_logging(stream=StringIO()) as s:
+            karma_requirejs(spec)
+        self.assertIn(
+            'selected 1 of 2 test module(s) affected by 1 changed file(s)',
+            s.getvalue())
+        with open(spec['karma_requirejs_test_script'], encoding='utf-8') as fd:
+            script = es5(fd.read())
+        tests = json.loads(str(script.children()[1].children()[0].initializer))
+        self.assertEqual(['test_b'], tests)
+        self.assertNotIn('failOnEmptyTestSuite', spec['karma_config'])
+
+        # the fingerprints are recorded after a successful run.
+        spec['karma_return_code'] = 0
+        spec.handle(karma.AFTER_KARMA)
+        spec = Spec(
+            karma_config=karma.build_base_config(),
+            build_dir=build_dir,
+            rjs_cache_dir=join(build_dir, 'cache'),
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            test_module_paths_map=test_module_paths_map,
+            karma_select_changed=True,
+        )
+        with pretty_logging(stream=StringIO()) as s:
+            karma_requirejs(spec)
+        self.assertIn('selected 0 of 2 test module(s)', s.getvalue())
+        self.assertFalse(spec['karma_config']['failOnEmptyTestSuite'])
+
+    def test_karma_minimal_deps(self):
+        build_dir = mkdtemp(self)
+        artifact = join(build_dir, 'artifact.js')
+        with open(artifact, 'w') as fd:
+            fd.write(
+                "define('vendor/base', [], function() {});\n"
+                "define('vendor/lib', ['require'], function(require) {\n"
+                "    require('vendor/base');\n"
+                "});\n"
+                "define('vendor/unused', [], function() {});\n"
+            )
+        test_module_paths_map = {}
+        for name, source in (
+                ('test_a', "require('lib_a');"),
+                ('lib_a', "require('vendor/lib');"),
+                ('lib_b', '')):
+            path = join(build_dir, name + '.js')
+            with open(path, 'w') as fd:
+                fd.write(source)
+            test_module_paths_map[name] = path
+        spec = Spec(
+            karma_config=karma.build_base_config(),
+            build_dir=build_dir,
+            artifact_paths=[artifact],
+            export_module_names=['exported'],
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            test_module_paths_map=test_module_paths_map,
+            karma_minimal_deps=True,
+        )
+
+        with pretty_logging(stream=StringIO()) as s:
+            karma_requirejs(spec)
+        self.assertIn(
+            'preloading 3 of 6 modules required by the test modules',
+            s.getvalue())
+        with open(spec['karma_requirejs_test_script'], encoding='utf-8') as fd:
+            script = es5(fd.read())
+        deps = json.loads(str(script.children()[0].children()[0].initializer))
+        self.assertEqual(['vendor/base', 'vendor/lib', 'lib_a'], deps)
+        self.assertEqual(spec['karma_requirejs_artifact_cycles'], [])
+
+    def test_karma_artifact_cycles(self):
+        build_dir = mkdtemp(self)
+        artifact = join(build_dir, 'artifact.js')
+        with open(artifact, 'w') as fd:
+            fd.write(
+                "define('vendor/a', ['require'], function(require) {\n"
+                "    require('vendor/b');\n"
+                "});\n"
+                "define('vendor/b', ['require'], function(require) {\n"
+                "    require('vendor/a');\n"
+                "});\n"
+            )
+        spec = Spec(
+            karma_config=karma.build_base_config(),
+            build_dir=build_dir,
+            artifact_paths=[artifact],
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+        )
+        with pretty_logging(stream=StringIO()) as s:
+            karma_requirejs(spec)
+        self.assertIn('circular dependency between modules', s.getvalue())
+        self.assertEqual(
+            spec['karma_requirejs_artifact_cycles'],
+            [['vendor/a', 'vendor/b']])
+
+    def test_karma_bundle(self):
+        build_dir = mkdtemp(self)
+        src_dir = mkdtemp(self)
+        lib_js = join(build_dir, 'lib.js')
+        other_js = join(build_dir, 'other.js')
+        test_lib_js = join(src_dir, 'test_lib.js')
+        data_txt = join(src_dir, 'data.txt')
+        for path in (lib_js, other_js, test_lib_js, data_txt):
+            with open(path, 'w') as fd:
+                fd.write("define([], function() {});")
+        with open(join(build_dir, 'build.js'), 'w') as fd:
+            fd.write('(\n{"paths": {}}\n)')
+        karma_config = karma.build_base_config()
+        karma_config['files'] = [lib_js, other_js, test_lib_js, data_txt]
+        karma_config['preprocessors'] = {other_js: ['coverage']}
+        spec = Spec(
+            karma_config=karma_config,
+            build_dir=build_dir,
+            build_manifest_path=join(build_dir, 'build.js'),
+            toolchain_bin_path='r.js',
+            export_module_names=['lib', 'other'],
+            transpiled_modpaths={'lib': 'lib', 'other': 'other'},
+            transpiled_targetpaths={'lib': 'lib.js', 'other': 'other.js'},
+            test_module_paths_map={
+                'test_lib': test_lib_js,
+                'text!data.txt': data_txt,
+            },
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            karma_bundle=True,
+        )
+        includes = []
+
+        def call(args):
+            includes.extend(dev.read_build_manifest(args[2])['include'])
+            with open(join(build_dir, 'karma_test_bundle.js'), 'w') as fd:
+                fd.write('')
+            return 0
+
+        stub_item_attr_value(self, dev, 'call', call)
+        with pretty_logging(stream=StringIO()):
+            karma_requirejs(spec)
+
+        self.assertEqual(includes, ['lib', 'other', 'test_lib'])
+        # only the test script is loaded outside of the bundle, with the
+        # bundled modules no longer served other than the preprocessed.
+        self.assertEqual(spec['karma_config']['files'], [
+            spec['karma_requirejs_test_config'],
+            join(build_dir, 'karma_test_bundle.js'),
+            spec['karma_requirejs_test_script'],
+            {'pattern': other_js, 'included': False},
+            {'pattern': data_txt, 'included': False},
+        ])
+
+    def test_karma_coverage_cache(self):
+        build_dir = mkdtemp(self)
+        cache_dir = mkdtemp(self)
+        karma_config = karma.build_base_config()
+        karma_config['files'] = ['lib.js', 'text.txt']
+        karma_config['preprocessors'] = {
+            'lib.js': ['coverage'],
+            'other.js': ['coverage'],
+        }
+        spec = Spec(
+            karma_config=karma_config,
+            build_dir=build_dir,
+            rjs_cache_dir=cache_dir,
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            transpiled_targetpaths={'lib': 'lib.js', 'other': 'other.js'},
+            coverage_enable=True,
+            karma_coverage_cache=True,
+        )
+        instrumented = join(build_dir, 'instrumented', 'lib.js')
+
+        def instrument_paths(paths, cache, build_dir_, working_dir):
+            self.assertEqual(sorted(paths), [
+                join(build_dir, 'lib.js'), join(build_dir, 'other.js')])
+            # only one of them got instrumented.
+            return {join(build_dir, 'lib.js'): instrumented}
+
+        stub_item_attr_value(self, dev, 'instrument_paths', instrument_paths)
+        with pretty_logging(stream=StringIO()):
+            karma_requirejs(spec)
+
+        self.assertEqual(karma_config['preprocessors'], {
+            'other.js': ['coverage'],
+        })
+        self.assertEqual(karma_config['files'][-1], {
+            'pattern': instrumented, 'included': False})
+        with open(spec['karma_requirejs_test_config'], encoding='utf-8') as fd:
+            self.assertIn(json.dumps(
+                '/absolute' + '/'.join(instrumented[:-3].split(os.sep))),
+                fd.read())
+
+    def test_karma_coverage_cache_no_cache_dir(self):
+        karma_config = karma.build_base_config()
+        karma_config['preprocessors'] = {'lib.js': ['coverage']}
+        spec = Spec(
+            karma_config=karma_config,
+            build_dir=mkdtemp(self),
+            rjs_loader_plugin_registry=get(RJS_LOADER_PLUGIN_REGISTRY_NAME),
+            transpiled_targetpaths={'lib': 'lib.js'},
+            coverage_enable=True,
+            karma_coverage_cache=True,
+        )
+        with pretty_logging(stream=StringIO()) as s:
+            karma_requirejs(spec)
+        self.assertIn('no cache directory specified', s.getvalue())
+        self.assertEqual(karma_config['preprocessors'], {
+            'lib.js': ['coverage'],
+        })
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 import unittest
+import os
+from collections import OrderedDict
 from os.path import join
+
+from pkg_resources import Requirement
+
 from calmjs.utils import pretty_logging
 from calmjs.rjs import dist
 
@@ -70,6 +75,33 @@ class DistIntegrationTestCase(unittest.TestCase):
             ['forms/ui']
         )
 
+    def test_explicit_module_registry_dependencies_identical(self):
+        # the single pass must produce the same map as the two passes
+        # through the functions in the sourcepath_methods_list.
+        registries = [
+            self.registry_name, self.test_registry_name, 'no.such.registry']
+        for package_names in (
+                ['site'], ['forms'], ['service', 'forms'], ['widget'], []):
+            expected = {}
+            for source_f, n_filter in dist.sourcepath_methods_list[
+                    'explicit']:
+                for registry_name in registries:
+                    expected.update(
+                        (k, n_filter(v)) for k, v in source_f(
+                            package_names, registry_name=registry_name
+                        ).items()
+                    )
+            self.assertEqual(
+                dist.explicit_module_registry_dependencies(
+                    package_names, registries), expected)
+
+    def test_get_tagged_module_registry_dependencies(self):
+        tagged = dist.get_tagged_module_registry_dependencies(
+            ['forms'], [self.registry_name])
+        self.assertTrue(tagged['forms/ui'][1])
+        self.assertTrue(tagged['forms/ui'][0].endswith('ui.js'))
+        self.assertFalse(tagged['framework/lib'][1])
+
     def test_get_calmjs_module_registry_for_site_no_registry(self):
         # since site doesn't actually define an explicit registry that
         # it needs.
@@ -198,3 +230,133 @@ class DistIntegrationTestCase(unittest.TestCase):
         self.assertEqual(sorted(mapping.keys()), ['jquery', 'underscore'])
         self.assertEqual(mapping['jquery'], 'empty:')
         self.assertEqual(mapping['underscore'], 'empty:')
+
+
+class DistCacheTestCase(unittest.TestCase):
+    """
+    The persistent memoization of the dist functions.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        utils.setup_class_integration_environment(cls)
+
+    @classmethod
+    def tearDownClass(cls):
+        utils.teardown_class_integration_environment(cls)
+
+    def setUp(self):
+        self.cache_dir = utils.mkdtemp(self)
+        self.calls = []
+
+    def tracked(self, f):
+        def wrapper(package_names, **kw):
+            self.calls.append(f.__name__)
+            return f(package_names, **kw)
+        wrapper.__name__ = f.__name__
+        wrapper.__module__ = f.__module__
+        return wrapper
+
+    def resolve(self, method='explicit'):
+        cache = dist.get_dist_cache(self.cache_dir)
+        with pretty_logging(stream=StringIO()):
+            return (
+                dist.get_calmjs_module_registry_for(
+                    ['site'], method=method, cache=cache),
+                dist.generate_transpile_sourcepaths(
+                    ['site'], registries=(self.registry_name,),
+                    method=method, cache=cache),
+                dist.generate_bundle_sourcepaths(
+                    ['site'], self.dist_dir, method=method, cache=cache),
+            )
+
+    def stub_methods(self):
+        for methods in (
+                dist.sourcepath_methods_list,
+                dist.sourcepath_resolvers,
+                dist.calmjs_module_registry_methods,
+                dist.extras_calmjs_methods):
+            self.addCleanup(methods.update, dict(methods))
+            for key, value in list(methods.items()):
+                if not isinstance(value, tuple):
+                    value = self.tracked(value)
+                elif isinstance(value[0], tuple):
+                    value = tuple(
+                        (self.tracked(f), n) for f, n in value)
+                else:
+                    value = (self.tracked(value[0]), value[1])
+                methods[key] = value
+
+    def test_get_dist_cache_disabled(self):
+        self.assertIsNone(dist.get_dist_cache(None))
+
+    def test_dist_cache_reused(self):
+        self.stub_methods()
+        results = self.resolve()
+        self.assertEqual(sorted(self.calls), [
+            'explicit_module_registry_dependencies',
+            'get_extras_json',
+            'get_module_registry_names',
+        ])
+        self.assertEqual(results, (
+            dist.get_calmjs_module_registry_for(['site'], method='explicit'),
+            dist.generate_transpile_sourcepaths(
+                ['site'], registries=(self.registry_name,),
+                method='explicit'),
+            dist.generate_bundle_sourcepaths(
+                ['site'], self.dist_dir, method='explicit'),
+        ))
+
+        self.calls[:] = []
+        self.assertEqual(self.resolve(), results)
+        self.assertEqual(self.calls, [])
+
+        # other methods are cached separately.
+        self.resolve(method='all')
+        self.assertEqual(sorted(self.calls), [
+            'flatten_extras_json',
+            'flatten_module_registry_dependencies',
+            'flatten_module_registry_names',
+        ])
+
+    def test_dist_cache_order_preserved(self):
+        def ordered(package_names):
+            self.calls.append(package_names)
+            return OrderedDict([
+                ('z', OrderedDict([('b', '2'), ('a', '1')])),
+                ('m', ['y', 'x']),
+                ('a', '0'),
+            ])
+
+        cache = dist.get_dist_cache(self.cache_dir)
+        with pretty_logging(stream=StringIO()):
+            missed = cache.call(ordered, ['site'])
+            hit = cache.call(ordered, ['site'])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(list(hit), ['z', 'm', 'a'])
+        self.assertEqual(list(hit), list(missed))
+        self.assertEqual(list(hit['z']), list(missed['z']))
+        self.assertEqual(hit['m'], ['y', 'x'])
+
+    def test_dist_cache_invalidated_by_sources(self):
+        self.resolve()
+        self.stub_methods()
+        _, transpile_sourcepath, _ = self.resolve(method='all')
+        self.calls[:] = []
+        source_dir = os.path.dirname(transpile_sourcepath['forms/ui'])
+        st = os.stat(source_dir)
+        os.utime(source_dir, (st.st_atime, st.st_mtime + 10))
+        self.resolve(method='all')
+        self.assertEqual(self.calls, ['flatten_module_registry_dependencies'])
+
+    def test_dist_cache_invalidated_by_working_set(self):
+        self.stub_methods()
+        self.resolve()
+        self.calls[:] = []
+        dist_ = self.working_set.find(Requirement.parse('site'))
+        metadata = join(
+            dist_.egg_info, sorted(os.listdir(dist_.egg_info))[0])
+        st = os.stat(metadata)
+        os.utime(metadata, (st.st_atime, st.st_mtime + 10))
+        self.resolve()
+        self.assertEqual(len(self.calls), 3)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import unittest
+from os.path import join
+
+from calmjs.toolchain import Spec
+from calmjs.utils import pretty_logging
+
+from calmjs.rjs import fingerprint
+
+from calmjs.testing import utils
+from calmjs.testing.mocks import StringIO
+
+
+class FingerprintTestCase(unittest.TestCase):
+
+    def test_normalize_js(self):
+        self.assertEqual(fingerprint.normalize_js(
+            '// a comment\r\n'
+            '  var a = 1;\r\n'
+            '\r\n'
+            '\tvar b = 2;  \n'
+            '//# sourceMappingURL=a.js.map\n'
+        ), 'var a = 1;\nvar b = 2;')
+
+    def test_fingerprint_text(self):
+        self.assertEqual(
+            fingerprint.fingerprint_text('var a = 1;\n'),
+            fingerprint.fingerprint_text('// header\n    var a = 1;\r\n'),
+        )
+        self.assertNotEqual(
+            fingerprint.fingerprint_text('var a = 1;\n'),
+            fingerprint.fingerprint_text('var a = 2;\n'),
+        )
+
+    def test_fingerprint_path_missing(self):
+        tmpdir = utils.mkdtemp(self)
+        self.assertIsNone(
+            fingerprint.fingerprint_path(join(tmpdir, 'missing.js')))
+
+    def test_find_duplicate_modules(self):
+        tmpdir = utils.mkdtemp(self)
+
+        def write(name, text):
+            path = join(tmpdir, name)
+            with open(path, 'w') as fd:
+                fd.write(text)
+            return path
+
+        spec = Spec(
+            transpile_sourcepath={
+                'example/lib': write('lib.js', 'var lib = {};\n'),
+                'example/main': write('main.js', 'var main = {};\n'),
+                'example/stubbed': 'empty:',
+            },
+            bundle_sourcepath={
+                'lib': write('dist_lib.js', '/* lib */\n  var lib = {};\n'),
+                'also_lib': write('also.js', 'var lib = {};\n'),
+                'missing': join(tmpdir, 'no_such_file.js'),
+                'dir': tmpdir,
+            },
+        )
+        duplicates = fingerprint.find_duplicate_modules(spec)
+        # the block comment is not normalized away.
+        self.assertEqual(duplicates, {'also_lib': 'example/lib'})
+
+        spec = Spec(transpile_sourcepath={
+            'a/x': write('ax.js', "var x = require('./util');\n"),
+            'a/y': write('ay.js', "var x = require('./util');\n"),
+            'b/x': write('bx.js', "var x = require('./util');\n"),
+            'c/x': write('cx.js', "var x = require('../a/util');\n"),
+            'a/t': write('at.js', "var t = require('text!./t.html');\n"),
+            'b/t': write('bt.js', "var t = require('text!./t.html');\n"),
+            'bad': write('bad.js', "var x = require('./util')(;\n"),
+            'also_bad': write('bad2.js', "var x = require('./util')(;\n"),
+        })
+        # only the ones where the relative imports resolve identically.
+        self.assertEqual(
+            fingerprint.find_duplicate_modules(spec), {'a/y': 'a/x'})
+
+        with pretty_logging(stream=StringIO()) as s:
+            fingerprint.log_duplicate_modules(duplicates)
+        self.assertIn(
+            "module 'example/lib' has identical content as module(s) "
+            "'also_lib'", s.getvalue())
+
+    def test_resolve_relative_import(self):
+        self.assertEqual(
+            fingerprint.resolve_relative_import('a/b/c', './d'), 'a/b/d')
+        self.assertEqual(
+            fingerprint.resolve_relative_import('a/b/c', '../d'), 'a/d')
+        self.assertEqual(
+            fingerprint.resolve_relative_import('a/b', 'text!./d.html'),
+            'text!a/d.html')
+        self.assertEqual(
+            fingerprint.resolve_relative_import('a/b', 'd'), 'd')
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+from os.path import join
+from subprocess import CalledProcessError
+
+from calmjs.utils import pretty_logging
+
+from calmjs.rjs import instrument
+from calmjs.rjs.cache import ResultCache
+
+from calmjs.testing.mocks import StringIO
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
+
+
+class InstrumentPathsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = mkdtemp(self)
+        self.cache = ResultCache(join(mkdtemp(self), 'cache'))
+        self.paths = []
+        for name in ('a', 'b'):
+            path = join(self.build_dir, name + '.js')
+            with open(path, 'w') as fd:
+                fd.write('var %s = 1;' % name)
+            self.paths.append(path)
+        self.jobs = []
+
+        def call(args, env=None):
+            with open(args[2]) as fd:
+                jobs = json.load(fd)
+            self.jobs.append(sorted(job['source'] for job in jobs))
+            for job in jobs:
+                with open(job['source']) as fd:
+                    text = fd.read()
+                with open(job['target'], 'w') as fd:
+                    fd.write('/* %s */ %s' % (json.dumps(
+                        job['filename']), text))
+            return 0
+
+        stub_item_attr_value(self, instrument, 'which', lambda cmd: 'node')
+        stub_item_attr_value(
+            self, instrument, 'check_output', lambda args, **kw: b'1.0\n')
+        stub_item_attr_value(self, instrument, 'call', call)
+
+    def test_instrument_paths_cached(self):
+        with pretty_logging(stream=StringIO()) as s:
+            results = instrument.instrument_paths(
+                self.paths, self.cache, self.build_dir)
+        self.assertEqual(sorted(results), self.paths)
+        self.assertEqual(
+            results[self.paths[0]],
+            join(self.build_dir, 'instrumented', 'a.js'))
+        self.assertEqual(self.jobs, [self.paths])
+        self.assertIn('instrumented 2 module(s) for coverage, with 0 reused',
+                      s.getvalue())
+        with open(results[self.paths[0]]) as fd:
+            self.assertEqual(fd.read(), '/* %s */ var a = 1;' % json.dumps(
+                self.paths[0]))
+
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(results, instrument.instrument_paths(
+                self.paths, self.cache, self.build_dir))
+        self.assertEqual(len(self.jobs), 1)
+        self.assertIn('with 2 reused', s.getvalue())
+
+        with open(self.paths[1], 'w') as fd:
+            fd.write('var b = 2;')
+        with pretty_logging(stream=StringIO()):
+            instrument.instrument_paths(
+                self.paths, self.cache, self.build_dir)
+        self.assertEqual(self.jobs[1], [self.paths[1]])
+
+        # another version of the instrumenter.
+        stub_item_attr_value(
+            self, instrument, 'check_output', lambda args, **kw: b'2.0')
+        with pretty_logging(stream=StringIO()):
+            instrument.instrument_paths(
+                self.paths, self.cache, self.build_dir)
+        self.assertEqual(self.jobs[2], self.paths)
+
+    def test_instrument_paths_reused_across_build_dirs(self):
+        with pretty_logging(stream=StringIO()):
+            instrument.instrument_paths(self.paths, self.cache, self.build_dir)
+        self.assertEqual(len(self.jobs), 1)
+
+        build_dir = mkdtemp(self)
+        paths = []
+        for name in ('a', 'b'):
+            path = join(build_dir, name + '.js')
+            with open(path, 'w') as fd:
+                fd.write('var %s = 1;' % name)
+            paths.append(path)
+
+        with pretty_logging(stream=StringIO()) as s:
+            results = instrument.instrument_paths(paths, self.cache, build_dir)
+        # no further invocation of the instrumenter.
+        self.assertEqual(len(self.jobs), 1)
+        self.assertIn('with 2 reused', s.getvalue())
+        self.assertEqual(
+            results[paths[1]], join(build_dir, 'instrumented', 'b.js'))
+        # with the path to the module in the new build directory.
+        with open(results[paths[1]]) as fd:
+            self.assertEqual(fd.read(), '/* %s */ var b = 1;' % json.dumps(
+                paths[1]))
+
+    def test_instrument_paths_failure(self):
+        stub_item_attr_value(
+            self, instrument, 'call', lambda args, env=None: 1)
+        with pretty_logging(stream=StringIO()) as s:
+            results = instrument.instrument_paths(
+                self.paths + [join(self.build_dir, 'missing.js')],
+                self.cache, self.build_dir)
+        self.assertEqual(results, {})
+        self.assertIn('instrumenter exited with return code 1', s.getvalue())
+
+    def test_instrument_paths_unavailable(self):
+        def check_output(args, **kw):
+            raise CalledProcessError(1, args)
+
+        stub_item_attr_value(self, instrument, 'check_output', check_output)
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(instrument.instrument_paths(
+                self.paths, self.cache, self.build_dir), {})
+        self.assertIn('istanbul-lib-instrument not available', s.getvalue())
+
+        stub_item_attr_value(self, instrument, 'which', lambda cmd: None)
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(instrument.instrument_paths(
+                self.paths, self.cache, self.build_dir), {})
+        self.assertIn('node not found', s.getvalue())
+        self.assertEqual(self.jobs, [])
+
+    def test_get_node_env(self):
+        env = instrument.get_node_env(self.build_dir)
+        self.assertTrue(env['NODE_PATH'].startswith(
+            join(self.build_dir, 'node_modules')))
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import os
+import socket
+import sys
+from codecs import open
+from os.path import exists
+from os.path import join
+from subprocess import Popen
+
+from pkg_resources import WorkingSet
+
+from calmjs.exc import AdviceAbort
+from calmjs.toolchain import NullToolchain
+from calmjs.toolchain import Spec
+from calmjs.utils import pretty_logging
+
+try:
+    from calmjs.dev import cli
+    from calmjs.dev import karma
+    from calmjs.rjs import karma as rjs_karma
+except ImportError:  # pragma: no cover
+    cli = karma = rjs_karma = None
+
+from calmjs.testing.mocks import StringIO
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
+
+
+@unittest.skipIf(rjs_karma is None, 'calmjs.dev not available')
+class RJSKarmaRuntimeTestCase(unittest.TestCase):
+
+    def test_argparser(self):
+        runtime = rjs_karma.RJSKarmaRuntime(
+            cli.KarmaDriver.create(), working_set=WorkingSet([]))
+        args, _ = runtime.argparser.parse_known_args([
+            '--karma-shards', '3', '--test-durations', 'durations.json'])
+        self.assertEqual(args.karma_shards, 3)
+        self.assertEqual(args.karma_test_durations, 'durations.json')
+
+        args, _ = runtime.argparser.parse_known_args([
+            '--select-changed', '--changed-file', 'a.js',
+            '--changed-file', 'b.js'])
+        self.assertTrue(args.karma_select_changed)
+        self.assertEqual(args.karma_changed_files, ['a.js', 'b.js'])
+
+        args, _ = runtime.argparser.parse_known_args(['--minimal-deps'])
+        self.assertTrue(args.karma_minimal_deps)
+
+        args, _ = runtime.argparser.parse_known_args(['--karma-bundle'])
+        self.assertTrue(args.karma_bundle)
+
+        args, _ = runtime.argparser.parse_known_args(['--coverage-cache'])
+        self.assertTrue(args.karma_coverage_cache)
+
+    def test_update_spec(self):
+        spec = Spec(karma_shards=2)
+        rjs_karma.update_spec_for_karma_requirejs(
+            spec, karma_shards=None, karma_test_durations='durations.json',
+            export_target='unrelated.js')
+        self.assertEqual(spec['karma_shards'], 2)
+        self.assertEqual(spec['karma_test_durations'], 'durations.json')
+        self.assertNotIn('export_target', spec)
+
+    def test_run_runtime(self):
+        specs = []
+
+        class Driver(cli.KarmaDriver):
+            def run(self, toolchain, spec):
+                specs.append(spec)
+
+        class Runtime(object):
+            toolchain = NullToolchain()
+
+            def kwargs_to_spec(self, **kwargs):
+                # as done by the toolchain runtimes, which only pass the
+                # arguments that they know of.
+                return Spec(build_dir=kwargs['build_dir'])
+
+        runtime = rjs_karma.RJSKarmaRuntime(
+            Driver.create(), working_set=WorkingSet([]))
+        build_dir = mkdtemp(self)
+        spec = runtime._run_runtime(
+            Runtime(), build_dir=build_dir, karma_shards=2)
+        self.assertEqual(specs, [spec])
+        self.assertEqual(spec['build_dir'], build_dir)
+        self.assertEqual(spec['karma_shards'], 2)
+
+
+@unittest.skipIf(rjs_karma is None, 'calmjs.dev not available')
+class RJSKarmaDriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = mkdtemp(self)
+        self.driver = rjs_karma.RJSKarmaDriver()
+        self.popen_args = []
+        self.return_codes = {}
+
+        test = self
+
+        class Popen(object):
+            def __init__(self, args, **kw):
+                test.popen_args.append(args)
+                self.args = args
+
+            def wait(self):
+                return test.return_codes.get(self.args[2], 0)
+
+        stub_item_attr_value(self, rjs_karma, 'Popen', Popen)
+        stub_item_attr_value(self, self.driver, 'which', lambda: 'karma')
+
+    def make_spec(self, shards):
+        spec = Spec(build_dir=self.build_dir, karma_shards=len(shards))
+        # as done by the advice.
+        spec.advise(
+            karma.BEFORE_KARMA, spec.__setitem__,
+            'karma_requirejs_test_shards', shards)
+        return spec
+
+    def test_karma_shards(self):
+        shards = [join(self.build_dir, 'karma.conf.%d.js' % idx)
+                  for idx in range(3)]
+        spec = self.make_spec(shards)
+        with pretty_logging(stream=StringIO()) as s:
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 0)
+        self.assertEqual(self.popen_args, [
+            ['karma', 'start', shard, '--color'] for shard in shards])
+        self.assertIn('executed 3 karma shard(s) concurrently', s.getvalue())
+
+    def test_karma_shards_failure(self):
+        shards = [join(self.build_dir, 'karma.conf.%d.js' % idx)
+                  for idx in range(3)]
+        self.return_codes[shards[1]] = 2
+        self.return_codes[shards[2]] = 1
+        spec = self.make_spec(shards)
+        with pretty_logging(stream=StringIO()) as s:
+            self.driver.karma(spec)
+        # all the shards are executed, with the first failure recorded.
+        self.assertEqual(len(self.popen_args), 3)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 2)
+        self.assertIn('karma exited with return code 1', s.getvalue())
+
+    def test_karma_single(self):
+        spec = Spec(build_dir=self.build_dir)
+        stub_item_attr_value(self, cli, 'call', lambda args, **kw: 3)
+        with pretty_logging(stream=StringIO()):
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 3)
+        self.assertEqual(self.popen_args, [])
+
+
+@unittest.skipIf(rjs_karma is None, 'calmjs.dev not available')
+class KarmaServerHelpersTestCase(unittest.TestCase):
+
+    def start_process(self, duration=60):
+        proc = Popen([
+            sys.executable, '-c', 'import time; time.sleep(%d)' % duration])
+        self.addCleanup(proc.wait)
+        self.addCleanup(rjs_karma.stop_process, proc.pid)
+        return proc
+
+    def test_is_process_alive(self):
+        self.assertTrue(rjs_karma.is_process_alive(os.getpid()))
+        self.assertFalse(rjs_karma.is_process_alive(None))
+        self.assertFalse(rjs_karma.is_process_alive(0))
+
+    def test_get_process_identity(self):
+        proc1 = self.start_process()
+        proc2 = self.start_process(61)
+        identity = rjs_karma.get_process_identity(proc1.pid)
+        self.assertTrue(identity)
+        self.assertEqual(rjs_karma.get_process_identity(proc1.pid), identity)
+        self.assertNotEqual(
+            rjs_karma.get_process_identity(proc2.pid), identity)
+        self.assertNotEqual(
+            rjs_karma.get_process_identity(os.getpid()), identity)
+
+    def test_is_server_alive(self):
+        proc = self.start_process()
+        state = {
+            'pid': proc.pid,
+            'identity': rjs_karma.get_process_identity(proc.pid),
+        }
+        self.assertTrue(rjs_karma.is_server_alive(state))
+        # a pid that got reused by another process.
+        self.assertFalse(rjs_karma.is_server_alive(
+            {'pid': proc.pid, 'identity': 'another process'}))
+        self.assertFalse(rjs_karma.is_server_alive({'pid': proc.pid}))
+        self.assertFalse(rjs_karma.is_server_alive({}))
+
+    def test_stop_process_wait_for_exit(self):
+        proc = self.start_process()
+        self.assertFalse(rjs_karma.wait_for_exit(proc.pid, 0))
+        rjs_karma.stop_process(proc.pid)
+        self.assertTrue(rjs_karma.wait_for_exit(proc.pid, 10))
+        self.assertFalse(rjs_karma.is_process_alive(proc.pid))
+
+    def test_wait_for_port(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('localhost', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        self.assertTrue(rjs_karma.wait_for_port(port, 0))
+        server.close()
+        self.assertFalse(rjs_karma.wait_for_port(port, 0))
+
+
+# a stand-in for the karma binary; the start command listens on the port
+# from the configuration (shifted by the port_offset in the control file)
+# and the run command reports that no browser is captured for the first
+# no_capture invocations.
+FAKE_KARMA = """\
+import json
+import os
+import re
+import socket
+import sys
+import time
+
+root = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(root, 'control.json')) as fd:
+    control = json.load(fd)
+with open(os.path.join(root, 'calls.log'), 'a') as fd:
+    fd.write(' '.join(sys.argv[1:3]) + '\\n')
+with open(sys.argv[2]) as fd:
+    port = int(re.search(r'"port": (\\d+)', fd.read()).group(1))
+
+if sys.argv[1] == 'start':
+    port += control.get('port_offset', 0)
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', port))
+    server.listen(5)
+    sys.stdout.write('Karma server started at http://localhost:%d/\\n' % port)
+    sys.stdout.flush()
+    while True:
+        time.sleep(1)
+
+socket.create_connection(('localhost', port), 5).close()
+counter = os.path.join(root, 'runs')
+runs = int(open(counter).read()) if os.path.exists(counter) else 0
+with open(counter, 'w') as fd:
+    fd.write(str(runs + 1))
+if runs < control.get('no_capture', 0):
+    sys.stdout.write('No captured browser, open http://localhost/\\n')
+    sys.exit(1)
+sys.stdout.write('Executed 1 of 1 SUCCESS\\n')
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@unittest.skipIf(rjs_karma is None, 'calmjs.dev not available')
+@unittest.skipIf(os.name == 'nt', 'karma server not supported on Windows')
+class KarmaServerDriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = mkdtemp(self)
+        self.bin_dir = mkdtemp(self)
+        self.binary = join(self.bin_dir, 'karma')
+        with open(self.binary, 'w', encoding='utf-8') as fd:
+            fd.write('#!%s\n' % sys.executable)
+            fd.write(FAKE_KARMA)
+        os.chmod(self.binary, 0o755)
+        self.set_control()
+        self.port = free_port()
+        self.driver = rjs_karma.KarmaServerDriver(
+            port=self.port, startup_timeout=10, capture_timeout=10)
+        stub_item_attr_value(self, self.driver, 'which', lambda: self.binary)
+        stub_item_attr_value(self, rjs_karma, 'KARMA_RUN_RETRY_INTERVAL', 0)
+        self.addCleanup(self.stop_server)
+
+    def set_control(self, **control):
+        with open(join(self.bin_dir, 'control.json'), 'w') as fd:
+            json.dump(control, fd)
+
+    def read_calls(self):
+        with open(join(self.bin_dir, 'calls.log')) as fd:
+            return fd.read().splitlines()
+
+    def read_state(self):
+        return rjs_karma.read_json(join(self.build_dir, 'karma_server.json'))
+
+    def stop_server(self):
+        state = self.read_state()
+        if isinstance(state, dict) and rjs_karma.is_server_alive(state):
+            rjs_karma.stop_process(state['pid'])
+            rjs_karma.wait_for_exit(state['pid'], 10)
+
+    def make_spec(self):
+        spec = Spec(build_dir=self.build_dir, artifact_paths=['/a.js'])
+        with pretty_logging(stream=StringIO()):
+            self.driver.setup_toolchain_spec(NullToolchain(), spec)
+        spec[karma.KARMA_CONFIG] = karma.build_base_config()
+        spec[karma.KARMA_CONFIG]['files'] = ['/test_a.js']
+        return spec
+
+    def test_setup_without_build_dir(self):
+        spec = Spec()
+        with pretty_logging(stream=StringIO()) as s:
+            self.driver.setup_toolchain_spec(NullToolchain(), spec)
+        self.assertFalse(spec[rjs_karma.KARMA_SERVER])
+        self.assertIn('starting karma for a single run', s.getvalue())
+
+    def test_write_config(self):
+        spec = self.make_spec()
+        self.assertTrue(spec[rjs_karma.KARMA_SERVER])
+        self.driver.write_config(spec)
+        config_fn = spec[karma.KARMA_CONFIG_PATH]
+        with open(config_fn, encoding='utf-8') as fd:
+            text = fd.read()
+        self.assertIn('"singleRun": false', text)
+        self.assertIn('"autoWatch": false', text)
+        self.assertIn('"port": %d' % self.port, text)
+        self.assertIn('"/a.js"', text)
+
+        # an identical configuration will leave the file untouched.
+        os.utime(config_fn, (0, 0))
+        self.driver.write_config(self.make_spec())
+        self.assertEqual(os.stat(config_fn).st_mtime, 0)
+
+    def test_karma_server_reused(self):
+        config_fn = join(self.build_dir, 'karma.conf.js')
+        with pretty_logging(stream=StringIO()) as s:
+            spec = self.make_spec()
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 0)
+        self.assertEqual(self.read_calls(), [
+            'start ' + config_fn, 'run ' + config_fn])
+        self.assertIn('in the background', s.getvalue())
+        state = self.read_state()
+        self.assertTrue(rjs_karma.is_server_alive(state))
+        self.assertEqual(state['port'], self.port)
+
+        with pretty_logging(stream=StringIO()) as s:
+            spec = self.make_spec()
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 0)
+        self.assertEqual(len(self.read_calls()), 3)
+        self.assertIn('reusing karma server', s.getvalue())
+
+        # a different set of files to be served will need a new server,
+        # started on the same port once the previous one has exited.
+        spec = self.make_spec()
+        spec[karma.KARMA_CONFIG]['files'].append('/test_b.js')
+        with pretty_logging(stream=StringIO()) as s:
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 0)
+        self.assertIn('karma configuration changed', s.getvalue())
+        self.assertFalse(rjs_karma.is_process_alive(state['pid']))
+        self.assertEqual(self.read_calls()[3:], [
+            'start ' + config_fn, 'run ' + config_fn])
+        self.assertNotEqual(self.read_state()['pid'], state['pid'])
+
+    def test_karma_server_retry_no_captured_browser(self):
+        self.set_control(no_capture=2)
+        spec = self.make_spec()
+        with pretty_logging(stream=StringIO()) as s:
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 0)
+        self.assertEqual(self.read_calls()[1:], ['run ' + join(
+            self.build_dir, 'karma.conf.js')] * 3)
+        self.assertIn('has yet to capture a browser', s.getvalue())
+
+    def test_karma_server_no_captured_browser_timeout(self):
+        self.set_control(no_capture=100)
+        self.driver.capture_timeout = 0
+        spec = self.make_spec()
+        with pretty_logging(stream=StringIO()):
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 1)
+        self.assertEqual(len(self.read_calls()), 2)
+
+    def test_karma_server_reused_pid(self):
+        # a recorded pid that now belongs to another process (this one)
+        # must neither be reused nor stopped.
+        spec = self.make_spec()
+        self.driver.write_config(spec)
+        rjs_karma.write_json(join(self.build_dir, 'karma_server.json'), {
+            'pid': os.getpid(), 'port': self.port, 'identity': 'karma',
+            'key': rjs_karma.digest_path(spec[karma.KARMA_CONFIG_PATH]),
+        })
+        with pretty_logging(stream=StringIO()) as s:
+            self.driver.karma(self.make_spec())
+        self.assertNotIn('reusing karma server', s.getvalue())
+        self.assertNotIn('stopping karma server', s.getvalue())
+        self.assertNotEqual(self.read_state()['pid'], os.getpid())
+
+    def test_karma_server_port_in_use(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('localhost', self.port))
+        server.listen(1)
+        with pretty_logging(stream=StringIO()):
+            with self.assertRaises(AdviceAbort) as e:
+                self.driver.karma(self.make_spec())
+        self.assertIn('port %d is in use' % self.port, str(e.exception))
+        self.assertFalse(exists(join(self.bin_dir, 'calls.log')))
+
+    def test_karma_server_port_mismatch(self):
+        self.set_control(port_offset=1)
+        with pretty_logging(stream=StringIO()):
+            with self.assertRaises(AdviceAbort) as e:
+                self.driver.karma(self.make_spec())
+        self.assertIn('instead of port %d' % self.port, str(e.exception))
+        pid = self.read_state()['pid']
+        self.assertTrue(rjs_karma.wait_for_exit(pid, 10))
+        self.assertEqual(len(self.read_calls()), 1)
+
+    def test_karma_single_run(self):
+        spec = Spec()
+        with pretty_logging(stream=StringIO()):
+            self.driver.setup_toolchain_spec(NullToolchain(), spec)
+        spec[karma.KARMA_CONFIG] = karma.build_base_config()
+        spec['build_dir'] = self.build_dir
+        # the call for the single run is done by the parent driver.
+        stub_item_attr_value(self, cli, 'call', lambda args, **kw: 3)
+        with pretty_logging(stream=StringIO()):
+            self.driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 3)
+        self.assertFalse(exists(join(self.bin_dir, 'calls.log')))
@@ -3,6 +3,7 @@ import unittest
 from os import mkdir
 from os import makedirs
 from os.path import exists
+from os.path import islink
 from os.path import join
 
 from calmjs.toolchain import Spec
@@ -315,6 +316,20 @@ class TextLoaderPluginTestCase(unittest.TestCase):
         })
         self.assertEqual(module_name, ['text!text_file.txt'])
 
+    def test_basic_materialize_method(self):
+        build_dir = mkdtemp(self)
+        srcdir = mkdtemp(self)
+        spec = {'build_dir': build_dir, 'materialize_method': 'symlink'}
+        source = join(srcdir, 'text_file.txt')
+
+        with open(source, 'w') as fd:
+            fd.write('a text file\n')
+
+        loaderplugin.TextPlugin(None)(
+            None, spec, 'text!text_file.txt', source, 'text!text_file.txt',
+            'text!text_file.txt')
+        self.assertTrue(islink(join(build_dir, 'text_file.txt')))
+
     def test_nested(self):
         # the target is 'namespace/text_file.txt'
         build_dir = mkdtemp(self)
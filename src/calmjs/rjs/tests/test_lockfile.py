@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+from collections import OrderedDict
+from os.path import exists
+from os.path import join
+
+from pkg_resources import Requirement
+
+from calmjs.utils import pretty_logging
+from calmjs.rjs import cli
+from calmjs.rjs import lockfile
+
+from calmjs.testing import utils
+from calmjs.testing.mocks import StringIO
+from calmjs.testing.utils import stub_item_attr_value
+
+
+class LockfileTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        utils.setup_class_integration_environment(cls)
+
+    @classmethod
+    def tearDownClass(cls):
+        utils.teardown_class_integration_environment(cls)
+
+    def setUp(self):
+        self.path = join(utils.mkdtemp(self), 'rjs.lock.json')
+
+    def create_spec(self, package_names=('site',), **kw):
+        kw.setdefault('source_registries', [self.registry_name])
+        with pretty_logging(stream=StringIO()) as s:
+            spec = cli.create_spec(
+                list(package_names), working_dir=self.dist_dir,
+                lockfile=self.path, **kw)
+        return spec, s.getvalue()
+
+    def stub_resolution(self):
+        def fail(*a, **kw):
+            raise AssertionError('sourcepaths resolved')
+
+        stub_item_attr_value(self, cli, 'generate_transpile_sourcepaths', fail)
+        stub_item_attr_value(self, cli, 'generate_bundle_sourcepaths', fail)
+
+    def test_lockfile_reused(self):
+        spec, log = self.create_spec()
+        self.assertTrue(exists(self.path))
+        self.assertIn('wrote resolved sourcepaths to lockfile', log)
+
+        self.stub_resolution()
+        locked, log = self.create_spec()
+        self.assertIn('sourcepaths recorded in lockfile', log)
+        self.assertEqual(
+            locked['transpile_sourcepath'], spec['transpile_sourcepath'])
+        self.assertEqual(
+            locked['bundle_sourcepath'], spec['bundle_sourcepath'])
+        self.assertEqual(
+            locked['calmjs_module_registry_names'], [self.registry_name])
+
+    def test_lockfile_different_inputs(self):
+        self.create_spec()
+        spec, log = self.create_spec(sourcepath_method='explicit')
+        self.assertIn('created with different arguments', log)
+        self.assertIn('wrote resolved sourcepaths to lockfile', log)
+        self.assertEqual(
+            spec['transpile_sourcepath']['forms/ui'], 'empty:')
+
+    def test_lockfile_dist_changed(self):
+        self.create_spec()
+        dist = self.working_set.find(Requirement.parse('forms'))
+        metadata = join(dist.egg_info, sorted(os.listdir(dist.egg_info))[0])
+        st = os.stat(metadata)
+        os.utime(metadata, (st.st_atime, st.st_mtime + 10))
+        spec, log = self.create_spec()
+        self.assertIn('distributions changed', log)
+        self.assertIn('wrote resolved sourcepaths to lockfile', log)
+
+    def test_lockfile_sources_changed(self):
+        spec, _ = self.create_spec()
+        source_dir = os.path.dirname(spec['transpile_sourcepath']['forms/ui'])
+        st = os.stat(source_dir)
+        os.utime(source_dir, (st.st_atime, st.st_mtime + 10))
+        spec, log = self.create_spec()
+        self.assertIn('source directories changed', log)
+
+    def test_lockfile_order_preserved(self):
+        inputs = {'package_names': ['site']}
+        transpile_sourcepath = OrderedDict([
+            ('z', 'empty:'), ('forms/ui', 'empty:'), ('a', 'empty:')])
+        bundle_sourcepath = OrderedDict([('b', 'empty:'), ('a', 'empty:')])
+        with pretty_logging(stream=StringIO()):
+            self.assertTrue(lockfile.write_lockfile(
+                self.path, inputs, [], transpile_sourcepath,
+                bundle_sourcepath))
+            _, locked_transpile, locked_bundle = lockfile.read_lockfile(
+                self.path, inputs)
+        self.assertEqual(list(locked_transpile), ['z', 'forms/ui', 'a'])
+        self.assertEqual(list(locked_bundle), ['b', 'a'])
+
+    def test_lockfile_corrupted(self):
+        with open(self.path, 'w') as fd:
+            fd.write('{')
+        spec, log = self.create_spec()
+        self.assertIn('ignoring corrupted cache file', log)
+        self.assertIn('wrote resolved sourcepaths to lockfile', log)
+
+    def test_dists_fingerprint_unresolvable(self):
+        def find_dists(package_names):
+            raise ValueError('conflict')
+
+        self.assertEqual(lockfile.get_dists_fingerprint(['no_such_pkg']), [])
+        stub_item_attr_value(
+            self, lockfile.calmjs_dist, 'find_packages_requirements_dists',
+            find_dists)
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(lockfile.get_dists_fingerprint(['site']))
+            self.assertFalse(lockfile.write_lockfile(
+                self.path, {'package_names': ['site']}, [], {}, {}))
+        self.assertIn('lockfile', s.getvalue())
+        self.assertFalse(exists(self.path))
+        self.assertEqual(
+            lockfile.get_paths_fingerprint({'a': 'empty:'}), {})
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from os.path import exists
+from os.path import join
+
+from calmjs.utils import pretty_logging
+
+from calmjs.rjs import manifest
+from calmjs.rjs.cache import ResultCache
+
+from calmjs.testing import utils
+from calmjs.testing.mocks import StringIO
+
+artifact = (
+    "define('lib', [], function() {});\n"
+    "define('app', ['require', 'lib'], function(require) {\n"
+    "    require('lib');\n"
+    "});\n"
+)
+
+
+class DefineManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = utils.mkdtemp(self)
+        self.artifact = join(self.tmpdir, 'artifact.js')
+        with open(self.artifact, 'w') as fd:
+            fd.write(artifact)
+
+    def test_digest_path(self):
+        self.assertEqual(
+            manifest.digest_path(self.artifact),
+            manifest.digest_path(self.artifact))
+        self.assertIsNone(
+            manifest.digest_path(join(self.tmpdir, 'missing.js')))
+
+    def test_write_read(self):
+        self.assertIsNone(manifest.read_define_manifest(self.artifact))
+        path = manifest.write_define_manifest(
+            self.artifact, cache=ResultCache(join(self.tmpdir, 'cache')))
+        self.assertEqual(path, self.artifact + '.defines.json')
+        with open(path) as fd:
+            self.assertEqual(json.load(fd)['version'], 1)
+        self.assertEqual(manifest.read_define_manifest(self.artifact), [
+            ['lib', []], ['app', ['lib']]])
+
+    def test_read_stale(self):
+        manifest.write_define_manifest(self.artifact)
+        with open(self.artifact, 'a') as fd:
+            fd.write("define('extra', [], function() {});\n")
+        with pretty_logging(
+                logger='calmjs.rjs.manifest', level='DEBUG',
+                stream=StringIO()) as s:
+            self.assertIsNone(manifest.read_define_manifest(self.artifact))
+        self.assertIn('does not match its artifact', s.getvalue())
+
+    def test_read_other_version(self):
+        path = manifest.write_define_manifest(self.artifact)
+        with open(path) as fd:
+            value = json.load(fd)
+        value['version'] = 0
+        with open(path, 'w') as fd:
+            json.dump(value, fd)
+        self.assertIsNone(manifest.read_define_manifest(self.artifact))
+
+    def test_write_failure(self):
+        with open(self.artifact, 'w') as fd:
+            fd.write("define('lib', [] function() {});\n")
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertIsNone(manifest.write_define_manifest(self.artifact))
+        self.assertIn('syntax error', s.getvalue())
+        self.assertFalse(exists(self.artifact + '.defines.json'))
+
+
+class PreloadManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = utils.mkdtemp(self)
+        self.artifact = join(self.tmpdir, 'artifact.js')
+        with open(self.artifact, 'w') as fd:
+            fd.write(
+                "define('app', ['require'], function(require) {\n"
+                "    require('lib');\n"
+                "    require('text!app/tmpl.html');\n"
+                "    require('jquery');\n"
+                "});\n"
+                "define('lib', ['require'], function(require) {\n"
+                "    require('underscore');\n"
+                "});\n"
+            )
+        self.external = [
+            'jquery', 'text!app/tmpl.html', 'underscore', 'unused']
+
+    def test_get_preload_entries(self):
+        records = [
+            ['app', ['lib', 'text!app/tmpl.html', 'jquery', 'missing']],
+            ['lib', ['underscore']],
+        ]
+        with pretty_logging(stream=StringIO()) as s:
+            entries = manifest.get_preload_entries(
+                records, self.artifact, self.external)
+        self.assertEqual(entries, [
+            {'type': 'module', 'name': 'underscore', 'path': 'underscore.js'},
+            {'type': 'resource', 'name': 'text!app/tmpl.html',
+             'plugin': 'text', 'resource': 'app/tmpl.html',
+             'path': 'app/tmpl.html'},
+            {'type': 'module', 'name': 'jquery', 'path': 'jquery.js'},
+            {'type': 'module', 'name': 'unused', 'path': 'unused.js'},
+            {'type': 'artifact', 'path': 'artifact.js'},
+        ])
+        self.assertEqual(s.getvalue(), '')
+
+    def test_get_preload_entries_config(self):
+        records = [
+            ['app', ['lib', 'text!app/tmpl.html', 'jquery', 'missing']],
+            ['lib', ['underscore']],
+        ]
+        entries = manifest.get_preload_entries(
+            records, self.artifact, self.external, {
+                'baseUrl': '../static',
+                'paths': {
+                    'app': 'templates/app',
+                    'jquery': ['//cdn.example.com/jquery.min', 'jquery'],
+                    'vendor': 'vendor',
+                },
+                'bundles': {
+                    'vendor/layer': ['underscore', 'unused'],
+                },
+            })
+        self.assertEqual(entries, [
+            {'type': 'layer', 'name': 'vendor/layer',
+             'path': '../static/vendor/layer.js',
+             'modules': ['underscore', 'unused']},
+            {'type': 'resource', 'name': 'text!app/tmpl.html',
+             'plugin': 'text', 'resource': 'app/tmpl.html',
+             'path': '../static/templates/app/tmpl.html'},
+            {'type': 'module', 'name': 'jquery',
+             'path': '//cdn.example.com/jquery.min.js'},
+            {'type': 'artifact', 'path': 'artifact.js'},
+        ])
+
+    def test_resolve_url(self):
+        config = {
+            'baseUrl': 'js',
+            'paths': {'lib': 'vendor/lib', 'lib/sub': '/abs/sub'},
+        }
+        self.assertEqual(manifest.resolve_url('mod', {}), 'mod.js')
+        self.assertEqual(manifest.resolve_url('mod', config), 'js/mod.js')
+        self.assertEqual(
+            manifest.resolve_url('lib/mod', config), 'js/vendor/lib/mod.js')
+        self.assertEqual(
+            manifest.resolve_url('lib/sub/mod', config), '/abs/sub/mod.js')
+        # names that are urls are used as is.
+        self.assertEqual(manifest.resolve_url('mod.js', config), 'mod.js')
+        self.assertEqual(
+            manifest.resolve_url('http://example.com/mod', config),
+            'http://example.com/mod')
+        self.assertEqual(manifest.resolve_url(
+            'mod', {'paths': {'mod': 'mod.js?v=1'}}), 'mod.js?v=1')
+        self.assertEqual(
+            manifest.resolve_resource_url('lib/tmpl.html', config),
+            'js/vendor/lib/tmpl.html')
+        self.assertEqual(
+            manifest.resolve_resource_url('.hidden', {}), '.hidden')
+
+    def test_write_preload_manifest(self):
+        path = manifest.write_preload_manifest(self.artifact, self.external)
+        self.assertEqual(path, self.artifact + '.preload.json')
+        with open(path) as fd:
+            value = json.load(fd)
+        self.assertEqual(value['version'], manifest.PRELOAD_MANIFEST_VERSION)
+        self.assertEqual(value['sha1'], manifest.digest_path(self.artifact))
+        self.assertEqual([entry.get('name') for entry in value['files']], [
+            'underscore', 'text!app/tmpl.html', 'jquery', 'unused', None])
+
+        path = manifest.write_preload_manifest(
+            self.artifact, self.external, config={'baseUrl': 'lib'})
+        with open(path) as fd:
+            value = json.load(fd)
+        self.assertEqual([entry['path'] for entry in value['files']], [
+            'lib/underscore.js', 'lib/app/tmpl.html', 'lib/jquery.js',
+            'lib/unused.js', 'artifact.js'])
+
+    def test_write_preload_manifest_from_define_manifest(self):
+        manifest.write_define_manifest(self.artifact)
+        calls = []
+
+        def process_path_defines_records(path, cache=None):
+            calls.append(path)
+
+        utils.stub_item_attr_value(
+            self, manifest, 'process_path_defines_records',
+            process_path_defines_records)
+        self.assertTrue(manifest.write_preload_manifest(self.artifact))
+        self.assertEqual(calls, [])
+
+    def test_write_preload_manifest_failure(self):
+        with open(self.artifact, 'w') as fd:
+            fd.write("define('lib', [] function() {});\n")
+        with pretty_logging(stream=StringIO()):
+            self.assertIsNone(manifest.write_preload_manifest(self.artifact))
+        self.assertFalse(exists(self.artifact + '.preload.json'))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import sys
+from os.path import exists
+from os.path import join
+from subprocess import CalledProcessError
+from subprocess import Popen
+from subprocess import check_output
+
+from calmjs.toolchain import Spec
+from calmjs.utils import pretty_logging
+from calmjs.utils import which
+
+from calmjs.rjs.instrument import get_node_env
+
+try:
+    from calmjs.dev import karma
+    from calmjs.rjs import noderunner
+except ImportError:  # pragma: no cover
+    karma = noderunner = None
+
+from calmjs.testing.mocks import StringIO
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
+
+
+def resolve_node_module(name):
+    # the path to the named module as resolved by node, if available.
+    node_bin = which('node')
+    if node_bin is None:
+        return None
+    try:
+        return check_output([
+            node_bin, '-e',
+            'process.stdout.write(require.resolve(%s))' % json.dumps(name),
+        ], env=get_node_env()).decode('utf-8') or None
+    except (OSError, CalledProcessError):
+        return None
+
+
+def skip_node_test():
+    if noderunner is None:
+        return (True, 'calmjs.dev not available')
+    if which('node') is None:
+        return (True, 'node not available')
+    for name in ('requirejs', 'mocha'):
+        if resolve_node_module(name) is None:
+            return (True, '%s not available to node' % name)
+    return (False, '')
+
+
+@unittest.skipIf(noderunner is None, 'calmjs.dev not available')
+class NodeTestRunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = mkdtemp(self)
+        self.node_config_js = join(self.build_dir, 'config.js')
+        with open(self.node_config_js, 'w') as fd:
+            fd.write('module.exports = {};')
+        self.jobs = []
+        self.cwds = []
+        self.failing = set()
+
+        test = self
+
+        class Popen(object):
+            # a fake worker that passes every test module it was given,
+            # other than the ones marked as failing.
+            def __init__(self, args, **kw):
+                with open(args[2]) as fd:
+                    job = json.load(fd)
+                test.jobs.append(job)
+                test.cwds.append(kw.get('cwd'))
+                results = {'errors': [], 'results': [{
+                    'suite': [name],
+                    'description': 'works',
+                    'success': name not in test.failing,
+                    'skipped': False,
+                    'time': 1,
+                    'log': [] if name not in test.failing else ['Error'],
+                } for name in job['tests']]}
+                with open(job['output'], 'w') as fd:
+                    json.dump(results, fd)
+
+            def poll(self):
+                return 0
+
+        stub_item_attr_value(self, noderunner, 'Popen', Popen)
+        stub_item_attr_value(self, noderunner, 'which', lambda cmd: 'node')
+
+    def make_spec(self, tests):
+        return Spec(
+            build_dir=self.build_dir,
+            toolchain_bin_path='r.js',
+            node_config_js=self.node_config_js,
+            karma_requirejs_test_paths={'mod': '/build/mod'},
+            karma_requirejs_test_deps=['mod'],
+            karma_requirejs_tests=tests,
+        )
+
+    def test_run_node_tests(self):
+        spec = self.make_spec(['test_a', 'test_b', 'test_c'])
+        with pretty_logging(stream=StringIO()) as s:
+            rc = noderunner.run_node_tests(spec, processes=2)
+        self.assertEqual(rc, 0)
+        self.assertEqual(len(self.jobs), 2)
+        self.assertEqual(sorted(
+            name for job in self.jobs for name in job['tests']),
+            ['test_a', 'test_b', 'test_c'])
+        self.assertEqual(self.jobs[0]['rjs'], 'r.js')
+        self.assertEqual(self.jobs[0]['config'], self.node_config_js)
+        self.assertEqual(self.jobs[0]['paths'], {'mod': '/build/mod'})
+        self.assertEqual(self.jobs[0]['deps'], ['mod'])
+        self.assertEqual(self.cwds, [self.build_dir, self.build_dir])
+        self.assertIn('Executed 3 of 3', s.getvalue())
+        self.assertTrue(exists(join(
+            self.build_dir, noderunner.NODE_TEST_SCRIPT_NAME)))
+        with open(spec['node_test_results']) as fd:
+            self.assertEqual(len(json.load(fd)['results']), 3)
+
+    def test_run_node_tests_failure(self):
+        self.failing.add('test_b')
+        spec = self.make_spec(['test_a', 'test_b'])
+        with pretty_logging(stream=StringIO()) as s:
+            rc = noderunner.run_node_tests(spec, processes=4)
+        self.assertEqual(rc, 1)
+        # never more workers than there are test modules.
+        self.assertEqual(len(self.jobs), 2)
+        self.assertIn('Executed 2 of 2 (1 FAILED)', s.getvalue())
+        self.assertIn('FAILED test_b works', s.getvalue())
+
+    def test_run_node_tests_missing_results(self):
+        stub_item_attr_value(self, noderunner, 'Popen', lambda args, **kw: (
+            type('Proc', (object,), {'poll': lambda self: 1})()))
+        spec = self.make_spec(['test_a'])
+        with pretty_logging(stream=StringIO()) as s:
+            rc = noderunner.run_node_tests(spec)
+        self.assertEqual(rc, 1)
+        self.assertIn('no test results were written', s.getvalue())
+
+    def test_run_node_tests_timeout(self):
+        procs = []
+
+        def popen(args, **kw):
+            # a worker that never finishes.
+            proc = Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+            procs.append(proc)
+            return proc
+
+        stub_item_attr_value(self, noderunner, 'Popen', popen)
+        spec = self.make_spec(['test_a', 'test_b'])
+        with pretty_logging(stream=StringIO()) as s:
+            rc = noderunner.run_node_tests(spec, processes=1, timeout=0.2)
+        self.assertEqual(rc, 1)
+        self.assertEqual(len(procs), 1)
+        self.assertIsNotNone(procs[0].poll())
+        self.assertIn(
+            'node test worker 0 did not finish within 0.2 seconds and was '
+            'killed; its test modules were: test_a, test_b', s.getvalue())
+        with open(spec['node_test_results']) as fd:
+            results = json.load(fd)
+        # only the timeout is recorded for the worker.
+        self.assertEqual(len(results['errors']), 1)
+        self.assertEqual(results['results'], [])
+
+    def test_run_node_tests_unavailable(self):
+        spec = self.make_spec(['test_a'])
+        spec['node_config_js'] = join(self.build_dir, 'missing.js')
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(noderunner.run_node_tests(spec), 1)
+        self.assertIn('node_config_js for the build are required',
+                      s.getvalue())
+
+        stub_item_attr_value(self, noderunner, 'which', lambda cmd: None)
+        with pretty_logging(stream=StringIO()):
+            self.assertEqual(noderunner.run_node_tests(
+                self.make_spec(['test_a'])), 1)
+        self.assertEqual(self.jobs, [])
+
+    def test_run_node_tests_no_tests(self):
+        with pretty_logging(stream=StringIO()) as s:
+            self.assertEqual(noderunner.run_node_tests(self.make_spec([])), 0)
+        self.assertIn('no test modules', s.getvalue())
+
+    def test_driver_karma(self):
+        spec = self.make_spec(['test_a'])
+        driver = noderunner.NodeTestDriver(processes=1)
+        with pretty_logging(stream=StringIO()):
+            driver.karma(spec)
+        self.assertEqual(spec[karma.KARMA_RETURN_CODE], 0)
+        self.assertEqual(len(self.jobs), 1)
+
+
+@unittest.skipIf(*skip_node_test())
+class NodeTestRunnerNodeTestCase(unittest.TestCase):
+    """
+    Execute the test script through node for real.
+    """
+
+    def test_run_node_tests(self):
+        build_dir = mkdtemp(self)
+        node_config_js = join(build_dir, 'config.js')
+        with open(node_config_js, 'w') as fd:
+            # a relative baseUrl, to be resolved from the build directory.
+            fd.write('module.exports = {"baseUrl": "."};')
+        with open(join(build_dir, 'mod.js'), 'w') as fd:
+            fd.write('define([], function() { return {"value": 1}; });')
+        with open(join(build_dir, 'test_mod.js'), 'w') as fd:
+            fd.write(
+                'define(["mod"], function(mod) {\n'
+                '    describe("mod", function() {\n'
+                '        it("works", function() {\n'
+                '            if (mod.value !== 1) throw new Error("value");\n'
+                '        });\n'
+                '        it("fails", function() {\n'
+                '            throw new Error("failure");\n'
+                '        });\n'
+                '    });\n'
+                '});\n'
+            )
+
+        spec = Spec(
+            build_dir=build_dir,
+            toolchain_bin_path=resolve_node_module('requirejs'),
+            node_config_js=node_config_js,
+            karma_requirejs_test_paths={},
+            karma_requirejs_test_deps=['mod'],
+            karma_requirejs_tests=['test_mod'],
+        )
+        with pretty_logging(stream=StringIO()) as s:
+            rc = noderunner.run_node_tests(spec, processes=1)
+        self.assertEqual(rc, 1)
+        self.assertIn('Executed 2 of 2 (1 FAILED)', s.getvalue())
+        self.assertIn('FAILED mod fails', s.getvalue())
+        with open(spec['node_test_results']) as fd:
+            results = json.load(fd)
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(sorted(
+            (r['description'], r['success']) for r in results['results']
+        ), [('fails', False), ('works', True)])
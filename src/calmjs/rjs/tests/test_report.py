@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import unittest
+from os import makedirs
+from os.path import join
+
+from calmjs.toolchain import Spec
+
+from calmjs.rjs import report
+
+from calmjs.testing import utils
+
+
+class ReportHelpersTestCase(unittest.TestCase):
+
+    def test_gzip_size(self):
+        data = b'define("a", [], function() {});\n' * 100
+        self.assertLess(report.gzip_size(data), len(data))
+        # stable output as no timestamps are involved
+        self.assertEqual(report.gzip_size(data), report.gzip_size(data))
+
+    def test_sizes(self):
+        result = report.sizes(b'abc')
+        self.assertEqual(result['raw'], 3)
+        self.assertIn('gzip', result)
+
+    def test_get_node_module_package_name(self):
+        self.assertEqual(report.get_node_module_package_name(
+            join('srv', 'node_modules', 'jquery', 'dist', 'jquery.js')),
+            'jquery',
+        )
+        self.assertEqual(report.get_node_module_package_name(
+            join('srv', 'node_modules', '@scope', 'pkg', 'index.js')),
+            '@scope/pkg',
+        )
+        self.assertEqual(report.get_node_module_package_name(join(
+            'srv', 'node_modules', 'pkg', 'node_modules', 'dep', 'i.js')),
+            'dep',
+        )
+        self.assertIsNone(report.get_node_module_package_name(
+            join('srv', 'src', 'example', 'index.js')))
+        self.assertIsNone(report.get_node_module_package_name(
+            join('srv', 'node_modules')))
+
+    def test_get_modname_package_map_missing_registry(self):
+        self.assertEqual(report.get_modname_package_map(None), {})
+        self.assertEqual(report.get_modname_package_map(
+            ['calmjs.rjs.no_such_registry']), {})
+
+
+class SizeReportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = utils.mkdtemp(self)
+        self.working_dir = utils.mkdtemp(self)
+        node_module = join(self.working_dir, 'node_modules', 'jquery')
+        makedirs(node_module)
+        self.jquery_src = join(node_module, 'jquery.js')
+        with open(self.jquery_src, 'w') as fd:
+            fd.write('var jquery = {};\n' * 10)
+        with open(join(self.build_dir, 'jquery.js'), 'w') as fd:
+            fd.write('var jquery = {};\n' * 10)
+        with open(join(self.build_dir, 'example.js'), 'w') as fd:
+            fd.write('var example = {};\n')
+        self.export_target = join(self.working_dir, 'export.js')
+        with open(self.export_target, 'w') as fd:
+            fd.write('var jquery = {};\n' * 10)
+            fd.write('var example = {};\n')
+            fd.write('// r.js wrapper\n')
+
+    def make_spec(self):
+        return Spec(
+            build_dir=self.build_dir,
+            export_target=self.export_target,
+            transpile_sourcepath={'example': '/src/example.js'},
+            bundle_sourcepath={
+                'jquery': self.jquery_src,
+                'underscore': 'empty:',
+            },
+            transpiled_modpaths={'example': 'example'},
+            transpiled_targetpaths={'example': 'example.js'},
+            bundled_modpaths={'jquery': 'jquery', 'underscore': 'empty:'},
+            bundled_targetpaths={
+                'jquery': 'jquery.js',
+                'underscore': 'empty:',
+            },
+        )
+
+    def test_generate_size_report(self):
+        result = report.generate_size_report(self.make_spec())
+        self.assertEqual(result['total']['raw'], 17 * 10 + 18 + 16)
+        self.assertEqual(sorted(result['modules']), ['example', 'jquery'])
+        self.assertEqual(result['modules']['jquery']['package'], 'jquery')
+        self.assertEqual(result['modules']['jquery']['raw'], 170)
+        self.assertEqual(
+            result['modules']['example']['package'], report.UNKNOWN_PACKAGE)
+        self.assertEqual(result['packages']['jquery']['modules'], ['jquery'])
+        self.assertEqual(result[report.UNATTRIBUTED], {'raw': 16})
+
+    def test_check_size_budget(self):
+        result = report.generate_size_report(self.make_spec())
+        self.assertEqual(report.check_size_budget(result, {
+            'total': 1000,
+            'packages': {'jquery': {'raw': 1000, 'gzip': 1000}},
+        }), [])
+
+        failures = report.check_size_budget(result, {
+            'total': {'raw': 100},
+            'packages': {
+                'jquery': {'gzip': 1},
+                'not_included': 1,
+            },
+        })
+        self.assertEqual(len(failures), 2)
+        self.assertIn("artifact 'export.js' is 204 bytes raw", failures[0])
+        self.assertIn("package 'jquery' is", failures[1])
+        self.assertIn("exceeds budget of 1", failures[1])
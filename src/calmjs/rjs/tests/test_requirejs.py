@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import gc
+import logging
+import threading
 import unittest
+import weakref
 from os.path import join
 from functools import partial
 
 from calmjs.interrogate import extract_module_imports
+from calmjs.parse.exceptions import ECMASyntaxError
+from calmjs.parse.parsers.es5 import Parser
+from calmjs.parse.parsers.es5 import parse as es5_parse
 from calmjs.interrogate import extract_function_argument
 from calmjs.rjs import requirejs
+from calmjs.rjs.cache import ResultCache
 from calmjs.utils import pretty_logging
 
 from calmjs.testing.mocks import StringIO
 from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
 
 # an example bundle including webpack blobs and requirejs AMD blobs
 artifact = """
@@ -179,6 +188,196 @@ class RequireJSHelperTestCase(unittest.TestCase):
         self.assertIn("module 'lib1' defined again in '<text>'", s)
         self.assertIn("WARNING", s)
 
+    def test_iter_defines_with_deps(self):
+        tree = requirejs.parse(
+            "define('lib1', ['lib2'], function() { require('lib3'); });\n"
+            "(function() { define('lib2', [], function() {}); })();\n"
+            "wrapped(define('hidden', [], function() {}));\n"
+            "define(['anonymous'], function() {});\n"
+        )
+        self.assertEqual(list(requirejs.iter_defines_with_deps(tree)), [
+            ('lib1', ['lib3']),
+            ('lib2', []),
+        ])
+
+    def test_extract_defines_deeply_nested(self):
+        # a nesting depth that would exceed the default recursion limit
+        # should a recursive traversal be used.
+        depth = 1200
+        text = 'var x = %sdefine("deep", [], function() {})%s;' % (
+            '[' * depth, ']' * depth)
+        self.assertEqual(['deep'], requirejs.extract_defines_with_deps(text))
+
+    def test_update_defines(self):
+        defines = {'lib1': []}
+        with pretty_logging(stream=StringIO()) as stream:
+            requirejs.update_defines(defines, [
+                ('lib1', ['lib2']),
+                ('lib2', []),
+            ], 'artifact.js')
+        self.assertEqual(defines, {'lib1': [], 'lib2': []})
+        self.assertIn(
+            "module 'lib1' defined again in 'artifact.js'", stream.getvalue())
+
+    def test_sort_defines(self):
+        self.assertEqual(requirejs.sort_defines({
+            'lib1': ['lib2', 'lib3'],
+            'lib2': ['lib3'],
+            'lib3': [],
+            'lib4': ['lib1'],
+        }), (['lib3', 'lib2', 'lib1', 'lib4'], []))
+
+    def test_sort_defines_missing(self):
+        with pretty_logging(stream=StringIO()) as stream:
+            result = requirejs.sort_defines({
+                'lib1': ['missing', 'lib2'],
+                'lib2': ['missing'],
+            })
+        self.assertEqual(result, (['lib2', 'lib1'], []))
+        self.assertEqual(1, stream.getvalue().count(
+            "module 'missing' required but seems to be missing"))
+
+    def test_sort_defines_cycles(self):
+        order, cycles = requirejs.sort_defines({
+            'lib1': ['lib2'],
+            'lib2': ['lib3'],
+            'lib3': ['lib1'],
+            'lib4': ['lib4'],
+            'lib5': ['lib1'],
+        })
+        self.assertEqual(order, ['lib3', 'lib2', 'lib1', 'lib4', 'lib5'])
+        self.assertEqual(cycles, [['lib1', 'lib2', 'lib3'], ['lib4']])
+
+    def test_sort_defines_long_chain(self):
+        count = 20000
+        defines = {'lib%d' % i: ['lib%d' % (i + 1)] for i in range(count)}
+        defines['lib%d' % count] = []
+        order, cycles = requirejs.sort_defines(defines)
+        self.assertEqual(order[0], 'lib%d' % count)
+        self.assertEqual(order[-1], 'lib0')
+        self.assertEqual(cycles, [])
+
+    def test_transitive_closure(self):
+        graph = {'a': ['b', 'c'], 'b': ['c', 'missing'], 'c': ['a'], 'd': []}
+        self.assertEqual(
+            requirejs.transitive_closure(graph, ['b']),
+            {'a', 'b', 'c', 'missing'})
+        self.assertEqual(requirejs.transitive_closure(graph, ['d']), {'d'})
+        self.assertEqual(requirejs.transitive_closure(graph, []), set())
+
+    def test_extract_defines_circular(self):
+        cycles = []
+        with pretty_logging(stream=StringIO()) as stream:
+            result = requirejs.extract_defines_with_deps(
+                "define('lib1', [], function() { require('lib2'); });\n"
+                "define('lib2', [], function() { require('lib1'); });\n",
+                cycles=cycles,
+            )
+        self.assertEqual(['lib2', 'lib1'], result)
+        self.assertEqual([['lib1', 'lib2']], cycles)
+        self.assertIn(
+            "circular dependency between modules: 'lib1' -> 'lib2' -> 'lib1'",
+            stream.getvalue())
+
+    def test_extract_defines_with_deps_from_paths_circular(self):
+        tmpdir = mkdtemp(self)
+        paths = [join(tmpdir, 'a.js'), join(tmpdir, 'b.js')]
+        with open(paths[0], 'w') as fd:
+            fd.write(
+                "define('lib1', [], function() { require('lib2'); });\n")
+        with open(paths[1], 'w') as fd:
+            fd.write(
+                "define('lib2', [], function() { require('lib3'); });\n"
+                "define('lib3', [], function() { require('lib1'); });\n"
+            )
+        cycles = []
+        with pretty_logging(stream=StringIO()):
+            result = requirejs.extract_defines_with_deps_from_paths(
+                paths, cycles=cycles)
+        self.assertEqual(['lib3', 'lib2', 'lib1'], result)
+        self.assertEqual([['lib1', 'lib2', 'lib3']], cycles)
+        # no cycles are reported for an acyclic set of modules.
+        cycles = []
+        with pretty_logging(stream=StringIO()):
+            requirejs.extract_defines_with_deps_from_paths(
+                paths[1:], cycles=cycles)
+        self.assertEqual([], cycles)
+
+    def test_extract_defines_with_deps_from_paths(self):
+        tmpdir = mkdtemp(self)
+        paths = [
+            join(tmpdir, 'a.js'), join(tmpdir, 'b.js'), join(tmpdir, 'c.js')]
+        with open(paths[0], 'w') as fd:
+            fd.write(
+                "define('lib1', [], function() { require('lib2'); });\n")
+        with open(paths[1], 'w') as fd:
+            fd.write(
+                "define('lib2', [], function() {});\n"
+                "define('lib1', [], function() {});\n"
+            )
+        with open(paths[2], 'w') as fd:
+            fd.write("define('lib3', [], function() {});\n")
+
+        trees = []
+        parse = requirejs.parse
+
+        def tracked_parse(text):
+            # all previously parsed trees should have been released,
+            # other than the most recent one which ply may still hold.
+            gc.collect()
+            self.assertTrue(all(ref() is None for ref in trees[:-1]))
+            tree = parse(text)
+            trees.append(weakref.ref(tree))
+            return tree
+
+        stub_item_attr_value(self, requirejs, 'parse', tracked_parse)
+        # force the usage of the parser.
+        stub_item_attr_value(
+            self, requirejs, 'prescan_defines_records', lambda text: None)
+        with pretty_logging(stream=StringIO()) as stream:
+            result = requirejs.extract_defines_with_deps_from_paths(paths)
+        self.assertEqual(['lib2', 'lib1', 'lib3'], result)
+        self.assertEqual(len(trees), 3)
+        self.assertIn(
+            "module 'lib1' defined again in '%s'" % paths[1],
+            stream.getvalue())
+
+    def test_extract_defines_with_deps_from_paths_processes(self):
+        tmpdir = mkdtemp(self)
+        paths = [
+            join(tmpdir, 'a.js'), join(tmpdir, 'missing.js'),
+            join(tmpdir, 'b.js'), join(tmpdir, 'c.js'),
+        ]
+        with open(paths[0], 'w') as fd:
+            fd.write(
+                "define('lib1', [], function() { require('lib2'); });\n")
+        with open(paths[2], 'w') as fd:
+            fd.write(
+                "define('lib2', [], function() {});\n"
+                "define('lib1', [], function() { require('lib3'); });\n"
+            )
+        with open(paths[3], 'w') as fd:
+            fd.write("define('lib3', [], function() {});\n")
+
+        with pretty_logging(stream=StringIO()) as stream:
+            serial = requirejs.extract_defines_with_deps_from_paths(paths)
+        serial_log = stream.getvalue()
+
+        for processes in (2, 0):
+            with pretty_logging(stream=StringIO()) as stream:
+                result = requirejs.extract_defines_with_deps_from_paths(
+                    paths, processes=processes)
+            self.assertEqual(serial, result)
+            self.assertEqual(['lib2', 'lib1', 'lib3'], result)
+            # messages from the workers are emitted by the parent.
+            self.assertIn("failed to read '%s'" % paths[1], stream.getvalue())
+            self.assertIn(
+                "module 'lib1' defined again in '%s'" % paths[2],
+                stream.getvalue())
+            self.assertEqual(
+                serial_log.count('WARNING'),
+                stream.getvalue().count('WARNING'))
+
     def test_extract_read_from_file(self):
         tmpdir = mkdtemp(self)
         src_file = join(tmpdir, 'source.js')
@@ -196,6 +395,20 @@ class RequireJSHelperTestCase(unittest.TestCase):
             'some/dummy/module3',
         ], sorted(set(result)))
 
+    def test_extract_read_from_file_cached(self):
+        tmpdir = mkdtemp(self)
+        src_file = join(tmpdir, 'source.js')
+        with open(src_file, 'w') as fd:
+            fd.write(requirejs_require)
+
+        result_cache = ResultCache(join(tmpdir, 'cache'))
+        result = requirejs.process_path(
+            src_file, requirejs.extract_imports, cache=result_cache)
+        stub_item_attr_value(
+            self, requirejs, 'prescan_module_imports', None)
+        self.assertEqual(result, requirejs.process_path(
+            src_file, requirejs.extract_imports, cache=result_cache))
+
     def test_extract_read_from_file_syntax_error(self):
         tmpdir = mkdtemp(self)
         src_file = join(tmpdir, 'source.js')
@@ -221,3 +434,253 @@ class RequireJSHelperTestCase(unittest.TestCase):
         self.assertIsNone(result)
         self.assertIn('No such file or directory:', stream.getvalue())
         self.assertIn(src_file, stream.getvalue())
+
+
+class PrescanTestCase(unittest.TestCase):
+    """
+    The lexical prescan must produce results identical to the parser
+    based extraction, or None.
+    """
+
+    fixtures = (
+        artifact,
+        artifact_multiple1,
+        artifact_multiple2,
+        artifact_multiple3,
+        artifact_multiple4,
+        commonjs_require,
+        requirejs_require,
+        "var re = /define('fake', [], function() {})[/]/g, a = b / 2 / c;"
+        "if (a) /require('fake')/.test(a);"
+        "define('real', [], function() { return x / require('dep'); });",
+        "define(\"esc'aped\\\\\", ['a', 'require', b, 'module'], "
+        "function() {});\n"
+        "require(['exports', \"c\"], function() {}, 1);\n"
+        "require(['d'], callback);\n"
+        "define('e', ['f'], function() {}());\n"
+        "a.define('g', [], function() {});\n"
+        "new define('h', [], function() {});\n"
+        "(define)('i', [], function() {});\n"
+        "wrapper(define('j', [], function() { require('k', 'l'); }));\n"
+        "define('m', [], function() { wrapper(require('n')); });\n",
+    )
+
+    def test_prescan_fixtures(self):
+        for text in self.fixtures:
+            tree = requirejs.parse(text)
+            self.assertEqual(
+                requirejs.prescan_module_imports(text),
+                list(extract_module_imports(text)),
+            )
+            self.assertEqual(
+                requirejs.prescan_defines_records(text),
+                list(requirejs.iter_defines_with_deps(tree)),
+            )
+
+    def test_prescan_no_calls(self):
+        self.assertEqual([], requirejs.prescan_module_imports('var a = 1;'))
+        self.assertEqual([], requirejs.prescan_defines_records('require;'))
+
+    def test_prescan_no_calls_syntax_error(self):
+        # the syntax errors caught by the tokenizer are still reported
+        # through the parser for the text without any calls.
+        for text in ("var a = {", "var a = 'b;", "a b;", "var a = 1; /*"):
+            self.assertIsNone(requirejs.prescan_module_imports(text))
+            self.assertIsNone(requirejs.prescan_defines_records(text))
+            with self.assertRaises(ECMASyntaxError):
+                requirejs.extract_imports(text)
+            with self.assertRaises(ECMASyntaxError):
+                requirejs.extract_defines_records(text)
+
+    def test_tokenize(self):
+        kinds, values, match = requirejs.tokenize(
+            "a = [1, 'b'] /* c */ // d\n/ 2; e = /f(/g;")
+        self.assertEqual(values, [
+            'a', '=', '[', '1', ',', "'b'", ']', '/', '2', ';',
+            'e', '=', '/f(/g', ';',
+        ])
+        self.assertEqual(kinds[12], requirejs.REGEX)
+        self.assertEqual(match[2], 6)
+
+    def test_tokenize_ambiguous(self):
+        for text in (
+                "function a() {}\n/b/.test(c);",
+                "a++ / b;",
+                "var a = `b`;",
+                "var a = () => b;",
+                "f(...a);",
+                "(a;",
+                "a);",
+                "var a = 'b;",
+                "var a = 1; /* b / c",
+                "define('a', ['b'] function() {});",
+                ):
+            self.assertIsNone(requirejs.tokenize(text))
+            self.assertIsNone(requirejs.prescan_defines_records(
+                text + "\ndefine('x', [], function() {});"))
+
+    def test_prescan_ambiguous_array(self):
+        text = "require(['a', b.c], function() {});"
+        self.assertIsNone(requirejs.prescan_module_imports(text))
+        self.assertEqual(requirejs.extract_imports(text), ['a'])
+
+    def test_extract_defines_records_fallback(self):
+        text = "a++ / b; define('lib', [], function() {});"
+        self.assertIsNone(requirejs.prescan_defines_records(text))
+        self.assertEqual(
+            requirejs.extract_defines_records(text), [('lib', [])])
+
+
+class SegmentsTestCase(unittest.TestCase):
+    """
+    The incremental extraction must produce results identical to the
+    extraction of the text as a whole.
+    """
+
+    def test_split_segments(self):
+        self.assertEqual(requirejs.split_segments(''), [''])
+        self.assertEqual(requirejs.split_segments(
+            "define('a', [], 1);\n"
+            "var b = define('b', [], 2);\n"
+            "define('c', [], 3);\n"
+        ), [
+            "define('a', [], 1);\nvar b = define('b', [], 2);\n",
+            "define('c', [], 3);\n",
+        ])
+        self.assertEqual(requirejs.split_segments(
+            "var a;\ndefine('b', [], 2);"), [
+            "var a;\n", "define('b', [], 2);"])
+
+    def test_extract_incremental(self):
+        for text in PrescanTestCase.fixtures:
+            records, segments = requirejs.extract_defines_records_incremental(
+                text)
+            self.assertEqual(records, requirejs.extract_defines_records(text))
+
+        records, segments = requirejs.extract_defines_records_incremental(
+            artifact_multiple4)
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(records, [
+            ('lib1', ['lib3']), ('lib1', ['missing']), ('lib3', [])])
+
+    def test_extract_incremental_reuse(self):
+        text = (
+            "define('a', ['b'], function(require) { require('b'); });\n"
+            "define('b', [], function() {});\n"
+        )
+        records, segments = requirejs.extract_defines_records_incremental(
+            text)
+        # the stored records for the unchanged segment are used as is.
+        for digest, value in segments.items():
+            if value[0][0] == 'b':
+                segments[digest] = [['cached', []]]
+        records, current = requirejs.extract_defines_records_incremental(
+            text.replace("require('b')", "require('c')"), segments)
+        self.assertEqual(records, [('a', ['c']), ['cached', []]])
+        self.assertEqual(len(current), 2)
+
+    def test_extract_incremental_fallback(self):
+        for text in (
+                # the artifact is wrapped as a whole.
+                "(function() {\ndefine('a', [], function() {});\n}());",
+                "/*\ndefine('a', [], function() {});\n*/",
+                "var a = 'b\\\ndefine(\\'a\\');';",
+                "a++ / b;\ndefine('a', [], function() {});",
+                ):
+            records, segments = requirejs.extract_defines_records_incremental(
+                text)
+            self.assertEqual(segments, {})
+            self.assertEqual(records, requirejs.extract_defines_records(text))
+
+    def test_process_path_defines_records(self):
+        tmpdir = mkdtemp(self)
+        src_file = join(tmpdir, 'artifact.js')
+        with open(src_file, 'w') as fd:
+            fd.write(artifact_multiple4)
+        result_cache = ResultCache(join(tmpdir, 'cache'))
+
+        self.assertEqual(
+            requirejs.process_path_defines_records(src_file),
+            requirejs.process_path_defines_records(src_file, result_cache),
+        )
+        segments = result_cache.get(
+            requirejs.SEGMENTS_CACHE_NAME, requirejs.abspath(src_file))
+        self.assertEqual(len(segments), 4)
+
+        with open(src_file, 'w') as fd:
+            fd.write(artifact_multiple4.replace('missing', 'changed'))
+        with pretty_logging(
+                logger='calmjs.rjs.requirejs', level=logging.DEBUG,
+                stream=StringIO()) as stream:
+            records = requirejs.process_path_defines_records(
+                src_file, result_cache)
+        self.assertEqual(list(records[1]), ['lib1', ['changed']])
+        self.assertIn('reused 3 of 4 segments', stream.getvalue())
+
+
+class ParserTestCase(unittest.TestCase):
+    """
+    The reused parser instances must produce the same results as fresh
+    ones.
+    """
+
+    def test_parse_reuse(self):
+        texts = [
+            artifact, "var a = /regex/;\nvar b = 'string';",
+            "var a = 1;\n\n\nvar b = 2;", "var a = ;", "var a = '",
+            "define('a', [], function() {})", requirejs_require,
+        ]
+        for text in texts:
+            try:
+                expected = repr(es5_parse(text))
+            except ECMASyntaxError as e:
+                with self.assertRaises(ECMASyntaxError) as cm:
+                    requirejs.parse(text)
+                self.assertEqual(str(e), str(cm.exception))
+            else:
+                self.assertEqual(expected, repr(requirejs.parse(text)))
+
+    def test_parse_after_syntax_error(self):
+        valid = "var a = 1;\n/* comment */ var b = /re/g;\nvar c = 'c';"
+        expected = repr(Parser().parse(valid))
+        for text in (
+                "var a = {", "var a = /*", "var a = '", "var a = /re",
+                "function f() { if (a) { var b = ; } }", "}"):
+            with self.assertRaises(ECMASyntaxError):
+                requirejs.parse(text)
+            # the parser must be left as if it were a new instance.
+            self.assertEqual(expected, repr(requirejs.parse(valid)))
+
+    def test_parse_unresettable_parser(self):
+        class Broken(object):
+            lexer = None
+            parser = None
+
+        stub_item_attr_value(self, requirejs, '_get_parser', Broken)
+        with pretty_logging(
+                logger='calmjs.rjs.requirejs', level=logging.DEBUG,
+                stream=StringIO()) as stream:
+            tree = requirejs.parse('var a = 1;')
+        self.assertEqual(repr(es5_parse('var a = 1;')), repr(tree))
+        self.assertIn('using a new parser instance', stream.getvalue())
+
+    def test_parser_per_thread(self):
+        parsers = []
+
+        def target():
+            requirejs.parse('var a = 1;')
+            parsers.append(requirejs._local.parser)
+
+        requirejs.parse('var a = 1;')
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(parsers), 1)
+        self.assertIsNot(requirejs._local.parser, parsers[0])
+
+    def test_parse_texts(self):
+        texts = ['var a = 1;', 'var b = 2;']
+        self.assertEqual(
+            [repr(es5_parse(text)) for text in texts],
+            [repr(tree) for tree in requirejs.parse_texts(texts)],
+        )
@@ -4,8 +4,10 @@ from __future__ import unicode_literals
 import unittest
 import json
 import os
+import sys
 import codecs
 from os.path import exists
+from os.path import islink
 from os.path import join
 from functools import partial
 
@@ -417,6 +419,268 @@ class ToolchainBaseUnitTestCase(unittest.TestCase):
             'empty:',
         )
 
+    def test_compile_bundle_entry_materialize_method(self):
+        build_dir = utils.mkdtemp(self)
+        src_dir = utils.mkdtemp(self)
+        src = join(src_dir, 'mod.js')
+        with open(src, 'w') as fd:
+            fd.write('var mod = {};')
+        os.mkdir(join(src_dir, 'tree'))
+        with open(join(src_dir, 'tree', 'index.js'), 'w') as fd:
+            fd.write('var index = {};')
+
+        rjs = toolchain.RJSToolchain()
+        spec = Spec(build_dir=build_dir, materialize_method='symlink')
+        self.assertEqual(rjs.compile_bundle_entry(spec, (
+            'mod', src, join('nested', 'mod.js'), 'mod')), (
+            {'mod': 'mod'}, {'mod': join('nested', 'mod.js')}, ['mod']))
+        self.assertTrue(islink(join(build_dir, 'nested', 'mod.js')))
+
+        self.assertEqual(rjs.compile_bundle_entry(spec, (
+            'tree', join(src_dir, 'tree'), 'tree', 'tree')), (
+            {'tree': 'tree'}, {'tree': 'tree'}, []))
+        self.assertTrue(islink(join(build_dir, 'tree', 'index.js')))
+
+    def test_compile_bundle_entry_default_copy(self):
+        build_dir = utils.mkdtemp(self)
+        src_dir = utils.mkdtemp(self)
+        src = join(src_dir, 'mod.js')
+        with open(src, 'w') as fd:
+            fd.write('var mod = {};')
+
+        rjs = toolchain.RJSToolchain()
+        spec = Spec(build_dir=build_dir)
+        rjs.compile_bundle_entry(spec, ('mod', src, 'mod.js', 'mod'))
+        self.assertFalse(islink(join(build_dir, 'mod.js')))
+        self.assertTrue(exists(join(build_dir, 'mod.js')))
+
+
+class ToolchainCompileDuplicateTestCase(unittest.TestCase):
+    """
+    Test the duplicate module detection done as part of compile.
+    """
+
+    def setUp(self):
+        self.build_dir = utils.mkdtemp(self)
+        self.src_dir = utils.mkdtemp(self)
+        for name in ('lib.js', 'copy.js'):
+            with open(join(self.src_dir, name), 'w') as fd:
+                fd.write('var lib = {};\n')
+
+    def make_spec(self, **kw):
+        return Spec(
+            build_dir=self.build_dir,
+            transpile_sourcepath={'lib': join(self.src_dir, 'lib.js')},
+            bundle_sourcepath={'copy': join(self.src_dir, 'copy.js')},
+            **kw
+        )
+
+    def test_compile_duplicate_ignored(self):
+        rjs = toolchain.RJSToolchain()
+        spec = self.make_spec()
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.compile(spec)
+        self.assertNotIn(toolchain.DUPLICATE_MODULES, spec)
+        self.assertNotIn('identical content', s.getvalue())
+
+    def test_compile_duplicate_reported(self):
+        rjs = toolchain.RJSToolchain()
+        spec = self.make_spec(duplicate_modules_method='report')
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.compile(spec)
+        self.assertEqual(spec[toolchain.DUPLICATE_MODULES], {'copy': 'lib'})
+        self.assertIn(
+            "module 'lib' has identical content as module(s) 'copy'",
+            s.getvalue())
+
+
+@unittest.skipIf(sys.platform == 'win32', 'uses a posix shell script')
+class ToolchainStateCacheTestCase(unittest.TestCase):
+    """
+    Test the locating of the r.js binary through the state cache.
+    """
+
+    def setUp(self):
+        utils.stub_os_environ(self)
+        self.bin_dir = utils.mkdtemp(self)
+        self.cache_dir = utils.mkdtemp(self)
+        self.rjs_bin = join(self.bin_dir, 'r.js')
+        with open(self.rjs_bin, 'w') as fd:
+            fd.write('#!/bin/sh\necho "r.js: 2.1.22, RequireJS: 2.1.22"\n')
+        os.chmod(self.rjs_bin, 0o755)
+        os.environ['PATH'] = os.pathsep.join([
+            self.bin_dir, os.environ.get('PATH', '')])
+
+    def test_find_rjs_bin_no_cache(self):
+        rjs = toolchain.RJSToolchain()
+        self.assertEqual(rjs.find_rjs_bin(Spec()), self.rjs_bin)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_find_rjs_bin_cached(self):
+        rjs = toolchain.RJSToolchain()
+        spec = Spec(rjs_cache_dir=self.cache_dir)
+        with pretty_logging(logger='calmjs', stream=mocks.StringIO()):
+            self.assertEqual(rjs.find_rjs_bin(spec), self.rjs_bin)
+
+        with open(join(self.cache_dir, 'state.json')) as fd:
+            state = json.load(fd)
+        (entry,) = state.values()
+        self.assertEqual(entry['value']['bin_path'], self.rjs_bin)
+        # versions are not queried, to avoid the spawning of binaries.
+        self.assertNotIn('version', entry['value'])
+
+        # ensure the cached value is used without further lookups.
+        rjs.which = rjs.which_with_node_modules = lambda: None
+        with pretty_logging(logger='calmjs', stream=mocks.StringIO()) as s:
+            self.assertEqual(rjs.find_rjs_bin(spec), self.rjs_bin)
+        self.assertIn("using cached '%s'" % self.rjs_bin, s.getvalue())
+
+        # changes to the binary will invalidate the entry.
+        with open(self.rjs_bin, 'a') as fd:
+            fd.write('\n')
+        with pretty_logging(logger='calmjs', stream=mocks.StringIO()):
+            self.assertIsNone(rjs.find_rjs_bin(spec))
+
+
+class ToolchainLinkTestCase(unittest.TestCase):
+    """
+    Test the link step, with r.js itself being stubbed out.
+    """
+
+    def setUp(self):
+        self.build_dir = utils.mkdtemp(self)
+        self.export_target = join(self.build_dir, 'export.js')
+        self.spec = Spec(
+            build_dir=self.build_dir,
+            export_target=self.export_target,
+            build_manifest_path=join(self.build_dir, 'build.js'),
+        )
+        self.spec[TOOLCHAIN_BIN_PATH] = 'r.js'
+
+        def call(args):
+            with open(self.export_target, 'w') as fd:
+                fd.write("define('module', [], function() {});\n")
+            return 0
+
+        utils.stub_item_attr_value(self, toolchain, 'call', call)
+
+    def test_link_no_define_manifest(self):
+        rjs = toolchain.RJSToolchain()
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            rjs.link(self.spec)
+        self.assertEqual(os.listdir(self.build_dir), ['export.js'])
+
+    def test_link_define_manifest(self):
+        rjs = toolchain.RJSToolchain()
+        self.spec[toolchain.DEFINE_MANIFEST] = True
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.link(self.spec)
+        self.assertIn('wrote define manifest', s.getvalue())
+        with open(self.export_target + '.defines.json') as fd:
+            self.assertEqual(json.load(fd)['records'], [['module', []]])
+
+    def test_link_define_manifest_failure(self):
+        rjs = toolchain.RJSToolchain()
+        self.spec[toolchain.DEFINE_MANIFEST] = True
+        utils.stub_item_attr_value(
+            self, toolchain, 'call', lambda args: 0)
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.link(self.spec)
+        self.assertIn('unable to write define manifest', s.getvalue())
+
+    def test_link_preload_manifest(self):
+        rjs = toolchain.RJSToolchain()
+        self.spec[toolchain.PRELOAD_MANIFEST] = True
+        with open(self.spec['build_manifest_path'], 'w') as fd:
+            fd.write('(\n{"paths": {"jquery": "empty:", "lib": "lib"}}\n)')
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.link(self.spec)
+        self.assertIn('wrote preload manifest', s.getvalue())
+        with open(self.export_target + '.preload.json') as fd:
+            self.assertEqual(json.load(fd)['files'], [
+                {'type': 'module', 'name': 'jquery', 'path': 'jquery.js'},
+                {'type': 'artifact', 'path': 'export.js'},
+            ])
+
+        # the locations through the config of the pages.
+        self.spec[toolchain.PRELOAD_CONFIG] = join(
+            self.build_dir, 'page.json')
+        with open(self.spec[toolchain.PRELOAD_CONFIG], 'w') as fd:
+            json.dump({'paths': {'jquery': 'vendor/jquery'}}, fd)
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            rjs.link(self.spec)
+        with open(self.export_target + '.preload.json') as fd:
+            self.assertEqual(json.load(fd)['files'][0]['path'], (
+                'vendor/jquery.js'))
+
+        utils.stub_item_attr_value(
+            self, toolchain, 'call', lambda args: 0)
+        os.remove(self.export_target)
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.link(self.spec)
+        self.assertIn('unable to write preload manifest', s.getvalue())
+
+
+class ToolchainFinalizeTestCase(unittest.TestCase):
+    """
+    Test the finalize step, which deals with the size reports.
+    """
+
+    def setUp(self):
+        self.build_dir = utils.mkdtemp(self)
+        with open(join(self.build_dir, 'module.js'), 'w') as fd:
+            fd.write('var module = {};\n')
+        self.export_target = join(self.build_dir, 'export.js')
+        with open(self.export_target, 'w') as fd:
+            fd.write('var module = {};\n')
+        self.spec = Spec(
+            build_dir=self.build_dir,
+            export_target=self.export_target,
+            transpiled_modpaths={'module': 'module'},
+            transpiled_targetpaths={'module': 'module.js'},
+        )
+
+    def test_finalize_no_report(self):
+        rjs = toolchain.RJSToolchain()
+        rjs.finalize(self.spec)
+        self.assertEqual(sorted(os.listdir(self.build_dir)), [
+            'export.js', 'module.js'])
+
+    def test_finalize_report(self):
+        rjs = toolchain.RJSToolchain()
+        report_path = join(self.build_dir, 'report.json')
+        self.spec[toolchain.SIZE_REPORT] = report_path
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            rjs.finalize(self.spec)
+
+        self.assertIn("artifact '%s' is 17 bytes" % (
+            self.export_target), s.getvalue())
+        with open(report_path) as fd:
+            result = json.load(fd)
+        self.assertEqual(result['total']['raw'], 17)
+        self.assertEqual(result['modules']['module']['raw'], 17)
+
+    def test_finalize_budget(self):
+        rjs = toolchain.RJSToolchain()
+        budget_path = join(self.build_dir, 'budget.json')
+        self.spec[toolchain.SIZE_BUDGET] = budget_path
+        with open(budget_path, 'w') as fd:
+            json.dump({'total': 100}, fd)
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            rjs.finalize(self.spec)
+
+        with open(budget_path, 'w') as fd:
+            json.dump({'total': 10}, fd)
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()) as s:
+            with self.assertRaises(RuntimeError) as e:
+                rjs.finalize(self.spec)
+
+        self.assertIn("size budget '%s' exceeded" % budget_path, str(
+            e.exception))
+        self.assertIn(
+            "artifact 'export.js' is 17 bytes raw; exceeds budget of 10",
+            s.getvalue())
+
 
 @unittest.skipIf(get_npm_version() is None, "npm is unavailable")
 class ToolchainUnitTestCase(unittest.TestCase):
@@ -781,6 +1045,7 @@ class ToolchainUnitTestCase(unittest.TestCase):
         )
         spec[rjs.rjs_bin_key] = join(tmpdir, 'r.js')
         rjs.assemble(spec)
+        self.assembled_spec = spec
 
         # the main config file
         # check that they all exists
@@ -853,3 +1118,78 @@ class ToolchainUnitTestCase(unittest.TestCase):
             'some.pylike.module': 'empty:',
             'underscore': 'empty:',
         })
+
+    def test_assemble_duplicate_modules_alias(self):
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            build_js, config_js = self.assemble_spec_config(
+                duplicate_modules_method='alias',
+                duplicate_modules={'module3': 'module1'},
+            )
+
+        self.assertEqual(build_js['include'], ['module1', 'module2'])
+        self.assertEqual(build_js['map'], {'*': {'module3': 'module1'}})
+        self.assertEqual(config_js['map'], {'*': {'module3': 'module1'}})
+        self.assertEqual(config_js['paths']['module3'], 'module1.js?')
+
+    def test_assemble_duplicate_modules_report_only(self):
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            build_js, config_js = self.assemble_spec_config(
+                duplicate_modules_method='report',
+                duplicate_modules={'module3': 'module1'},
+            )
+
+        self.assertEqual(
+            build_js['include'], ['module1', 'module2', 'module3'])
+        self.assertNotIn('map', build_js)
+        self.assertEqual(config_js['paths']['module3'], 'module3.js?')
+
+    def test_assemble_reproducible(self):
+        def assemble_raw():
+            with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+                build_js, config_js = self.assemble_spec_config(
+                    reproducible=True)
+            spec = self.assembled_spec
+            raw = []
+            for key in (
+                    'build_manifest_path', 'requirejs_config_js',
+                    'node_config_js'):
+                with open(spec[key]) as fd:
+                    raw.append(fd.read())
+            return build_js, config_js, raw
+
+        build_js, config_js, raw1 = assemble_raw()
+        self.assertEqual(build_js['out'], 'export.js')
+        self.assertEqual(config_js['baseUrl'], '.')
+        self.assertEqual(
+            build_js['include'], ['module1', 'module2', 'module3'])
+        # the keys are emitted in sorted order.
+        self.assertLess(
+            raw1[0].index('"generateSourceMaps"'), raw1[0].index('"out"'))
+
+        # a build in a different build directory produce identical files,
+        # other than the node config that must remain absolute.
+        build_js, config_js, raw2 = assemble_raw()
+        self.assertNotIn(
+            self.assembled_spec['build_dir'], ''.join(raw2[:2]))
+        self.assertEqual(raw1[:2], raw2[:2])
+        self.assertIn('"baseUrl": %s' % json.dumps(
+            self.assembled_spec['build_dir']), raw2[2])
+
+    def test_assemble_reproducible_different_drive(self):
+        def relpath(path, start):
+            raise ValueError('path is on mount C:, start on mount D:')
+
+        utils.stub_item_attr_value(self, toolchain, 'relpath', relpath)
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            build_js, config_js = self.assemble_spec_config(
+                reproducible=True)
+        self.assertEqual(
+            build_js['out'], self.assembled_spec['export_target'])
+
+    def test_assemble_not_reproducible(self):
+        with pretty_logging(logger='calmjs.rjs', stream=mocks.StringIO()):
+            build_js, config_js = self.assemble_spec_config()
+        self.assertEqual(
+            config_js['baseUrl'], self.assembled_spec['build_dir'])
+        self.assertEqual(
+            build_js['out'], self.assembled_spec['export_target'])
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import unittest
+import os
+from os.path import islink
+from os.path import join
 
 from calmjs.utils import pretty_logging
 from calmjs.rjs import utils
 
 from calmjs.testing.mocks import StringIO
+from calmjs.testing.utils import mkdtemp
 
 
 class DictGetTestCase(unittest.TestCase):
@@ -70,3 +74,77 @@ class DictKeyGetUpdateTestCase(unittest.TestCase):
             "value of base_key['k2'] is being rewritten from 'v2' to 'v4';",
             s.getvalue())
         self.assertEqual(a['base_key'], {'k1': 'v2', 'k2': 'v4'})
+
+
+class MaterializeTestCase(unittest.TestCase):
+    """
+    Placing of source files into the build directory.
+    """
+
+    def setUp(self):
+        self.src_dir = mkdtemp(self)
+        self.build_dir = mkdtemp(self)
+        self.source = join(self.src_dir, 'mod.js')
+        with open(self.source, 'w') as fd:
+            fd.write('var mod = {};\n')
+
+    def read(self, path):
+        with open(path) as fd:
+            return fd.read()
+
+    def test_materialize_methods(self):
+        for method in sorted(utils.materialize_methods):
+            target = join(self.build_dir, method + '.js')
+            utils.materialize(self.source, target, method)
+            self.assertEqual(self.read(target), 'var mod = {};\n')
+
+        self.assertTrue(islink(join(self.build_dir, 'symlink.js')))
+        self.assertFalse(islink(join(self.build_dir, 'copy.js')))
+
+    def test_materialize_default_copy(self):
+        target = join(self.build_dir, 'mod.js')
+        utils.materialize(self.source, target, None)
+        self.assertNotEqual(
+            os.stat(target).st_ino, os.stat(self.source).st_ino)
+
+    def test_materialize_replaces_link_not_written_through(self):
+        target = join(self.build_dir, 'mod.js')
+        utils.materialize(self.source, target, 'symlink')
+        other = join(self.src_dir, 'other.js')
+        with open(other, 'w') as fd:
+            fd.write('var other = {};\n')
+        utils.materialize(other, target, 'copy')
+        self.assertFalse(islink(target))
+        self.assertEqual(self.read(target), 'var other = {};\n')
+        # the original source is untouched.
+        self.assertEqual(self.read(self.source), 'var mod = {};\n')
+
+    def test_materialize_fallback(self):
+        def fail(source, target):
+            raise OSError('not supported')
+
+        target = join(self.build_dir, 'mod.js')
+        original = utils.materialize_methods['hardlink']
+        utils.materialize_methods['hardlink'] = fail
+        try:
+            with pretty_logging(
+                    logger='calmjs.rjs', level=10, stream=StringIO()) as s:
+                utils.materialize(self.source, target, 'hardlink')
+        finally:
+            utils.materialize_methods['hardlink'] = original
+
+        self.assertIn("falling back to copy", s.getvalue())
+        self.assertEqual(self.read(target), 'var mod = {};\n')
+
+    def test_materialize_tree(self):
+        nested = join(self.src_dir, 'nested')
+        os.mkdir(nested)
+        with open(join(nested, 'inner.js'), 'w') as fd:
+            fd.write('var inner = {};\n')
+        target = join(self.build_dir, 'tree')
+        utils.materialize_tree(self.src_dir, target, 'hardlink')
+        self.assertEqual(
+            self.read(join(target, 'nested', 'inner.js')), 'var inner = {};\n')
+        # materializing again over the existing tree is fine.
+        utils.materialize_tree(self.src_dir, target, 'symlink')
+        self.assertTrue(islink(join(target, 'mod.js')))
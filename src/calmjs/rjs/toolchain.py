@@ -32,15 +32,18 @@ from __future__ import unicode_literals
 
 import json
 import logging
+import os
 import sys
+from functools import partial
+from os import makedirs
 from os.path import dirname
 from os.path import join
+from os.path import relpath
 from os.path import exists
 from os.path import isdir
 from os.path import isfile
 from subprocess import call
 
-from calmjs.interrogate import extract_module_imports
 from calmjs.toolchain import Toolchain
 from calmjs.toolchain import ToolchainSpecCompileEntry
 from calmjs.toolchain import CONFIG_JS_FILES
@@ -50,12 +53,32 @@ from calmjs.toolchain import EXPORT_MODULE_NAMES
 from calmjs.toolchain import TOOLCHAIN_BIN_PATH
 
 from calmjs.toolchain import toolchain_spec_prepare_loaderplugins
-
+from calmjs.utils import json_dump
+from calmjs.utils import which
+
+from .cache import CACHE_DIR
+from .cache import StateCache
+from .cache import get_result_cache
+from .cache import hash_key
+from .dev import read_build_manifest
 from .dev import rjs_advice
 from .exc import RJSRuntimeError
 from .exc import RJSExitError
+from .fingerprint import find_duplicate_modules
+from .fingerprint import log_duplicate_modules
+from .manifest import load_preload_config
+from .manifest import write_define_manifest
+from .manifest import write_preload_manifest
 from .registry import RJS_LOADER_PLUGIN_REGISTRY_NAME
+from .report import check_size_budget
+from .report import generate_size_report
+from .report import load_size_budget
+from .report import log_size_report
+from .requirejs import extract_imports
 from .requirejs import process_path
+from .utils import MATERIALIZE_METHOD
+from .utils import materialize
+from .utils import materialize_tree
 from .umdjs import UMD_NODE_AMD_HEADER
 from .umdjs import UMD_NODE_AMD_FOOTER
 from .umdjs import UMD_NODE_AMD_INDENT
@@ -70,10 +93,24 @@ _PLATFORM_SPECIFIC_RUNTIME = {
     'win32': 'r.js.cmd',
 }
 _DEFAULT_RUNTIME = 'r.js'
+_NODE_RUNTIME = 'node'
 
 # reserved spec keys for this package
 REQUIREJS_PLUGINS = 'requirejs_plugins'
 STUB_MISSING_WITH_EMPTY = 'stub_missing_with_empty'
+# CACHE_DIR = 'rjs_cache_dir' (defined in calmjs.rjs.cache)
+SIZE_REPORT = 'size_report'
+SIZE_BUDGET = 'size_budget'
+DUPLICATE_MODULES = 'duplicate_modules'
+DUPLICATE_MODULES_METHOD = 'duplicate_modules_method'
+# MATERIALIZE_METHOD = 'materialize_method' (defined in calmjs.rjs.utils)
+REPRODUCIBLE = 'reproducible'
+DEFINE_MANIFEST = 'define_manifest'
+PRELOAD_MANIFEST = 'preload_manifest'
+PRELOAD_CONFIG = 'preload_config'
+
+# choices for DUPLICATE_MODULES_METHOD
+DUPLICATE_MODULES_METHODS = ('alias', 'ignore', 'report')
 
 
 def get_rjs_runtime_name(platform):
@@ -217,6 +254,31 @@ class RJSToolchain(Toolchain):
         return super(RJSToolchain, self).compile_loaderplugin_entry(
             spec, entry)
 
+    def compile_bundle_entry(self, spec, entry):
+        """
+        Handler for each entry for the bundle method of the compile
+        process.  This materializes the source file or directory into
+        the build directory, using the method specified through the
+        MATERIALIZE_METHOD key in the spec (copy by default).
+        """
+
+        modname, source, target, modpath = entry
+        bundled_modpath = {modname: modpath}
+        bundled_target = {modname: target}
+        export_module_name = []
+        method = spec.get(MATERIALIZE_METHOD)
+        if isfile(source):
+            export_module_name.append(modname)
+            copy_target = join(spec[BUILD_DIR], target)
+            if not exists(dirname(copy_target)):
+                makedirs(dirname(copy_target))
+            materialize(source, copy_target, method)
+        elif isdir(source):
+            copy_target = join(spec[BUILD_DIR], modname)
+            materialize_tree(source, copy_target, method)
+
+        return bundled_modpath, bundled_target, export_module_name
+
     def modname_source_target_to_modpath(self, spec, modname, source, target):
         """
         Return 'empty:' if the source is also that, as this is the only
@@ -238,6 +300,42 @@ class RJSToolchain(Toolchain):
         super(RJSToolchain, self).simple_transpile_modname_source_target(
             spec, modname, source, target)
 
+    def find_rjs_bin(self, spec):
+        """
+        Locate the r.js binary.
+
+        If a cache directory is provided through the spec, the binary
+        previously found for the same working directory and environment
+        will be used if it remains unchanged, along with the node binary
+        it will be executed with; otherwise its location will be
+        recorded there.  The versions are not queried, as that would
+        require spawning both binaries.
+        """
+
+        if not spec.get(CACHE_DIR):
+            return self.which() or self.which_with_node_modules()
+
+        state_cache = StateCache(spec[CACHE_DIR])
+        key = hash_key(
+            self.binary, self.join_cwd(), self.env_path, self.node_path,
+            os.environ.get('PATH'),
+        )
+        state = state_cache.get(key)
+        if state:
+            logger.debug("using cached '%s'", state['bin_path'])
+            return state['bin_path']
+
+        bin_path = self.which() or self.which_with_node_modules()
+        if bin_path is None:
+            return None
+
+        kw = self._gen_call_kws()
+        node_bin = which(_NODE_RUNTIME, path=kw['env'].get('PATH'))
+        state_cache.set(key, {
+            'bin_path': bin_path,
+        }, files=[p for p in (bin_path, node_bin) if p])
+        return bin_path
+
     def prepare(self, spec):
         """
         Attempts to locate the r.js binary if not already specified.  If
@@ -245,8 +343,7 @@ class RJSToolchain(Toolchain):
         """
 
         if self.rjs_bin_key not in spec:
-            which_bin = spec[self.rjs_bin_key] = (
-                self.which() or self.which_with_node_modules())
+            which_bin = spec[self.rjs_bin_key] = self.find_rjs_bin(spec)
             if which_bin is None:
                 raise RJSRuntimeError(
                     "unable to locate '%s'" % self.binary)
@@ -302,6 +399,19 @@ class RJSToolchain(Toolchain):
         # setup own advice.
         rjs_advice(spec)
 
+    def compile(self, spec):
+        """
+        Compile everything into the build directory, then fingerprint
+        the sources of the compiled modules if duplicate module handling
+        was requested.
+        """
+
+        super(RJSToolchain, self).compile(spec)
+        if spec.get(DUPLICATE_MODULES_METHOD) not in ('alias', 'report'):
+            return
+        spec[DUPLICATE_MODULES] = duplicates = find_duplicate_modules(spec)
+        log_duplicate_modules(duplicates)
+
     def assemble(self, spec):
         """
         Assemble the library by compiling everything and generate the
@@ -309,6 +419,11 @@ class RJSToolchain(Toolchain):
         """
 
         export_module_names = spec[EXPORT_MODULE_NAMES]
+        # duplicate modules will be aliased to their canonical module.
+        aliases = (
+            spec.get(DUPLICATE_MODULES, {})
+            if spec.get(DUPLICATE_MODULES_METHOD) == 'alias' else {}
+        )
 
         # the build config is the file that will be passed to r.js for
         # building the final bundle.
@@ -317,7 +432,28 @@ class RJSToolchain(Toolchain):
         update_base_requirejs_config(build_config)
         build_config['shim'].update(spec.get('shim', {}))
         build_config['out'] = spec[EXPORT_TARGET]
-        build_config['include'] = export_module_names
+        build_config['include'] = [
+            modname for modname in export_module_names
+            if modname not in aliases
+        ]
+        if aliases:
+            build_config['map'] = {'*': dict(aliases)}
+
+        reproducible = bool(spec.get(REPRODUCIBLE))
+        if reproducible:
+            # the ordering of the export module names is derived from
+            # the iteration order of the sourcepath mappings, so sort
+            # them for a stable include order; also the build directory
+            # is most likely a temporary directory, so paths are made
+            # relative to it, as r.js resolves them from the location
+            # of the build file that resides within.
+            build_config['include'].sort()
+            try:
+                build_config['out'] = relpath(
+                    spec[EXPORT_TARGET], spec[BUILD_DIR]).replace(os.sep, '/')
+            except ValueError:
+                # no relative path between different drives on Windows.
+                build_config['out'] = spec[EXPORT_TARGET]
 
         # the requirejs config is for usage of the "built" (in this
         # case, transpiled) files, so that the import names are mapped
@@ -327,8 +463,11 @@ class RJSToolchain(Toolchain):
         requirejs_config.update(build_config)
 
         # Update paths with names pointing to built files in build_dir
-        # for the configuration for serving.
-        requirejs_config['baseUrl'] = spec['build_dir']
+        # for the configuration for serving; for the reproducible mode
+        # the baseUrl is relative, such that the consumers of this
+        # configuration must resolve it against the build_dir.
+        requirejs_config['baseUrl'] = (
+            '.' if reproducible else spec['build_dir'])
         # leave as empty as this is only applicable to build
         requirejs_config['include'] = []
 
@@ -343,6 +482,7 @@ class RJSToolchain(Toolchain):
         requirejs_config['paths'] = {}
 
         emptied = set()
+        result_cache = get_result_cache(spec)
 
         # correct the targets by appending a ? for the affected targets
         source_prefixes = ('transpiled', 'bundled')
@@ -364,10 +504,14 @@ class RJSToolchain(Toolchain):
                         configured_paths[modname] = target + '?'
                         # also, do the parsing for the parsed paths
                         # this should also preemptively report potential
-                        # syntax error.
+                        # syntax error, other than the ones that only
+                        # the parser would find for the texts that the
+                        # lexical prescan has fully handled; r.js will
+                        # still report those when linking.
                         parsed_required_paths.update({
                             modname: EMPTY for modname in (process_path(
-                                full_target, extract_module_imports) or [])
+                                full_target, extract_imports,
+                                cache=result_cache) or [])
                         })
                         continue
 
@@ -376,6 +520,11 @@ class RJSToolchain(Toolchain):
         # finally, update the config with the plugin targets, which
         # should have been correctly processed by the plugin handlers.
         configured_paths.update(spec['plugins_targetpaths'])
+        configured_paths.update({
+            modname: configured_paths[canonical]
+            for modname, canonical in aliases.items()
+            if canonical in configured_paths
+        })
 
         missing_modname = (
             set(parsed_required_paths) - set(configured_paths) - emptied)
@@ -411,31 +560,40 @@ class RJSToolchain(Toolchain):
                 {k: v for k, v in spec[key].items() if v == EMPTY})
 
         # build a configuration for usage directly from nodejs (which
-        # may or may not work, but a test can find out).
+        # may or may not work, but a test can find out).  As this gets
+        # loaded through require from any working directory, the
+        # baseUrl remains absolute even for the reproducible mode.
         nodejs_config = {}
         nodejs_config.update(build_config)
         nodejs_config['baseUrl'] = spec['build_dir']
 
-        # write out the configuration files
+        # write out the configuration files; all emitted mappings are
+        # sorted by their keys for the reproducible mode.
+        dump = partial(
+            json.dump, indent=4, sort_keys=reproducible,
+            separators=(',', ': ') if reproducible else None,
+        )
         with open(spec['build_manifest_path'], 'w') as fd:
             fd.write('(\n')
-            json.dump(build_config, fd, indent=4)
+            dump(build_config, fd)
             fd.write('\n)')
 
         with open(spec['requirejs_config_js'], 'w') as fd:
             fd.write(UMD_REQUIREJS_JSON_EXPORT_HEADER)
-            json.dump(requirejs_config, fd, indent=4)
+            dump(requirejs_config, fd)
             fd.write(UMD_REQUIREJS_JSON_EXPORT_FOOTER)
 
         with open(spec['node_config_js'], 'w') as fd:
             fd.write(UMD_REQUIREJS_JSON_EXPORT_HEADER)
-            json.dump(nodejs_config, fd, indent=4)
+            dump(nodejs_config, fd)
             fd.write(UMD_REQUIREJS_JSON_EXPORT_FOOTER)
 
     def link(self, spec):
         """
         Basically link everything up as a bundle, as if statically
-        linking everything into "binary" file.
+        linking everything into "binary" file.  The define and preload
+        manifests will then be written next to the export_target if
+        requested.
         """
 
         args = (spec[self.rjs_bin_key], '-o', spec['build_manifest_path'])
@@ -448,3 +606,57 @@ class RJSToolchain(Toolchain):
                 "the final build process."
             )
             raise RJSExitError(rc, spec[self.rjs_bin_key])
+
+        if spec.get(DEFINE_MANIFEST):
+            manifest = write_define_manifest(
+                spec[EXPORT_TARGET], cache=get_result_cache(spec))
+            if manifest:
+                logger.info("wrote define manifest to '%s'", manifest)
+            else:
+                logger.warning(
+                    "unable to write define manifest for '%s'",
+                    spec[EXPORT_TARGET])
+
+        if spec.get(PRELOAD_MANIFEST):
+            # the modules excluded from the artifact are to be fetched.
+            paths = read_build_manifest(
+                spec['build_manifest_path']).get('paths', {})
+            manifest = write_preload_manifest(
+                spec[EXPORT_TARGET], external=[
+                    modname for modname, path in paths.items()
+                    if path == EMPTY
+                ], cache=get_result_cache(spec), config=(
+                    load_preload_config(spec[PRELOAD_CONFIG])
+                    if spec.get(PRELOAD_CONFIG) else None))
+            if manifest:
+                logger.info("wrote preload manifest to '%s'", manifest)
+            else:
+                logger.warning(
+                    "unable to write preload manifest for '%s'",
+                    spec[EXPORT_TARGET])
+
+    def finalize(self, spec):
+        """
+        Generate the size report for the linked artifact if requested,
+        and check it against the size budget if one was provided.
+        """
+
+        if not (spec.get(SIZE_REPORT) or spec.get(SIZE_BUDGET)):
+            return
+
+        report = generate_size_report(spec)
+        log_size_report(report)
+
+        if spec.get(SIZE_REPORT):
+            with open(spec[SIZE_REPORT], 'w') as fd:
+                json_dump(report, fd)
+            logger.info("wrote size report to '%s'", spec[SIZE_REPORT])
+
+        if spec.get(SIZE_BUDGET):
+            failures = check_size_budget(
+                report, load_size_budget(spec[SIZE_BUDGET]))
+            for failure in failures:
+                logger.error(failure)
+            if failures:
+                raise RJSRuntimeError(
+                    "size budget '%s' exceeded" % spec[SIZE_BUDGET])
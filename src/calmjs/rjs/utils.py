@@ -3,10 +3,35 @@
 Helper utilities.
 """
 
+import errno
 import logging
+import os
+import shutil
+from os import makedirs
+from os.path import abspath
+from os.path import isdir
+from os.path import join
+from os.path import lexists
+from os.path import relpath
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+# The spec key for the method for materializing source files into the
+# build directory; see materialize_methods for the available choices.
+MATERIALIZE_METHOD = 'materialize_method'
+# The spec key for the number of worker processes to use for processing
+# the files, where applicable; 0 for the number of CPUs available.
+PROCESSES = 'rjs_processes'
+
+# from linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
 
 def dict_get(d, key):
     value = d[key] = d.get(key, {})
@@ -25,3 +50,84 @@ def dict_key_update_overwrite_check(d, target, mapping):
 
     # complaints are over, finish the job.
     d[target].update(mapping)
+
+
+def _reflink(source, target):
+    """
+    Clone the source to target, sharing the underlying data blocks on
+    the filesystems that support it; an OSError is raised otherwise.
+    """
+
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    with open(source, 'rb') as src, open(target, 'wb') as tgt:
+        try:
+            if fcntl is None:
+                raise OSError(errno.ENOTSUP, 'FICLONE is unavailable')
+            fcntl.ioctl(tgt.fileno(), FICLONE, src.fileno())
+        except (OSError, IOError):
+            if copy_file_range is None:
+                raise
+            # an in-kernel copy, which may still result in a reflink.
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            while offset < size:
+                copied = copy_file_range(
+                    src.fileno(), tgt.fileno(), size - offset, offset, offset)
+                if not copied:
+                    break
+                offset += copied
+    shutil.copymode(source, target)
+
+
+def _symlink(source, target):
+    os.symlink(abspath(source), target)
+
+
+materialize_methods = {
+    'copy': shutil.copy,
+    'hardlink': os.link,
+    'reflink': _reflink,
+    'symlink': _symlink,
+}
+
+
+def materialize(source, target, method='copy'):
+    """
+    Materialize the source file at target using the provided method,
+    which is one of the keys of materialize_methods.  Falls back to a
+    plain copy should the underlying filesystem refuse the method.
+
+    Any existing file at target is removed first, such that a file
+    previously linked to some source is never written through.
+    """
+
+    f = materialize_methods.get(method or 'copy', shutil.copy)
+    if lexists(target):
+        os.remove(target)
+
+    if f is not shutil.copy:
+        try:
+            f(source, target)
+            return
+        except (OSError, IOError, NotImplementedError) as e:
+            logger.debug(
+                "failed to materialize '%s' to '%s' using method '%s'; "
+                "falling back to copy: %s", source, target, method, e)
+            if lexists(target):
+                os.remove(target)
+
+    shutil.copy(source, target)
+
+
+def materialize_tree(source, target, method='copy'):
+    """
+    Materialize all files from the source directory into the target
+    directory using the provided method.
+    """
+
+    for root, dirs, files in os.walk(source):
+        target_root = join(target, relpath(root, source))
+        if not isdir(target_root):
+            makedirs(target_root)
+        for name in files:
+            materialize(join(root, name), join(target_root, name), method)